@@ -0,0 +1,75 @@
+"""
+    Coalescing of small uplink messages into one packet, see system_send.
+"""
+import time
+
+
+class coalescer(object):
+    """
+        Collects messages until they add up to batch_bytes or the oldest of them has waited
+        linger seconds, so that small readings share one uplink packet. With linger 0 every
+        message is a batch of its own.
+    """
+
+    def __init__(self, linger, batch_bytes):
+        self.linger = linger
+        self.batch_bytes = batch_bytes
+        self.messages = []
+        self.size = 0
+        self.first = 0
+
+        self.batches = 0
+        self.batched_messages = 0
+        self.batched_bytes = 0
+        # number of batches by message count, counts are rounded up to powers of two
+        self.batch_sizes = {}
+
+    def add(self, msg, size):
+        if not self.messages:
+            self.first = time.monotonic()
+        self.messages.append(msg)
+        self.size += size
+
+    def time_left(self):
+        """
+            Seconds until the current batch has to be sent, None if there is none.
+        """
+        if not self.messages:
+            return None
+        return max(0, self.first + self.linger - time.monotonic())
+
+    def ready(self):
+        if not self.messages:
+            return False
+        return self.size >= self.batch_bytes or time.monotonic() >= self.first + self.linger
+
+    def take(self):
+        """
+            Returns the messages of the current batch and their encoded size, and starts a new batch.
+        """
+        messages = self.messages
+        size = self.size
+
+        self.batches += 1
+        self.batched_messages += len(messages)
+        self.batched_bytes += self.size
+        bucket = 1
+        while bucket < len(messages):
+            bucket *= 2
+        self.batch_sizes[bucket] = self.batch_sizes.get(bucket, 0) + 1
+
+        self.messages = []
+        self.size = 0
+        return messages, size
+
+    def get_stats(self):
+        stats = {'batches': self.batches, 'messages': self.batched_messages, 'bytes': self.batched_bytes}
+        if self.batches:
+            stats['messages per batch'] = round(float(self.batched_messages) / self.batches, 1)
+        for bucket in sorted(self.batch_sizes):
+            if bucket <= 2:
+                label = '%d' % (bucket)
+            else:
+                label = '%d-%d' % (bucket // 2 + 1, bucket)
+            stats['batches of %s' % (label)] = self.batch_sizes[bucket]
+        return stats
@@ -0,0 +1,173 @@
+"""
+    Compression of uplink messages.
+
+    Only raw payloads are compressed: message data that is bytes, or the bytes in the 'data'
+    field of a sensor message (see lib/message_codec.py). The payload is replaced by its
+    compressed bytes and the encoding is marked in the minor type of the packet, 'z' for zlib
+    and 'x' for lzma instead of 'd'. The node controller side learns the encoding from the
+    packet header and decode_data() restores the payload, nothing in the message data has to
+    be trusted or unpickled for it.
+"""
+import lzma
+import zlib
+
+
+ENCODINGS = ['none', 'zlib', 'lzma']
+
+# msg_mi_type of a data packet by the encoding of its payload
+MINOR_TYPES = {'none': 'd', 'zlib': 'z', 'lzma': 'x'}
+
+
+def compress(encoding, data):
+    if encoding == 'zlib':
+        return zlib.compress(data, 6)
+    if encoding == 'lzma':
+        return lzma.compress(data, preset=1)
+    return data
+
+
+def decompress(encoding, data):
+    if encoding == 'zlib':
+        return zlib.decompress(data)
+    if encoding == 'lzma':
+        return lzma.decompress(data)
+    if encoding == 'none':
+        return data
+    raise ValueError('unknown encoding %s' % (encoding))
+
+
+def raw_payload(data):
+    """
+        Returns the raw payload of message data, None if it has none.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return data
+    if isinstance(data, dict) and isinstance(data.get('data'), (bytes, bytearray)):
+        return data['data']
+    return None
+
+
+def replace_payload(data, payload):
+    """
+        Returns message data with its raw payload replaced, the original is not changed.
+    """
+    if isinstance(data, dict):
+        data = dict(data)
+        data['data'] = payload
+        return data
+    return payload
+
+
+def packet_encoding(minor_type):
+    """
+        Returns the encoding of the payload of a packet of the given msg_mi_type, a character or
+        its code.
+    """
+    if isinstance(minor_type, int):
+        minor_type = chr(minor_type)
+    for encoding in ENCODINGS:
+        if MINOR_TYPES[encoding] == minor_type:
+            return encoding
+    return 'none'
+
+
+def decode_data(minor_type, data):
+    """
+        Returns the data of a packet as it was before compressor.encode_data(). minor_type is
+        the msg_mi_type from the packet header.
+    """
+    encoding = packet_encoding(minor_type)
+    if encoding == 'none':
+        return data
+    return replace_payload(data, decompress(encoding, raw_payload(data)))
+
+
+class compressor(object):
+    """
+        Picks the encoding of every message. Messages below min_size are not worth it, large
+        ones get lzma, the rest zlib. The ratio achieved per key (e.g. a sensor) is tracked,
+        a key whose data does not shrink by at least min_saving is only tried again every
+        probe_interval messages. With mode 'zlib' or 'lzma' every message above min_size is
+        compressed with that encoding, with 'none' nothing is.
+    """
+
+    def __init__(self, mode='adaptive', min_size=256, lzma_min_size=65536, min_saving=0.1, probe_interval=50):
+        if not mode in ['adaptive'] + ENCODINGS:
+            raise ValueError('unknown compression %s' % (mode))
+        self.mode = mode
+        self.min_size = min_size
+        self.lzma_min_size = lzma_min_size
+        self.min_saving = min_saving
+        self.probe_interval = probe_interval
+
+        # key -> [smoothed ratio, messages skipped since the last try]
+        self.ratios = {}
+
+        # encoding -> [messages, bytes before, bytes after]
+        self.counters = {}
+        for encoding in ENCODINGS:
+            self.counters[encoding] = [0, 0, 0]
+
+    def choose(self, size, key):
+        if self.mode != 'adaptive':
+            if size < self.min_size:
+                return 'none'
+            return self.mode
+
+        if size < self.min_size:
+            return 'none'
+
+        ratio = self.ratios.get(key)
+        if ratio and ratio[0] > 1 - self.min_saving:
+            ratio[1] += 1
+            if ratio[1] < self.probe_interval:
+                return 'none'
+            ratio[1] = 0
+
+        if size >= self.lzma_min_size:
+            return 'lzma'
+        return 'zlib'
+
+    def count(self, encoding, size_in, size_out):
+        counter = self.counters[encoding]
+        counter[0] += 1
+        counter[1] += size_in
+        counter[2] += size_out
+
+    def encode_data(self, data, size, key=''):
+        """
+            Returns (encoding, data) of a message, the raw payload compressed if that pays off.
+            size is the encoded size of the message, it is counted for data without a raw payload.
+        """
+        payload = raw_payload(data)
+        if payload is None:
+            self.count('none', size, size)
+            return 'none', data
+
+        encoding = self.choose(len(payload), key)
+        if encoding == 'none':
+            self.count('none', len(payload), len(payload))
+            return 'none', data
+
+        compressed = compress(encoding, payload)
+        ratio = float(len(compressed)) / max(1, len(payload))
+
+        smoothed = self.ratios.setdefault(key, [ratio, 0])
+        smoothed[0] = 0.8 * smoothed[0] + 0.2 * ratio
+
+        if self.mode == 'adaptive' and ratio > 1 - self.min_saving:
+            self.count('none', len(payload), len(payload))
+            return 'none', data
+
+        self.count(encoding, len(payload), len(compressed))
+        return encoding, replace_payload(data, compressed)
+
+    def get_stats(self):
+        stats = {}
+        saved = 0
+        for encoding in ENCODINGS:
+            messages, size_in, size_out = self.counters[encoding]
+            stats['%s messages' % (encoding)] = messages
+            saved += size_in - size_out
+        stats['bytes saved'] = saved
+        return stats
@@ -0,0 +1,17 @@
+"""
+    Access to the node configuration files in /etc/waggle.
+
+    The directory can be changed with the WAGGLE_CONFIG_DIR environment variable,
+    e.g. to run the plugin manager against stub files and a local node controller.
+"""
+import os
+
+config_dir = os.environ.get('WAGGLE_CONFIG_DIR', '/etc/waggle')
+
+
+def read_config(name):
+    """
+        Returns the stripped content of a configuration file, e.g. read_config('node_id').
+    """
+    with open(os.path.join(config_dir, name), 'r') as file_:
+        return file_.read().strip()
@@ -0,0 +1,116 @@
+"""
+    Cuts a byte stream into frames of header, body and footer, where the length of the body
+    is given in the header, e.g. waggle packets as they come from the node controller.
+
+    The stream is read straight into one buffer and complete frames are handed out as
+    memoryviews of it, so a frame is neither copied while it arrives in pieces nor when
+    several frames arrive in one read. The buffer grows to the largest frame seen.
+"""
+
+
+class frame_decoder(object):
+    """
+        :param int header_length: Bytes of the header.
+        :param int footer_length: Bytes after the body.
+        :param body_length: Function that returns the length of the body from the header bytes.
+        :param bytes sentinel: Reply that is not a frame, e.g. b'False' for nothing waiting. It must
+            not be a prefix of any header.
+        :param int max_frame: Larger frames are taken as a corrupt stream, next_frame() raises ValueError.
+    """
+
+    def __init__(self, header_length, footer_length, body_length, sentinel=None, initial_size=65536, max_frame=64 << 20):
+        self.header_length = header_length
+        self.footer_length = footer_length
+        self.body_length = body_length
+        self.sentinel = sentinel
+        self.max_frame = max_frame
+        self.buffer = bytearray(max(initial_size, header_length + footer_length))
+        self.view = memoryview(self.buffer)
+        # the unread bytes are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # size of the frame at start, 0 while its header is incomplete
+        self.frame_size = 0
+
+        self.frames = 0
+        self.sentinels = 0
+        self.reads = 0
+
+    def reset(self):
+        """
+            Drops everything that was read, e.g. after a reconnect.
+        """
+        self.start = 0
+        self.end = 0
+        self.frame_size = 0
+
+    def pending(self):
+        return self.end - self.start
+
+    def make_room(self, size):
+        """
+            Makes sure that size bytes fit behind start. The unread bytes are moved to the front
+            of the buffer, or to a larger one if they do not fit.
+        """
+        if self.start + size <= len(self.buffer):
+            return
+        pending = self.end - self.start
+        if size > len(self.buffer):
+            buffer = bytearray(max(size, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            # frames handed out before keep the old buffer alive as long as they are used
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.buffer[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def recv_from(self, sock):
+        """
+            Reads what the socket has into the buffer, returns the number of bytes read, 0 when
+            the peer closed the connection. A frame returned by next_frame() before may be
+            overwritten.
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        self.make_room(max(self.frame_size, self.header_length + self.footer_length))
+        if self.end == len(self.buffer):
+            self.make_room(len(self.buffer) + 1)
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        self.reads += 1
+        return n
+
+    def next_frame(self):
+        """
+            Returns the next complete frame as a memoryview, the sentinel if that came next, or
+            None if more bytes have to be read first.
+        """
+        pending = self.end - self.start
+        if not self.frame_size:
+            if self.sentinel and pending and self.buffer[self.start] == self.sentinel[0]:
+                if pending < len(self.sentinel):
+                    if self.view[self.start:self.end] != self.sentinel[:pending]:
+                        raise ValueError('corrupt stream')
+                    return None
+                if self.view[self.start:self.start + len(self.sentinel)] != self.sentinel:
+                    raise ValueError('corrupt stream')
+                self.start += len(self.sentinel)
+                self.sentinels += 1
+                return self.sentinel
+
+            if pending < self.header_length:
+                return None
+            size = self.header_length + self.body_length(self.view[self.start:self.start + self.header_length]) + self.footer_length
+            if size > self.max_frame:
+                raise ValueError('frame of %d bytes exceeds %d bytes' % (size, self.max_frame))
+            self.frame_size = size
+
+        if pending < self.frame_size:
+            return None
+        frame = self.view[self.start:self.start + self.frame_size]
+        self.start += self.frame_size
+        self.frame_size = 0
+        self.frames += 1
+        return frame
@@ -0,0 +1,64 @@
+"""
+    Latency histograms that are cheap enough to be always on.
+
+    Bucket i counts the latencies of less than 2^i microseconds that did not fit into bucket
+    i - 1, so recording is an integer conversion and a bit_length(). The last bucket takes
+    everything from about 18 minutes on. Percentiles are reported as the upper bound of
+    their bucket, i.e. at most a factor of two too high.
+"""
+
+BUCKETS = 32
+
+
+class histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        i = int(seconds * 1000000).bit_length()
+        if i >= BUCKETS:
+            i = BUCKETS - 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        """
+            Returns the state of the histogram as plain types, e.g. to share it with another process.
+        """
+        return {'counts': list(self.counts), 'count': self.count, 'total': self.total, 'max': self.max}
+
+
+def percentile(snapshot, fraction):
+    """
+        Returns the latency in seconds below which the given fraction of the recorded latencies lie.
+    """
+    if not snapshot['count']:
+        return 0.0
+    wanted = snapshot['count'] * fraction
+    seen = 0
+    for i in range(BUCKETS):
+        seen += snapshot['counts'][i]
+        if seen >= wanted:
+            return min(snapshot['max'], (2 ** i) / 1000000.0)
+    return snapshot['max']
+
+
+def summary(snapshot):
+    """
+        Returns count, mean, p50, p90, p99 and max of a snapshot, the latencies in milliseconds.
+    """
+    mean = 0.0
+    if snapshot['count']:
+        mean = snapshot['total'] / snapshot['count']
+    return [snapshot['count'], round(mean * 1000, 3), round(percentile(snapshot, 0.5) * 1000, 3), round(percentile(snapshot, 0.9) * 1000, 3),
+        round(percentile(snapshot, 0.99) * 1000, 3), round(snapshot['max'] * 1000, 3)]
+
+
+summary_header = ['count', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms']
@@ -0,0 +1,112 @@
+"""
+    Encoding of plugin messages for the hops between plugin manager processes.
+
+    Messages are encoded once, in the plugin process, and the router hands the same
+    bytes to all of its listeners, the listeners decode them again. A short header
+    in front of the pickled message carries the name of the plugin that sent it and
+    the sensor, so the router can route without decoding the message.
+
+    header: format version (1 byte), source length (1 byte), sensor length (1 byte),
+    followed by source and sensor in utf-8 and the body.
+
+    FORMAT_PICKLE body: the pickled message.
+    FORMAT_RAW body: length of the metadata (4 bytes), the pickled message without its
+    'data' field, and the raw payload. Used for messages whose data is bytes, e.g. the
+    coresense frames and the alphasense histograms, so that the payload is never pickled
+    and can be sliced out of the received buffer without a copy.
+"""
+import pickle
+import struct
+
+
+HEADER = struct.Struct('!BBB')
+META_LENGTH = struct.Struct('!I')
+
+FORMAT_PICKLE = 1
+FORMAT_RAW = 2
+
+
+def message_sensor(msg):
+    """
+        Returns the sensor name of a message from waggle.pipeline, '' if it has none.
+    """
+    if isinstance(msg, dict):
+        return str(msg.get('sensor', ''))
+    return ''
+
+
+def encode_name(name):
+    """
+        Returns a plugin or sensor name in utf-8, cut to the 255 bytes that fit into the header
+        on a character boundary, so that topic() can decode it.
+    """
+    encoded = name.encode('utf-8')
+    if len(encoded) <= 255:
+        return encoded
+    return encoded[:255].decode('utf-8', 'ignore').encode('utf-8')
+
+
+def encode_parts(msg, source=''):
+    """
+        Serializes a plugin message into a list of buffers that, joined, form the encoded message.
+        A raw payload is one of the buffers as it is, so the caller can copy it straight to its
+        destination.
+
+        :param msg: The message as it was put into the mailbox by the plugin.
+        :param string source: The name of the plugin that sent the message.
+    """
+    source = encode_name(source)
+    sensor = encode_name(message_sensor(msg))
+
+    if isinstance(msg, dict) and isinstance(msg.get('data'), (bytes, bytearray, memoryview)):
+        meta = dict(msg)
+        payload = meta.pop('data')
+        meta = pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)
+        header = HEADER.pack(FORMAT_RAW, len(source), len(sensor))
+        return [header, source, sensor, META_LENGTH.pack(len(meta)), meta, payload]
+
+    header = HEADER.pack(FORMAT_PICKLE, len(source), len(sensor))
+    return [header, source, sensor, pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)]
+
+
+def encode(msg, source=''):
+    """
+        Serializes a plugin message into bytes, see encode_parts().
+    """
+    return b''.join(encode_parts(msg, source))
+
+
+def topic(data):
+    """
+        Returns (source, sensor) of an encoded message without decoding the message itself.
+    """
+    version, source_length, sensor_length = HEADER.unpack_from(data)
+    start = HEADER.size
+    source = bytes(data[start:start + source_length]).decode('utf-8')
+    start += source_length
+    sensor = bytes(data[start:start + sensor_length]).decode('utf-8')
+    return source, sensor
+
+
+def decode(data):
+    """
+        Restores a message that was serialized with encode(). The raw payload of a FORMAT_RAW
+        message is returned as a memoryview of data, not as a copy.
+
+        :param bytes data: The encoded message.
+    """
+    version, source_length, sensor_length = HEADER.unpack_from(data)
+    view = memoryview(data)
+    start = HEADER.size + source_length + sensor_length
+
+    if version == FORMAT_PICKLE:
+        return pickle.loads(view[start:])
+
+    if version == FORMAT_RAW:
+        meta_length = META_LENGTH.unpack_from(data, start)[0]
+        start += META_LENGTH.size
+        msg = pickle.loads(view[start:start + meta_length])
+        msg['data'] = view[start + meta_length:]
+        return msg
+
+    raise ValueError('unknown message format %d' % (version))
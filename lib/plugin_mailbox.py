@@ -0,0 +1,42 @@
+"""
+    The mailbox handed to a plugin in place of the raw transport.
+"""
+from lib import message_codec
+from lib.ring_buffer import ring_buffer
+
+
+def queue_reader(queue):
+    """
+        Returns the reading end of a multiprocessing queue. It becomes readable when something is
+        put into the queue, so it can be waited on with multiprocessing.connection.wait(), a ZMQ
+        poller or an event loop, together with other file descriptors.
+    """
+    return queue._reader
+
+
+class plugin_mailbox(object):
+    """
+        Encodes messages in the plugin process and tags them with the plugin name, so
+        that the router can route them by plugin and sensor without decoding them.
+
+        :param string source: The name of the plugin.
+        :param transport: The mailbox_outgoing queue or the ring buffer of the plugin.
+        :param incoming: The queue of the messages from the node controller addressed to the
+            plugin, None if the plugin has no puid. Plugins read it as mailbox.incoming.
+    """
+
+    def __init__(self, source, transport, incoming=None):
+        self.source = source
+        self.transport = transport
+        self.incoming = incoming
+
+    def put(self, msg, block=True, timeout=None):
+        parts = message_codec.encode_parts(msg, self.source)
+        if isinstance(self.transport, ring_buffer):
+            # raw payloads are copied once, straight into the shared memory
+            self.transport.put(parts, block, timeout)
+        else:
+            self.transport.put(b''.join(parts), block, timeout)
+
+    def put_nowait(self, msg):
+        self.put(msg, False)
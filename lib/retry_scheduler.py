@@ -0,0 +1,158 @@
+"""
+    Retry timing for the uplink: a timer heap of packets waiting for their next attempt, and a
+    circuit breaker that stops sending to a node controller that keeps failing.
+"""
+import heapq
+import logging
+import random
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def backoff(attempt, base=0.5, maximum=60):
+    """
+        Exponential backoff with jitter: a random delay between half and all of
+        base * 2^attempt, but not more than maximum.
+    """
+    delay = min(maximum, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class retry_scheduler(object):
+    """
+        Items waiting for their next attempt, ordered by the time it is due. Each item waits
+        backoff(attempt), so repeated failures of one packet space out while everything else
+        keeps flowing. At most max_pending items are kept, further ones are dropped. If delays,
+        a lib.histogram, is given, the time every item actually waited is recorded in it.
+    """
+
+    def __init__(self, base=0.5, maximum=60, max_pending=10000, delays=None):
+        self.base = base
+        self.maximum = maximum
+        self.max_pending = max_pending
+        self.delays = delays
+        # (due, sequence number, time scheduled, item), the sequence number keeps items of the
+        # same due time in order
+        self.heap = []
+        self.sequence = 0
+
+        self.scheduled = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, item, attempt=0, delay=None):
+        """
+            Returns False if the item was dropped because too many are waiting.
+        """
+        if len(self.heap) >= self.max_pending:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.error("%d packets are waiting for a retry, %d dropped so far" % (len(self.heap), self.dropped))
+            return False
+
+        if delay is None:
+            delay = backoff(attempt, self.base, self.maximum)
+        self.sequence += 1
+        now = time.monotonic()
+        heapq.heappush(self.heap, (now + delay, self.sequence, now, item))
+        self.scheduled += 1
+        return True
+
+    def time_left(self):
+        """
+            Seconds until the next item is due, None if none is waiting.
+        """
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - time.monotonic())
+
+    def pop_due(self):
+        """
+            Returns the next item that is due, None if there is none.
+        """
+        now = time.monotonic()
+        if self.heap and self.heap[0][0] <= now:
+            due, sequence, scheduled, item = heapq.heappop(self.heap)
+            if self.delays:
+                self.delays.record(now - scheduled)
+            return item
+        return None
+
+    def drain(self):
+        """
+            Removes all items and returns them, the one due first first.
+        """
+        items = [heapq.heappop(self.heap)[3] for i in range(len(self.heap))]
+        return items
+
+
+class circuit_breaker(object):
+    """
+        Counts consecutive failures of an endpoint. After failure_threshold of them the
+        breaker opens and nothing is sent for an interval that doubles, with jitter, with
+        every failed probe up to max_interval. When the interval is over the breaker is
+        half-open: one probe may be sent, its success closes the breaker.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=3, base_interval=1, max_interval=60):
+        self.failure_threshold = failure_threshold
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.open_until = 0
+
+    def allow(self):
+        """
+            True if packets may be sent now.
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() < self.open_until:
+                return False
+            self.state = self.HALF_OPEN
+        return True
+
+    def is_open(self):
+        return self.state == self.OPEN
+
+    def time_left(self):
+        """
+            Seconds until the open breaker lets a probe through, 0 if it is not open.
+        """
+        if self.state != self.OPEN:
+            return 0
+        return max(0, self.open_until - time.monotonic())
+
+    def success(self):
+        """
+            Returns True if this closed the breaker.
+        """
+        closed = self.state != self.CLOSED
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        return closed
+
+    def failure(self):
+        """
+            Returns True if this opened the breaker.
+        """
+        self.failures += 1
+        if self.state == self.OPEN:
+            return False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.open_until = time.monotonic() + backoff(self.opened, self.base_interval * 2, self.max_interval)
+            self.opened += 1
+            return True
+        return False
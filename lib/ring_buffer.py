@@ -0,0 +1,201 @@
+"""
+    Lock-free single-producer/single-consumer ring buffer in shared memory.
+
+    A plugin that is configured for the shared memory transport gets its own ring
+    instead of the common mailbox queue. The plugin writes encoded messages straight
+    into the shared memory and the router reads them from there, there is no pipe,
+    no feeder thread and no lock on the way.
+"""
+import mmap
+import multiprocessing
+import os
+import platform
+import queue
+import struct
+import time
+
+
+COUNTER = struct.Struct('Q')
+LENGTH = struct.Struct('I')
+
+# head (consumer position) and tail (producer position) live in separate cache lines
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64
+DATA_OFFSET = 128
+
+# marks the unused rest of the buffer when a record does not fit before the end
+PADDING = 0xFFFFFFFF
+
+DEFAULT_CAPACITY = 1 << 20
+
+# CPUs that make stores visible in program order, see ring_buffer
+STRONGLY_ORDERED_MACHINES = ['x86_64', 'amd64', 'i386', 'i486', 'i586', 'i686', 'x86']
+
+
+def supported():
+    """
+        True if the ring is safe on this CPU. It publishes records without a memory barrier, so
+        on weakly ordered CPUs like the ARM node boards the router could read a record before
+        its payload arrived.
+    """
+    return platform.machine().lower() in STRONGLY_ORDERED_MACHINES
+
+
+def align(size):
+    return (size + 7) & ~7
+
+
+class ring_buffer(object):
+    """
+        Records are stored as a 4 byte length followed by the payload, padded to 8 bytes.
+        head and tail are byte counters that only ever grow, the producer is the only
+        writer of tail and the consumer the only writer of head, so no lock is needed.
+        The payload of a record is written before tail is advanced, which relies on the
+        CPU making stores visible in program order (as x86 does).
+
+        The memory is an anonymous shared mapping, the ring has to be created before the
+        producer and the consumer processes are forked.
+
+        The consumer can wait on fileno(), the producer writes a byte to it whenever it
+        puts a record into a ring the consumer had emptied. Each side stores its counter and
+        then loads the other one, x86 may do such a load before the store, so both put a
+        fence in between, see fence() and idle().
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = align(capacity)
+        self.mem = mmap.mmap(-1, DATA_OFFSET + self.capacity)
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        # only taken for the fence, it protects nothing
+        self.barrier = multiprocessing.Lock()
+
+    def fileno(self):
+        return self.wakeup_read
+
+    def _load(self, offset):
+        return COUNTER.unpack_from(self.mem, offset)[0]
+
+    def _store(self, offset, value):
+        COUNTER.pack_into(self.mem, offset, value)
+
+    def empty(self):
+        return self._load(HEAD_OFFSET) == self._load(TAIL_OFFSET)
+
+    def fence(self):
+        """
+            Keeps a load from being done before an earlier store. Taking the lock is a locked
+            instruction, which is a full barrier on x86.
+        """
+        self.barrier.acquire()
+        self.barrier.release()
+
+    #### producer side ####
+
+    def put(self, data, block=True, timeout=None):
+        """
+            Queue compatible put of an encoded message, raises queue.Full if the ring has no room
+            for it in time. data can also be a list of buffers that form the message, they are
+            copied into the record one after the other.
+        """
+        if isinstance(data, (list, tuple)):
+            parts = [memoryview(part).cast('B') for part in data]
+        else:
+            parts = [memoryview(data).cast('B')]
+        size = sum(len(part) for part in parts)
+        record = align(LENGTH.size + size)
+        if record > self.capacity:
+            raise ValueError('message of %d bytes does not fit into ring of %d bytes' % (size, self.capacity))
+
+        tail = self._load(TAIL_OFFSET)
+        offset = tail % self.capacity
+        padding = 0
+        if self.capacity - offset < record:
+            padding = self.capacity - offset
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            head = self._load(HEAD_OFFSET)
+            if tail + padding + record - head <= self.capacity:
+                break
+            if not block or (deadline and time.time() > deadline):
+                raise queue.Full
+            time.sleep(0.001)
+
+        if padding:
+            LENGTH.pack_into(self.mem, DATA_OFFSET + offset, PADDING)
+            offset = 0
+
+        start = DATA_OFFSET + offset
+        LENGTH.pack_into(self.mem, start, size)
+        start += LENGTH.size
+        for part in parts:
+            self.mem[start:start + len(part)] = part
+            start += len(part)
+
+        self._store(TAIL_OFFSET, tail + padding + record)
+
+        # head is read again after publishing, if the consumer had caught up with the old tail it
+        # may have found the ring empty and gone to sleep. Either it sees the new tail in idle(),
+        # or the fences make sure that head is seen here.
+        self.fence()
+        if self._load(HEAD_OFFSET) == tail:
+            try:
+                os.write(self.wakeup_write, b'\0')
+            except BlockingIOError:
+                # the consumer has not drained the pipe yet, it is awake anyway
+                pass
+
+    def put_nowait(self, data):
+        self.put(data, False)
+
+    #### consumer side ####
+
+    def idle(self):
+        """
+            True if the ring is empty, the consumer can wait on fileno() then. It is woken up
+            by the next record.
+        """
+        self.fence()
+        return self.empty()
+
+    def clear_wakeup(self):
+        try:
+            while os.read(self.wakeup_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def get_bytes(self):
+        """
+            Returns the next record as bytes, or None if the ring is empty.
+        """
+        head = self._load(HEAD_OFFSET)
+        if head == self._load(TAIL_OFFSET):
+            return None
+
+        offset = head % self.capacity
+        size = LENGTH.unpack_from(self.mem, DATA_OFFSET + offset)[0]
+        if size == PADDING:
+            head += self.capacity - offset
+            offset = 0
+            size = LENGTH.unpack_from(self.mem, DATA_OFFSET)[0]
+
+        start = DATA_OFFSET + offset + LENGTH.size
+        data = self.mem[start:start + size]
+
+        self._store(HEAD_OFFSET, head + align(LENGTH.size + size))
+        return data
+
+    def get_batch(self, max_records):
+        batch = []
+        while len(batch) < max_records:
+            data = self.get_bytes()
+            if data is None:
+                break
+            batch.append(data)
+        return batch
@@ -1,4 +1,4 @@
-import multiprocessing, time, sys, psutil, os, signal, logging, uuid
+import multiprocessing, time, sys, psutil, os, signal, logging, uuid, queue, platform
 from multiprocessing import Manager, Queue
 
 """
@@ -8,12 +8,42 @@ from multiprocessing import Manager, Queue
 """
 
 import plugins 
+from lib.ring_buffer import ring_buffer
+import lib.ring_buffer
+from lib.plugin_mailbox import plugin_mailbox
 
 
 logger = logging.getLogger(__name__)
 
 
 
+# what the router does when the queue of a listener is full
+listener_policies = ['block', 'drop-oldest', 'drop-newest', 'sample']
+
+# system_io does the work of system_send and system_receive in one process, it cannot run together with them
+exclusive_plugins = {'system_io': ['system_send', 'system_receive'], 'system_send': ['system_io'], 'system_receive': ['system_io']}
+# plugins that replace others, startall only starts them when they are whitelisted
+opt_in_plugins = ['system_io']
+
+# priority classes of the router lanes, highest priority first, with their share of every router batch
+priority_lanes = [('control', 16), ('health', 4), ('bulk', 1)]
+
+
+def priority_classes(plugin_priorities):
+    """
+    Returns the priority classes of plugins/prioritylist.txt without the unknown ones, those
+    plugins are bulk.
+    """
+    classes = {}
+    lane_names = [x[0] for x in priority_lanes]
+    for name in plugin_priorities:
+        if not plugin_priorities[name] in lane_names:
+            logger.error('unknown priority class %s of plugin %s, using bulk' % (plugin_priorities[name], name))
+            continue
+        classes[name] = plugin_priorities[name]
+    return classes
+
+
 def check_pid(pid):        
     """ Check For the existence of a unix pid. """
     try:
@@ -26,29 +56,159 @@ def check_pid(pid):
 
 
 class plugin_runner(object):
-    def __init__(self):
+    def __init__(self, ring_buffer_plugins=[], max_log_listeners=8, system_send_maxsize=1000, plugin_priorities={}, send_settings={},
+            plugin_puids={}, incoming_maxsize=100, receive_settings={}, client_maxsize=0):
         self.jobs = []
+        self.system_send_maxsize = system_send_maxsize
+        # name -> value strings for system_send, see plugins/sendsettings.txt
+        self.send_settings = dict(send_settings)
+        # name -> value strings for system_receive, see plugins/receivesettings.txt
+        self.receive_settings = dict(receive_settings)
         self.manager = Manager()
         self.man = self.manager.dict()
         
         
         self.mailbox_outgoing = Queue()
-        self.system_send_queue = self.manager.Queue()
+        # plain queue instead of a manager proxy, the router puts already encoded bytes into it.
+        # It is bounded, so that the router can block on it while system_send falls behind.
+        self.system_send_queue = Queue(system_send_maxsize)
         self.system_receive_queue = self.manager.Queue()
+        # traffic counters of the router, updated by the router about once a second
+        self.router_stats = self.manager.dict()
+        # uplink counters of system_send
+        self.send_stats = self.manager.dict()
+        # downlink counters of system_receive
+        self.receive_stats = self.manager.dict()
         self.listeners = {} 
+        # pid -> psutil.Process, keeps the CPU times of the last info request of the plugin
+        self.processes = {}
+        
+        # Listener queues are handed to the router by name over router_control, a queue itself
+        # can only be shared by inheritance. So all of them are created before the router is forked.
+        self.router_control = Queue()
+        # the router confirms every removal with the uuid of the listener, see free_listener_queue
+        self.router_acks = Queue()
+        # uuid -> queue name of listeners whose removal the router has not confirmed yet
+        self.removing_listeners = {}
+        self.listener_queues = {'system_send': self.system_send_queue}
+        # queue name -> bound of the queue itself, 0 if it is not bounded. A client queue is only
+        # bounded for clients with policy block.
+        self.listener_queue_bounds = {'system_send': system_send_maxsize}
+        for i in range(max_log_listeners):
+            self.listener_queues['client-%d' % (i)] = Queue(client_maxsize)
+            self.listener_queue_bounds['client-%d' % (i)] = client_maxsize
+        
+        # plugins that send through their own shared memory ring instead of mailbox_outgoing.
+        # The rings have to exist before the router and the plugins are forked.
+        self.ring_buffers = {}
+        if ring_buffer_plugins and not lib.ring_buffer.supported():
+            logger.warning("Ignoring the ring buffers of %s, they are not safe on %s, the plugins use the mailbox queue" % (", ".join(ring_buffer_plugins), platform.machine()))
+            ring_buffer_plugins = []
+        for name in ring_buffer_plugins:
+            self.ring_buffers[name] = ring_buffer()
+        
+        # Messages from the node controller are routed by their r_puid. Every plugin with a puid
+        # gets its own bounded incoming queue, created before system_receive and the plugin are forked.
+        # puid -> {'plugin': plugin name, 'queue': incoming queue of the plugin}
+        self.incoming_routes = {}
+        self.incoming_queues = {}
+        for puid in plugin_puids:
+            name = plugin_puids[puid]
+            if not name in self.incoming_queues:
+                self.incoming_queues[name] = Queue(incoming_maxsize)
+            self.incoming_routes[puid] = {'plugin': name, 'queue': self.incoming_queues[name]}
+        
+        # plugin name -> priority class, plugins not listed are bulk
+        self.plugin_priorities = priority_classes(plugin_priorities)
+        
+        # Every priority class has its own mailbox, so health reports do not queue up behind a
+        # flood of sensor data. The bulk lane is mailbox_outgoing.
+        self.lanes = []
+        for lane_name, weight in priority_lanes:
+            if lane_name == 'bulk':
+                mailbox = self.mailbox_outgoing
+            else:
+                mailbox = Queue()
+            rings = [self.ring_buffers[x] for x in sorted(self.ring_buffers) if self.plugin_priority(x) == lane_name]
+            self.lanes.append({'name': lane_name, 'weight': weight, 'mailbox': mailbox, 'rings': rings})
+        
+        # The control and health messages for system_send get listener queues of their own, so
+        # that they pass the bulk data waiting in the system_send queue and are not coalesced.
+        # lane name -> listener queue name
+        self.system_send_lanes = {}
+        for lane_name, weight in priority_lanes:
+            if lane_name != 'bulk':
+                self.system_send_lanes[lane_name] = 'system_send-%s' % (lane_name)
+                self.listener_queues[self.system_send_lanes[lane_name]] = Queue()
     
+    def plugin_priority(self, plugin_name):
+        return self.plugin_priorities.get(plugin_name, 'bulk')
+    
+    def system_send_priority_queues(self):
+        """
+        Returns the queues of the control and health messages for system_send, highest priority first.
+        """
+        return [self.listener_queues[self.system_send_lanes[x[0]]] for x in priority_lanes if x[0] in self.system_send_lanes]
+    
+    def lane_mailbox(self, plugin_name):
+        for lane in self.lanes:
+            if lane['name'] == self.plugin_priority(plugin_name):
+                return lane['mailbox']
     
-    #def listener_consolidate(self, name):
-    #    if not name in self.listeners:
-    #        return
-    #        
-    #    pid = self.listeners[name]['pid']
-    #    
-    #    if not pid:
-    #        return
-    #        
-    #    if not check_pid(pid):
-    #        del self.listeners[name]    
+    
+    def listener_consolidate(self):
+        """
+        Removes listeners whose process is gone, so that their queues can be used again.
+        """
+        # reap finished children first, a zombie still passes check_pid
+        multiprocessing.active_children()
+        for listener_uuid in list(self.listeners):
+            pid = self.listeners[listener_uuid]['pid']
+            if not check_pid(pid):
+                self.remove_listener(listener_uuid)
+    
+    def read_router_acks(self):
+        """
+        Forgets the removed listeners the router has confirmed, it does not deliver to their
+        queues anymore.
+        """
+        router = self.get_plugin_by_name('system_router')
+        if not router or not router.is_alive():
+            # nothing delivers to the queues
+            self.removing_listeners = {}
+        
+        while True:
+            try:
+                listener_uuid = self.router_acks.get_nowait()
+            except queue.Empty:
+                break
+            self.removing_listeners.pop(listener_uuid, None)
+    
+    def free_listener_queue(self):
+        """
+        Returns the name of a log client queue that is not in use, or None. The queue of a
+        removed listener is only used again once the router has confirmed the removal, until
+        then the router may still put messages for the old listener into it.
+        """
+        self.listener_consolidate()
+        self.read_router_acks()
+        
+        used = set([self.listeners[x]['queue_name'] for x in self.listeners])
+        used.update(self.removing_listeners.values())
+        for queue_name in sorted(self.listener_queues):
+            if queue_name == 'system_send' or queue_name in self.system_send_lanes.values() or queue_name in used:
+                continue
+            
+            # Drop what is left over from the previous listener. qsize() counts the messages the
+            # router has put, also those its feeder thread has not written to the pipe yet.
+            listener_queue = self.listener_queues[queue_name]
+            while listener_queue.qsize():
+                try:
+                    listener_queue.get(timeout=1)
+                except queue.Empty:
+                    break
+            return queue_name
+        return None
     
     #def listener_exists(self, name):
     #    #self.listener_consolidate(name)
@@ -76,24 +236,84 @@ class plugin_runner(object):
         
     #     return [1, listener_uuid]
         
-    def add_listener(self, name, queue, pid):
-        #self.listener_consolidate(name)
+    def add_listener(self, name, queue_name, pid, filters=[], maxsize=0, policy='block', lane_queues={}):
+        """
+        Registers one of the listener queues with the running router. The queue gets the messages
+        of all plugins, or only those matching one of the (plugin, sensor) filters. A filter with
+        sensor None matches every sensor of the plugin.
         
+        maxsize bounds the queue (0: unbounded), policy says what the router does when it is full:
+        block, drop-oldest, drop-newest or sample. The router blocks on the queue itself, so a
+        listener with policy block has to use the bound the queue was created with.
+        
+        lane_queues maps priority classes to listener queues that get the messages of that class
+        instead, they are not bounded.
+        """
         listener_uuid = str(uuid.uuid4())
         
         if listener_uuid in self.listeners:
             return [0, 'listener with that uuid already exists']
             
+        if not queue_name in self.listener_queues:
+            return [0, 'listener queue %s does not exist' % (queue_name)]
+            
         if not pid:
             return [0, 'pid is not defined']
             
         if not type(pid) is int:
             return [0, 'pid is not int']
+            
+        if not policy in listener_policies:
+            return [0, 'unknown policy %s, use one of %s' % (policy, ', '.join(listener_policies))]
+            
+        if not type(maxsize) is int or maxsize < 0:
+            return [0, 'maxsize has to be an int >= 0 (0: unbounded)']
+        
+        queue_bound = self.listener_queue_bounds.get(queue_name, 0)
+        if policy == 'block' and maxsize != queue_bound:
+            return [0, 'policy block needs maxsize %d, the bound of queue %s' % (queue_bound, queue_name)]
         
+        for lane_name in lane_queues:
+            if not lane_queues[lane_name] in self.listener_queues:
+                return [0, 'listener queue %s does not exist' % (lane_queues[lane_name])]
+        
+        # a restarted system_send takes over the queue of its predecessor
+        for old_uuid in list(self.listeners):
+            if self.listeners[old_uuid]['queue_name'] == queue_name:
+                self.remove_listener(old_uuid)
             
-        self.listeners[listener_uuid] = {'name': name, 'queue': queue, 'pid': pid} 
+        listener = {'name': name, 'queue_name': queue_name, 'pid': pid, 'filters': list(filters), 'maxsize': maxsize, 'policy': policy,
+            'lane_queue_names': dict(lane_queues)}
+        self.listeners[listener_uuid] = listener
+        self.router_control.put(('add', listener_uuid, listener))
         
         return [1, listener_uuid]
+    
+    def remove_listener(self, listener_uuid):
+        if not listener_uuid in self.listeners:
+            return [0, 'listener %s not found' % (listener_uuid)]
+        
+        listener = self.listeners.pop(listener_uuid)
+        self.removing_listeners[listener_uuid] = listener['queue_name']
+        self.router_control.put(('remove', listener_uuid))
+        
+        return [1, 'listener %s removed' % (listener_uuid)]
+
+    def get_stats(self):
+        """
+        Returns the last traffic counters published by the router, those of system_send under 'uplink'
+        and those of system_receive under 'downlink'.
+        """
+        if not self.get_plugin_by_name('system_router'):
+            return [0, 'system_router is not running']
+        
+        stats = self.router_stats.copy()
+        if not stats:
+            return [0, 'system_router has not published any stats yet']
+        
+        stats['uplink'] = self.send_stats.copy()
+        stats['downlink'] = self.receive_stats.copy()
+        return [1, stats]
 
     #Lists all available plugins and their status
     def list_plugins(self):
@@ -116,6 +336,10 @@ class plugin_runner(object):
             j = self.get_plugin_by_name(plugin_name)
             if j:
                 return [0, 'Plugin %s is already active.' % (plugin_name) ]
+            
+            for other in exclusive_plugins.get(plugin_name, []):
+                if self.get_plugin_by_name(other):
+                    return [0, 'Plugin %s cannot run together with %s.' % (plugin_name, other) ]
 
             #checks for register attribute in plugin
             plugin = getattr(plugins, plugin_name)
@@ -129,25 +353,42 @@ class plugin_runner(object):
             #Starts plugin as a process named the same as plugin name
             #sys.stdout = open('/dev/null', 'w')
             if plugin_name == 'system_router':
-                j = multiprocessing.Process(name=plugin_name, target=register_plugin, args=(plugin_name,self.man, self.mailbox_outgoing, self.listeners ))
+                j = multiprocessing.Process(name=plugin_name, target=register_plugin, args=(plugin_name,self.man, self.lanes, self.listeners, self.listener_queues, self.router_control, self.router_stats,
+                    self.router_acks))
                 self.jobs.append(j)
                 j.start()
                 
             elif  plugin_name == 'system_send':
                 
                 try:
-                    j = multiprocessing.Process(name=plugin_name, target=register_plugin, args=(plugin_name,self.man, self.system_send_queue))
+                    j = multiprocessing.Process(name=plugin_name, target=register_plugin, args=(plugin_name,self.man, self.system_send_queue, self.send_stats, self.send_settings,
+                        self.system_send_priority_queues()))
                 except Exception as e:
                     logger.error("Starting process failed: %s" % (str(e)))
                 
                 self.jobs.append(j)
                 j.start()
                 
-                self.add_listener('system_send', self.system_send_queue, int(j.pid))
+                # uplink data is never dropped, a full queue makes the router wait for system_send
+                self.add_listener('system_send', 'system_send', int(j.pid), maxsize=self.system_send_maxsize, policy='block', lane_queues=self.system_send_lanes)
                 
+            elif plugin_name == 'system_io':
+                j = multiprocessing.Process(name=plugin_name, target=register_plugin, args=(plugin_name,self.man, self.system_send_queue, self.incoming_routes,
+                    self.send_stats, self.receive_stats, self.send_settings, self.receive_settings, self.system_send_priority_queues()))
+                self.jobs.append(j)
+                j.start()
+                
+                self.add_listener('system_io', 'system_send', int(j.pid), maxsize=self.system_send_maxsize, policy='block', lane_queues=self.system_send_lanes)
+                
+            elif plugin_name == 'system_receive':
+                j = multiprocessing.Process(name=plugin_name, target=register_plugin, args=(plugin_name,self.man, self.incoming_routes, self.receive_stats, self.receive_settings))
+                self.jobs.append(j)
+                j.start()
                 
             else:
-                j = multiprocessing.Process(name=plugin_name, target=register_plugin, args=(plugin_name,self.man, self.mailbox_outgoing))
+                transport = self.ring_buffers.get(plugin_name, self.lane_mailbox(plugin_name))
+                mailbox = plugin_mailbox(plugin_name, transport, self.incoming_queues.get(plugin_name))
+                j = multiprocessing.Process(name=plugin_name, target=register_plugin, args=(plugin_name,self.man, mailbox))
                 self.jobs.append(j)
                 j.start()
             # if plugin_name == 'system_router':
@@ -419,10 +660,40 @@ class plugin_runner(object):
             return [0 , '']
        
            
-        p = psutil.Process(pid)
-        message = "Memory Percent: %s\tCPU Percent: %s\tPID: %s"  % (str(p.memory_percent()), str(p.cpu_percent(interval=1.0)), str(pid) )
+        message = "Memory Percent: %s\tCPU Percent: %s\tPID: %s"  % (str(self.memory_percent(pid)), str(self.cpu_percent(pid)), str(pid) )
         logger.debug(message)
         return [1, message]
+    
+    def process(self, pid):
+        p = self.processes.get(pid)
+        if not p or not p.is_running():
+            # forget processes that are gone
+            for old_pid in list(self.processes):
+                if not self.processes[old_pid].is_running():
+                    del self.processes[old_pid]
+            p = psutil.Process(pid)
+            self.processes[pid] = p
+        return p
+    
+    def memory_percent(self, pid):
+        return self.process(pid).memory_percent()
+    
+    def cpu_percent(self, pid):
+        """
+        CPU usage of a process since the last call for it, without waiting. The first call
+        returns the average over the lifetime of the process.
+        """
+        known = pid in self.processes and self.processes[pid].is_running()
+        p = self.process(pid)
+        if known:
+            return p.cpu_percent(interval=None)
+        # starts the measurement for the next call
+        p.cpu_percent(interval=None)
+        times = p.cpu_times()
+        elapsed = time.time() - p.create_time()
+        if elapsed <= 0:
+            return 0.0
+        return round(100.0 * (times.user + times.system) / elapsed, 1)
         
 
     #Calls plugin_info on all active plugins.
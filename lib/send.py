@@ -1,4 +1,5 @@
 import time, socket, sys, logging
+from .config import read_config
 
 
 logger = logging.getLogger(__name__)
@@ -6,8 +7,7 @@ logger = logging.getLogger(__name__)
 
 
 #gets the IP address for the nodecontroller
-with open('/etc/waggle/node_controller_host','r') as file_:
-    NC_HOST = file_.read().strip() 
+NC_HOST = read_config('node_controller_host')
 
 NC_PORT = 9090 #port for push_server
     
@@ -0,0 +1,259 @@
+"""
+    Append-only store-and-forward spool on local disk.
+
+    Packets are appended to segment files, a new segment is started once the current one
+    holds segment_bytes. Positions are byte offsets over all segments, a segment file is
+    named after the position of its first record. A record is its length and crc32
+    (4 bytes each) followed by the packet.
+
+    The position of the next packet to deliver is committed in memory after every packet
+    and written to the offset file by sync(), which replaces the file atomically. After a
+    crash the packets since the last sync are sent again, none are lost. A record that was
+    only partially written is cut off when the spool is opened again, and every record is
+    checked against its crc when it is read. The directory is synced whenever a file is
+    created, replaced or removed, so that no segment goes missing in a crash. Segments
+    that are fully delivered are deleted, and when the spool grows beyond max_bytes its
+    oldest segments are dropped, so an outage of any length only costs bounded disk space.
+"""
+import logging
+import os
+import struct
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct('!II')
+SEGMENT_SUFFIX = '.seg'
+
+
+class spool(object):
+
+    def __init__(self, directory, segment_bytes=4 << 20, max_bytes=256 << 20):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.offset_file = os.path.join(directory, 'offset')
+
+        self.appended = 0
+        self.delivered = 0
+        self.dropped_bytes = 0
+        self.dropped_segments = 0
+        self.corrupt_bytes = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # start positions of the segments, oldest first
+        self.segments = sorted([int(x[:-len(SEGMENT_SUFFIX)]) for x in os.listdir(directory) if x.endswith(SEGMENT_SUFFIX)])
+
+        committed = 0
+        if os.path.isfile(self.offset_file):
+            with open(self.offset_file, 'r') as f:
+                committed = int(f.read().strip() or 0)
+
+        if not self.segments:
+            self.segments.append(committed)
+            open(self.segment_path(committed), 'wb').close()
+            self.sync_directory()
+
+        self.write_position = self.recover(self.segments[-1])
+        self.writer = open(self.segment_path(self.segments[-1]), 'ab')
+
+        self.committed = min(max(committed, self.segments[0]), self.write_position)
+        self.read_position = self.committed
+        self.reader = None
+        self.reader_segment = None
+        self.remove_delivered()
+
+        if not self.empty():
+            logger.info("spool %s holds %d bytes that were not sent yet" % (directory, self.pending_bytes()))
+
+    def segment_path(self, start):
+        return os.path.join(self.directory, '%020d%s' % (start, SEGMENT_SUFFIX))
+
+    def sync_directory(self):
+        """
+        Makes the creation, replacement and removal of files in the spool directory durable.
+        """
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def recover(self, start):
+        """
+        Returns the end position of the last segment, after cutting off a record that was not
+        completely written.
+        """
+        path = self.segment_path(start)
+        valid = 0
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                length, crc = RECORD.unpack(header)
+                data = f.read(length)
+                if len(data) < length or zlib.crc32(data) != crc:
+                    break
+                valid += RECORD.size + length
+
+        if valid != os.path.getsize(path):
+            logger.warning("cutting off incomplete record at the end of %s" % (path))
+            with open(path, 'r+b') as f:
+                f.truncate(valid)
+        return start + valid
+
+    def segment_end(self, start):
+        i = self.segments.index(start)
+        if i + 1 < len(self.segments):
+            return self.segments[i + 1]
+        return self.write_position
+
+    def segment_of(self, position):
+        for start in reversed(self.segments):
+            if start <= position:
+                return start
+        return self.segments[0]
+
+    def empty(self):
+        return self.read_position >= self.write_position
+
+    def pending_bytes(self):
+        return self.write_position - self.committed
+
+    def append(self, data):
+        if self.write_position - self.segments[-1] >= self.segment_bytes:
+            self.rotate()
+
+        self.writer.write(RECORD.pack(len(data), zlib.crc32(data)))
+        self.writer.write(data)
+        # flushed to the OS, so the reader sees it, sync() makes it durable
+        self.writer.flush()
+        self.write_position += RECORD.size + len(data)
+        self.appended += 1
+
+        while self.write_position - self.segments[0] > self.max_bytes and len(self.segments) > 1:
+            self.drop_oldest()
+
+    def rotate(self):
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.writer.close()
+        self.segments.append(self.write_position)
+        self.writer = open(self.segment_path(self.write_position), 'ab')
+        self.sync_directory()
+
+    def drop_oldest(self):
+        start = self.segments.pop(0)
+        end = self.segments[0]
+        if self.committed < end:
+            self.dropped_bytes += end - self.committed
+            self.dropped_segments += 1
+            if self.dropped_segments == 1 or self.dropped_segments % 100 == 0:
+                logger.error("spool is full, %d bytes that were not sent are dropped so far" % (self.dropped_bytes))
+            self.committed = end
+        if self.read_position < end:
+            self.read_position = end
+        self.close_reader()
+        os.remove(self.segment_path(start))
+        self.sync_directory()
+
+    def close_reader(self):
+        if self.reader:
+            self.reader.close()
+        self.reader = None
+        self.reader_segment = None
+
+    def read(self):
+        """
+        Returns (position after the packet, packet) of the next packet that was not read yet,
+        None if there is none. The packet counts as delivered once its position is committed.
+        A record that does not match its crc ends its segment, the rest of the segment is
+        skipped, since its length cannot be trusted either.
+        """
+        while not self.empty():
+            segment = self.segment_of(self.read_position)
+            segment_end = self.segment_end(segment)
+            if self.read_position >= segment_end:
+                # the rest of this segment was read, continue with the next one
+                segment = self.segments[self.segments.index(segment) + 1]
+                self.read_position = segment
+                segment_end = self.segment_end(segment)
+
+            if self.reader_segment != segment:
+                self.close_reader()
+                self.reader = open(self.segment_path(segment), 'rb')
+                self.reader_segment = segment
+
+            self.reader.seek(self.read_position - segment)
+            header = self.reader.read(RECORD.size)
+            if len(header) == RECORD.size:
+                length, crc = RECORD.unpack(header)
+                end = self.read_position + RECORD.size + length
+                if end <= segment_end:
+                    data = self.reader.read(length)
+                    if len(data) == length and zlib.crc32(data) == crc:
+                        self.read_position = end
+                        return (self.read_position, data)
+
+            logger.error("corrupt record at %d in %s, skipping the %d bytes to the end of the segment" % (
+                self.read_position, self.segment_path(segment), segment_end - self.read_position))
+            self.corrupt_bytes += segment_end - self.read_position
+            self.read_position = segment_end
+        return None
+
+    def rewind(self):
+        """
+        Makes the packets that were read but not committed available for reading again.
+        """
+        self.read_position = self.committed
+
+    def commit(self, position):
+        """
+        Marks the packets up to position as delivered. Positions the spool has already moved
+        past, e.g. of packets dropped by drop_oldest() while they were in flight, are ignored.
+        """
+        self.delivered += 1
+        if position <= self.committed:
+            return
+        self.committed = position
+        if self.committed >= self.segment_end(self.segments[0]) and len(self.segments) > 1:
+            self.remove_delivered()
+
+    def remove_delivered(self):
+        removed = False
+        while len(self.segments) > 1 and self.segments[1] <= self.committed:
+            start = self.segments.pop(0)
+            if self.reader_segment == start:
+                self.close_reader()
+            os.remove(self.segment_path(start))
+            removed = True
+        if removed:
+            self.sync_directory()
+
+    def sync(self):
+        """
+        Makes the appended packets and the committed position durable.
+        """
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+
+        tmp_file = self.offset_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write('%d\n' % (self.committed))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.offset_file)
+        self.sync_directory()
+
+    def get_stats(self):
+        return {'pending bytes': self.pending_bytes(), 'segments': len(self.segments), 'spooled': self.appended,
+            'replayed': self.delivered, 'dropped bytes': self.dropped_bytes, 'corrupt bytes': self.corrupt_bytes}
+
+    def close(self):
+        self.sync()
+        self.writer.close()
+        self.close_reader()
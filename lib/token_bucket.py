@@ -0,0 +1,159 @@
+"""
+    Token buckets for shaping the uplink traffic of the plugins.
+"""
+import collections
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class token_bucket(object):
+    """
+        Holds up to burst tokens (bytes) and gains rate tokens per second. A message larger
+        than burst passes once the bucket is full and leaves it in debt, so it is delayed but
+        never stuck.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, size):
+        """
+            Takes size tokens if they are there, returns False otherwise.
+        """
+        self.refill()
+        if self.tokens >= min(size, self.burst):
+            self.tokens -= size
+            return True
+        return False
+
+    def time_until(self, size):
+        """
+            Seconds until size tokens can be taken.
+        """
+        self.refill()
+        missing = min(size, self.burst) - self.tokens
+        if missing <= 0:
+            return 0
+        return missing / self.rate
+
+    def level(self):
+        self.refill()
+        return self.tokens
+
+
+class shaper(object):
+    """
+        Limits the uplink bandwidth of single plugins with a token bucket each. Messages of a
+        plugin over its budget are either deferred until the bucket has refilled (at most
+        max_deferred of them, the oldest are dropped beyond that) or dropped, so that the plugin
+        is downsampled to its budget.
+
+        Limits are settings of the form limit.<plugin>=<bytes per second>:<burst bytes>[:defer|drop].
+    """
+
+    def __init__(self, settings, max_deferred=1000):
+        self.max_deferred = max_deferred
+        # plugin -> token_bucket, policy
+        self.buckets = {}
+        self.policies = {}
+        # plugin -> encoded messages waiting for tokens, oldest first
+        self.deferred = {}
+        # plugin -> [bytes passed, messages deferred, messages dropped]
+        self.counters = {}
+
+        for name in settings:
+            if not name.startswith('limit.'):
+                continue
+            plugin = name[len('limit.'):]
+            try:
+                fields = settings[name].split(':')
+                rate, burst = int(fields[0]), int(fields[1])
+                policy = 'defer'
+                if len(fields) > 2:
+                    policy = fields[2]
+                if not policy in ['defer', 'drop'] or rate <= 0 or burst <= 0:
+                    raise ValueError(policy)
+            except (ValueError, IndexError) as e:
+                logger.error("invalid uplink limit %s=%s" % (name, settings[name]))
+                continue
+            self.buckets[plugin] = token_bucket(rate, burst)
+            self.policies[plugin] = policy
+            self.deferred[plugin] = collections.deque()
+            self.counters[plugin] = [0, 0, 0]
+
+    def admit(self, source, encoded):
+        """
+            Returns the messages that may be sent now: the given one if its plugin is within its
+            budget or not limited at all, none otherwise.
+        """
+        bucket = self.buckets.get(source)
+        if not bucket:
+            return [encoded]
+
+        counters = self.counters[source]
+        deferred = self.deferred[source]
+        # deferred messages go first, a new one must not overtake them
+        if not deferred and bucket.consume(len(encoded)):
+            counters[0] += len(encoded)
+            return [encoded]
+
+        if self.policies[source] == 'drop':
+            counters[2] += 1
+            return []
+
+        if len(deferred) >= self.max_deferred:
+            deferred.popleft()
+            counters[2] += 1
+        deferred.append(encoded)
+        counters[1] += 1
+        return []
+
+    def release(self):
+        """
+            Returns the deferred messages whose plugins have regained enough tokens.
+        """
+        released = []
+        for source in self.deferred:
+            deferred = self.deferred[source]
+            bucket = self.buckets[source]
+            while deferred and bucket.consume(len(deferred[0])):
+                self.counters[source][0] += len(deferred[0])
+                released.append(deferred.popleft())
+        return released
+
+    def time_left(self):
+        """
+            Seconds until the next deferred message can be released, None if none is waiting.
+        """
+        time_left = None
+        for source in self.deferred:
+            deferred = self.deferred[source]
+            if not deferred:
+                continue
+            wait = self.buckets[source].time_until(len(deferred[0]))
+            if time_left is None or wait < time_left:
+                time_left = wait
+        return time_left
+
+    def get_stats(self):
+        stats = {}
+        for source in sorted(self.buckets):
+            bucket = self.buckets[source]
+            passed, deferred, dropped = self.counters[source]
+            stats['%s tokens' % (source)] = '%d/%d' % (bucket.level(), bucket.burst)
+            stats['%s bytes passed' % (source)] = passed
+            stats['%s deferred' % (source)] = deferred
+            stats['%s waiting' % (source)] = len(self.deferred[source])
+            stats['%s dropped' % (source)] = dropped
+        return stats
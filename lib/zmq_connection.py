@@ -0,0 +1,204 @@
+"""
+    Long-lived ZMQ connections to the node controller.
+
+    One context per process and one socket per endpoint are kept open across packets, so
+    sending a packet does not cost a TCP handshake and a new set of context threads. The
+    node controller answers every packet.
+
+    zmq_connection waits for the reply before the next packet is sent. zmq_pipeline keeps a
+    window of packets in flight on a DEALER socket, so on a slow link a packet is sent every
+    RTT / window instead of every RTT.
+"""
+import collections
+import logging
+import struct
+import time
+import zmq
+
+
+logger = logging.getLogger(__name__)
+
+
+class zmq_connection(object):
+    """
+        A REQ socket connected to one endpoint. A REQ socket cannot send again before it got
+        the reply to its last request, so when the reply does not arrive within reply_timeout
+        the socket is dropped and a new one is connected for the next request. ZMQ itself
+        reconnects the socket when the node controller goes away and comes back.
+    """
+
+    def __init__(self, host, port, reply_timeout=10, context=None):
+        self.host = host
+        self.port = port
+        self.endpoint = 'tcp://%s:%d' % (host, port)
+        self.reply_timeout = reply_timeout
+        self.context = context or zmq.Context.instance()
+        self.socket = None
+
+    def connect(self):
+        self.socket = self.context.socket(zmq.REQ)
+        # unsent packets of a dropped socket are sent again by the caller
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.SNDTIMEO, int(self.reply_timeout * 1000))
+        self.socket.setsockopt(zmq.RCVTIMEO, int(self.reply_timeout * 1000))
+        self.socket.connect(self.endpoint)
+        logger.debug("Connected to %s" % (self.endpoint))
+
+    def reset(self):
+        if self.socket:
+            self.socket.close()
+        self.socket = None
+
+    def request(self, msg):
+        """
+            Sends one packet and returns the reply of the node controller. Raises
+            zmq.error.ZMQError (zmq.error.Again on timeout), the connection is usable again
+            afterwards.
+        """
+        if not self.socket:
+            self.connect()
+
+        try:
+            self.socket.send(msg)
+            return self.socket.recv()
+        except zmq.error.ZMQError:
+            self.reset()
+            raise
+
+    def close(self):
+        self.reset()
+
+
+class zmq_pipeline(object):
+    """
+        A DEALER socket that keeps up to window packets in flight. Every packet is sent as
+        [request id, empty delimiter, packet]; the REP socket of the node controller returns
+        everything in front of the delimiter with its reply, so replies are matched to their
+        packets by id. A packet whose reply does not arrive within reply_timeout has failed.
+        When the node controller is given up on, reset() replaces the socket so that packets
+        still queued in it are not sent late.
+
+        If histograms is given, the time spent in send() is recorded in its 'send' histogram,
+        or in 'connect' for the first packet on a new socket, which waits for the connection.
+        The time until a packet is acknowledged is recorded in 'acknowledgement'.
+    """
+
+    def __init__(self, host, port, window=16, reply_timeout=10, context=None, histograms=None):
+        self.host = host
+        self.port = port
+        self.endpoint = 'tcp://%s:%d' % (host, port)
+        self.window = window
+        self.reply_timeout = reply_timeout
+        self.context = context or zmq.Context.instance()
+        self.socket = None
+        self.next_id = 0
+        # request id -> (deadline, token), oldest first
+        self.in_flight = collections.OrderedDict()
+        # deadline of the last packet that was acknowledged, tells whether the link still worked
+        # after a packet was sent
+        self.last_acknowledged = 0
+        self.histograms = histograms
+
+    def connect(self):
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        # packets are not queued for a node controller that is not connected, sending times out instead
+        self.socket.setsockopt(zmq.IMMEDIATE, 1)
+        self.socket.setsockopt(zmq.SNDTIMEO, int(self.reply_timeout * 1000))
+        self.socket.connect(self.endpoint)
+        logger.debug("Connected to %s" % (self.endpoint))
+
+    def reset(self):
+        """
+            Drops the socket and returns the tokens of the packets that were in flight.
+        """
+        if self.socket:
+            self.socket.close()
+        self.socket = None
+        failed = [x[1] for x in self.in_flight.values()]
+        self.in_flight.clear()
+        return failed
+
+    def has_room(self):
+        return len(self.in_flight) < self.window
+
+    def send(self, packet, token=None):
+        """
+            Sends a packet without waiting for its reply, token is handed back by receive()
+            once the packet is acknowledged. Raises zmq.error.Again when the node controller
+            is not connected within reply_timeout.
+        """
+        start = time.monotonic()
+        stage = 'send'
+        if not self.socket:
+            self.connect()
+            stage = 'connect'
+
+        self.next_id += 1
+        request_id = struct.pack('!Q', self.next_id)
+        self.socket.send_multipart([request_id, b'', packet])
+        now = time.monotonic()
+        self.in_flight[request_id] = (now + self.reply_timeout, token)
+        if self.histograms:
+            self.histograms[stage].record(now - start)
+
+    def receive(self):
+        """
+            Reads the replies that arrived, returns the tokens of the acknowledged packets.
+        """
+        acknowledged = []
+        while self.socket:
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                break
+            entry = self.in_flight.pop(frames[0], None)
+            if entry:
+                self.last_acknowledged = max(self.last_acknowledged, entry[0])
+                acknowledged.append(entry[1])
+                if self.histograms:
+                    self.histograms['acknowledgement'].record(time.monotonic() - entry[0] + self.reply_timeout)
+        return acknowledged
+
+    def time_left(self):
+        """
+            Seconds until the oldest packet in flight times out, None if none is in flight.
+        """
+        for request_id in self.in_flight:
+            return max(0, self.in_flight[request_id][0] - time.monotonic())
+        return None
+
+    def expire(self):
+        """
+            Takes the packets whose reply is overdue off the window. Returns a list of
+            (token, True if a packet sent after it was acknowledged). A reply that still arrives
+            for one of them is ignored.
+        """
+        now = time.monotonic()
+        expired = []
+        while self.in_flight:
+            request_id = next(iter(self.in_flight))
+            deadline, token = self.in_flight[request_id]
+            if deadline > now:
+                break
+            del self.in_flight[request_id]
+            expired.append((token, self.last_acknowledged > deadline))
+        return expired
+
+    def request(self, packet):
+        """
+            Sends one packet and waits for its reply, like zmq_connection.request().
+        """
+        self.send(packet, packet)
+        deadline = time.monotonic() + self.reply_timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0 or not self.socket.poll(int(left * 1000)):
+                self.reset()
+                raise zmq.error.Again()
+            for token in self.receive():
+                if token is packet:
+                    return
+
+    def close(self):
+        self.reset()
@@ -7,13 +7,17 @@ import os
 import socket
 import json
 import argparse
-import select
+import asyncio
+import concurrent.futures
 import datetime
 import logging
 import logging.handlers
 from multiprocessing import Queue
 import plugins
+import lib.config
 import lib.run_plugins_multi
+import lib.histogram
+from lib import message_codec
 from waggle.protocol.utils.pidfile import PidFile, AlreadyRunning
 
 
@@ -37,37 +41,70 @@ logger.handlers = []
 
 class PluginManagerAPI:
     def __init__(self):
-        self.plug = lib.run_plugins_multi.plugin_runner()
-        self.system_plugins={'system_receive': 1, 'system_send': 1 ,'system_router': 1 }
+        self.ring_buffer_plugins = self.get_list('plugins/ringbufferlist.txt')
+        self.plugin_priorities = self.get_priorities('plugins/prioritylist.txt')
+        self.send_settings = self.get_settings('plugins/sendsettings.txt')
+        self.receive_settings = self.get_settings('plugins/receivesettings.txt')
+        self.plugin_puids = self.get_puids('plugins/puidlist.txt')
+        self.plug = lib.run_plugins_multi.plugin_runner(ring_buffer_plugins=self.ring_buffer_plugins, plugin_priorities=self.plugin_priorities, send_settings=self.send_settings,
+            plugin_puids=self.plugin_puids, receive_settings=self.receive_settings)
+        self.system_plugins={'system_receive': 1, 'system_send': 1 ,'system_router': 1, 'system_io': 1 }
+
+        # Commands that start or stop processes run one after the other. Those that wait for
+        # processes, e.g. stop for up to 10 seconds, run in this thread, so that the control
+        # socket keeps answering other clients meanwhile. Those that fork run on the loop thread
+        # while this thread is idle, see run_command().
+        self.lifecycle = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # held while a lifecycle command runs, created with the event loop
+        self.lifecycle_lock = None
+        # seconds a client has to send its command
+        self.client_timeout = 10
+
+        # a slow log client only loses its own messages, it never holds up the router
+        self.log_maxsize = 100
+        self.log_policy = 'drop-oldest'
 
         self.command_functions = {
             "list" : {  'function' : self.command_list_plugins_full,
                         'description' : 'list plugins'
             },
             "log" : {   'function' : None,
-                        'description' : 'get message stream'
+                        'arguments' : '[maxsize=<n>] [policy=<policy>] [<plugin>[:<sensor>] ...]',
+                        'description' : 'get message stream, optionally only of some plugins or sensors'
+            },
+            "stats" : { 'function' : self.command_stats,
+                        'description' : 'messages and bytes per plugin, queue depth of every listener, uplink and downlink counters'
+            },
+            "latency" : { 'function' : self.command_latency,
+                        'description' : 'latency of the stages of the uplink send path'
             },
             "help" : {  'function' : self.command_help,
                         'description' : ''
             },
             "start" : { 'function' : self.command_start_plugin,
+                        'lifecycle' : True,
+                        'forks' : True,
                         'arguments' : '<plugin>',
                         'description' : 'start plugin'
             },
             "stop" : {  'function' : self.command_stop_plugin,
+                        'lifecycle' : True,
                         'arguments' : '<plugin>',
                         'description' : 'stop plugin'
             },
             "kill" : {  'function' : self.command_kill_plugin,
+                        'lifecycle' : True,
                         'arguments' : '<plugin>',
                         'description' : 'kill plugin'
             },
             "pause" : { 'function' : self.command_pause_plugin,
+                        'lifecycle' : True,
                         'arguments' : '<plugin>',
                         'description' : 'pause plugin'
             },
             "unpause" : {
                         'function' : self.command_unpause_plugin,
+                        'lifecycle' : True,
                         'arguments' : '<plugin>',
                         'description' : 'unpause plugin'
             },
@@ -81,12 +118,16 @@ class PluginManagerAPI:
                         'description' : 'get info about plugin'
             },
             "startall" : {  'function' : self.command_start_all,
+                        'lifecycle' : True,
+                        'forks' : True,
                         'description' : 'start all plugins'
             },
             "stopall" : {  'function' : self.command_stop_all,
+                        'lifecycle' : True,
                         'description' : 'stop all plugins'
             },
             "killall" : {  'function' : self.command_kill_all,
+                        'lifecycle' : True,
                         'description' : 'kill all plugins'
             }
 
@@ -141,6 +182,52 @@ class PluginManagerAPI:
         mylist = [x for x in mylist if not x.startswith("#")]
         return mylist
 
+    def get_priorities(self, filename):
+        """
+        Reads the priority class of plugins from lines of the form <plugin>:<class>.
+        """
+        priorities = {}
+        for line in self.get_list(filename):
+            try:
+                name, priority = line.split(':')
+            except ValueError:
+                logger.error('invalid line in %s: %s' % (filename, line))
+                continue
+            priorities[name.strip()] = priority.strip()
+        return priorities
+
+    def get_settings(self, filename):
+        """
+        Reads lines of the form <name>=<value>, the values are left as strings.
+        """
+        settings = {}
+        for line in self.get_list(filename):
+            try:
+                name, value = line.split('=', 1)
+            except ValueError:
+                logger.error('invalid line in %s: %s' % (filename, line))
+                continue
+            settings[name.strip()] = value.strip()
+        return settings
+
+    def get_puids(self, filename):
+        """
+        Reads the puid of plugins from lines of the form <puid>:<plugin>, a puid is 8 hex digits.
+        """
+        puids = {}
+        for line in self.get_list(filename):
+            try:
+                puid, name = line.split(':')
+                puid = puid.strip().lower()
+                if len(puid) != 8:
+                    raise ValueError(puid)
+                int(puid, 16)
+            except ValueError:
+                logger.error('invalid line in %s: %s' % (filename, line))
+                continue
+            puids[puid] = name.strip()
+        return puids
+
     def get_blacklist(self):
         return self.blacklist
 
@@ -214,6 +301,86 @@ class PluginManagerAPI:
 
         #client_sock.sendall(tabulate(user_table, headers, tablefmt   = "fancy_grid"))
 
+    def command_stats(self):
+        """
+        Shows the traffic counters of the router: what every plugin sent and how full the queues of
+        the listeners, e.g. the one of system_send, are. Also the counters of system_send and
+        system_receive.
+        """
+        status, stats = self.plug.get_stats()
+        if not status:
+            return self.create_status_message(status, stats)
+
+        now = time.time()
+        sources = stats.get('sources', {})
+        source_table = []
+        for name in sorted(sources, key=lambda x: sources[x]['bytes'], reverse=True):
+            source = sources[name]
+            source_table.append([name, source['messages'], source['bytes'], '%.1f' % (now - source['last_seen'])])
+
+        listeners = stats.get('listeners', {})
+        listener_table = []
+        for listener_uuid in sorted(listeners, key=lambda x: listeners[x]['name']):
+            listener = listeners[listener_uuid]
+            listener_table.append([listener['name'], listener['queue_name'], listener['depth'], listener['high_water'],
+                listener['maxsize'], listener['policy'], listener['delivered'], listener['dropped']])
+
+        # the uplink counters are grouped by stage of system_send
+        uplink = stats.get('uplink', {})
+        uplink_table = []
+        for stage in uplink:
+            # the histograms are shown by the latency command
+            if stage == 'latency':
+                continue
+            for counter in uplink[stage]:
+                uplink_table.append([stage, counter, uplink[stage][counter]])
+
+        # messages from the node controller, by the plugin they are addressed to
+        downlink = stats.get('downlink', {})
+        incoming = downlink.get('plugins', {})
+        incoming_table = []
+        for name in sorted(incoming):
+            incoming_table.append([name, incoming[name]['depth'], incoming[name]['delivered'], incoming[name]['dropped']])
+        downlink_table = []
+        for counter in sorted(downlink):
+            if counter != 'plugins':
+                downlink_table.append([counter, downlink[counter]])
+
+        results = {}
+        results['objects'] = []
+        results['objects'].append({'type': 'table', 'title': 'Plugin traffic', 'data': source_table,
+            'header': ['plugin', 'messages', 'bytes', 'last seen (s ago)']})
+        results['objects'].append({'type': 'table', 'title': 'Listener queues', 'data': listener_table,
+            'header': ['listener', 'queue', 'depth', 'high water', 'maxsize', 'policy', 'delivered', 'dropped']})
+        results['objects'].append({'type': 'table', 'title': 'Uplink', 'data': uplink_table,
+            'header': ['stage', 'counter', 'value']})
+        results['objects'].append({'type': 'table', 'title': 'Downlink', 'data': downlink_table,
+            'header': ['counter', 'value']})
+        results['objects'].append({'type': 'table', 'title': 'Incoming queues', 'data': incoming_table,
+            'header': ['plugin', 'depth', 'delivered', 'dropped']})
+        results['status'] = 'success'
+        return json.dumps(results)
+
+    def command_latency(self):
+        """
+        Shows how long the stages of system_send take, from the histograms it keeps since it started.
+        """
+        status, stats = self.plug.get_stats()
+        if not status:
+            return self.create_status_message(status, stats)
+
+        latency = stats.get('uplink', {}).get('latency', {})
+        latency_table = []
+        for stage in latency:
+            latency_table.append([stage] + lib.histogram.summary(latency[stage]))
+
+        results = {}
+        results['objects'] = []
+        results['objects'].append({'type': 'table', 'title': 'Uplink latency', 'data': latency_table,
+            'header': ['stage'] + lib.histogram.summary_header})
+        results['status'] = 'success'
+        return json.dumps(results)
+
     def create_status_message(self, status, message):
         result = {}
         result['status'] = self.status_code_to_text(status)
@@ -270,11 +437,29 @@ class PluginManagerAPI:
 
 
 
+    def start_all_skips(self, plugin):
+        """
+        Of plugins that cannot run together, e.g. system_io and system_send, startall starts the
+        whitelisted ones, none next to one that is already active, and system_io only if it is
+        whitelisted, so that by default system_send and system_receive keep running.
+        """
+        alternatives = lib.run_plugins_multi.exclusive_plugins.get(plugin, [])
+        if not alternatives:
+            return False
+        if any([self.plug.get_plugin_by_name(other) for other in alternatives]):
+            return True
+        if self.on_whitelist(plugin):
+            return False
+        return plugin in lib.run_plugins_multi.opt_in_plugins or any([self.on_whitelist(other) for other in alternatives])
+
     def command_start_all(self):
 
         blacklist = self.get_blacklist()
         fail = 0
         for plugin in plugins.__all__:
+            if self.start_all_skips(plugin):
+                logger.info("Not starting plugin %s, it cannot run together with %s" % (plugin, ", ".join(lib.run_plugins_multi.exclusive_plugins[plugin])))
+                continue
             if (not (plugin in blacklist)):
                 start, msg = self.plug.start_plugin(plugin)
                 logger.info("Starting plugin %s" % (plugin))
@@ -285,7 +470,7 @@ class PluginManagerAPI:
             return self.create_status_message(1, "Started all non-blacklisted plugins.")
 
 
-        return self.create_status_message(0, "Attempted to start all non-blacklisted plugins, failed to start " + fail)
+        return self.create_status_message(0, "Attempted to start all non-blacklisted plugins, failed to start %d" % (fail))
 
 
 
@@ -369,7 +554,9 @@ class PluginManagerAPI:
         counter=0
         while 1:
             try:
-                msg = queue.get()
+                msg = message_codec.decode(queue.get())
+                if isinstance(msg, dict) and isinstance(msg.get('data'), memoryview):
+                    msg['data'] = msg['data'].tobytes()
             except Queue.Empty:
                 msg = None
                 time.sleep(1)
@@ -403,7 +590,7 @@ class PluginManagerAPI:
         try:
             command_function = self.command_functions[command]['function']
         except KeyError:
-            loggr.debug("Command %s unknown." % (command))
+            logger.debug("Command %s unknown." % (command))
             return '{"error":"command %s is unknown"}' % (command)
             sys.exit(1)
 
@@ -427,124 +614,153 @@ class PluginManagerAPI:
             return results
 
 
-    def listen_to_socket(self):
-
-        socket_file = '/tmp/plugin_manager'
-
-        if os.path.exists(socket_file): #checking for the file
-            os.remove(socket_file)
-
-
-        server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-
-
-        server_sock.bind(socket_file)
-
-        # listen for clients
-        server_sock.listen(5)
-
-        read_list = [server_sock]
-
-        timeout_reading = 10
-        while True:
-
-            logger.debug("waiting for data")
-
-            readable, writable, errored = select.select(read_list, [], [], timeout_reading)
-
-
-
-            if len(readable) == 0:
-                logger.debug("no command after 10 seconds")
-                # this will join all children and thus remove zombies
-                multiprocessing.active_children()
+    def start_log_listener(self, command_line, client_sock):
+        """
+        Starts a process that streams the messages of the router to a client. Returns the reply to
+        the client if that failed, None if the process took over the connection.
+        """
+        # filters like "coresense_3" or "coresense_3:frame", options like "maxsize=100" or "policy=sample"
+        filters = []
+        options = {'maxsize': str(self.log_maxsize), 'policy': self.log_policy}
+        for argument in command_line[1:]:
+            if '=' in argument:
+                key, _, value = argument.partition('=')
+                options[key] = value
                 continue
+            plugin, _, sensor = argument.partition(':')
+            filters.append((plugin, sensor or None))
 
+        try:
+            maxsize = int(options['maxsize'])
+        except ValueError:
+            maxsize = -1
 
-            try:
-                client_sock, address = server_sock.accept()
-            except KeyboardInterrupt:
-                logger.info("Shutdown requested...exiting")
-                #self.stop()
-                sys.exit(0)
-            except Exception as e:
-                logger.info("server_sock.accept: "+str(e))
-                #self.stop()
-                sys.exit(1)
+        listener_name = 'client'
+        queue_name = self.plug.free_listener_queue()
 
+        if not queue_name:
+            return self.create_status_message(0, 'too many listeners')
 
+        myq = self.plug.listener_queues[queue_name]
 
+        logger.debug('spawning process for listener')
+        j = multiprocessing.Process(name=listener_name, target=self.message_log_process, args=(client_sock, myq))
 
-            try:
-                data = client_sock.recv(8192).decode('iso-8859-15') #arbitrary
+        j.start()
 
-            except KeyboardInterrupt:
-                logger.info("KeyboardInterrupt")
-                break
-            except Exception as a:
-                logger.error("client_sock.recv failed: %s" % (str(e) ))
-                break
+        # the running router picks the listener up, no restart needed
+        add_listener_result = self.plug.add_listener(listener_name, queue_name, j.pid, filters, maxsize, options['policy'])
 
+        if add_listener_result[0] == 0:
+            j.terminate()
+            return self.create_status_message(add_listener_result[0], add_listener_result[1])
 
+        logger.info("Registered listener with uuid %s" % (add_listener_result[1]))
+        return None
 
+    def maintain(self):
+        # a stop in the lifecycle thread joins the same children, it has them to itself
+        if self.lifecycle_lock.locked():
+            return
+        # this will join all children and thus remove zombies
+        multiprocessing.active_children()
+        # tells the router about listeners that have exited, in case it cannot watch them itself
+        self.plug.listener_consolidate()
 
-            command = str(data).rstrip()
+    async def run_command(self, command_line):
+        """
+        Runs a command of a client. Commands that start or stop processes run one after the other,
+        the others right away. A forking command runs on the loop thread while the lifecycle
+        thread is idle, so that the child cannot inherit a lock, e.g. of a logging handler, that
+        another thread holds.
+        """
+        command_function = self.command_functions.get(command_line[0], {}) if command_line else {}
+        if not command_function.get('lifecycle'):
+            return self.do_command(command_line)
 
+        async with self.lifecycle_lock:
+            if command_function.get('forks'):
+                return self.do_command(command_line)
+            return await asyncio.get_running_loop().run_in_executor(self.lifecycle, self.do_command, command_line)
 
+    async def handle_client(self, reader, writer):
+        """
+        Serves one client: reads its command and sends the reply, see run_command().
+        """
+        try:
+            data = await asyncio.wait_for(reader.read(8192), self.client_timeout)
+            command = data.decode('iso-8859-15').rstrip()
+            command_line = command.split()
 
-            if command == 'log':
+            if command_line and command_line[0] == 'log':
                 logger.debug("received command \"log\"" )
-                myq  = Queue()
-
-                listener_name = 'client'
-                #listener_e = self.plug.listener_exists(listener_name)
-                #if listener_e[0]:
-                #    result_json = self.create_status_message(0, 'listener already exists')
-                #else:
-
-                logger.debug('spawning process for listener')
-                j = multiprocessing.Process(name=listener_name, target=self.message_log_process, args=(client_sock, myq))
-
-                j.start()
-
-                add_listener_result = self.plug.add_listener(listener_name, myq, j.pid)
-
-                if add_listener_result[0] == 0:
-                    result_json = self.create_status_message(add_listener_result[0], add_listener_result[1])
-                    j.terminate()
-                else:
-                    logger.info("Registered listener with uuid %s" % (add_listener_result[1]))
-                    self.plug.restart_plugin('system_router')
-                    continue;
-
+                # the listener process gets a socket of its own, the connection of the loop is closed
+                client_sock = socket.socket(fileno=os.dup(writer.get_extra_info('socket').fileno()))
+                try:
+                    # forks, see run_command()
+                    async with self.lifecycle_lock:
+                        result_json = self.start_log_listener(command_line, client_sock)
+                finally:
+                    client_sock.close()
+                if result_json is None:
+                    return
             else:
-
                 logger.debug("received command \"%s\"" % (command))
-                try:
-                    result_json = self.do_command(command.split())
-                except Exception as e:
-                    logger.error("command execution failed: %s" % (str(e)) )
-                    continue
+                result_json = await self.run_command(command_line)
 
-            if not 'status' in result_json:
+            if not result_json or not 'status' in result_json:
                 logger.error("result_json has not status")
-                continue
-
-            try:
-                client_sock.sendall(result_json.encode('iso-8859-15')+"\n".encode('iso-8859-15'))
-            except Exception as e:
-                logger.warning("Could not reply to client: %s" % (str(e)) )
-                continue
+                return
 
+            writer.write(result_json.encode('iso-8859-15')+"\n".encode('iso-8859-15'))
+            await writer.drain()
             logger.debug("got data: \"%s\"" % (str(data)))
+        except asyncio.TimeoutError:
+            logger.debug("no command after %d seconds" % (self.client_timeout))
+        except Exception as e:
+            logger.warning("Could not serve client: %s" % (str(e)) )
+        finally:
+            writer.close()
+
+    async def serve_socket(self, socket_file):
+        self.lifecycle_lock = asyncio.Lock()
+        server = await asyncio.start_unix_server(self.handle_client, path=socket_file)
+        async with server:
+            while True:
+                await asyncio.sleep(10)
+                self.maintain()
+
+    def listen_to_socket(self):
+        """
+        Serves the control socket. Clients are served concurrently, a slow command only holds up
+        its own client and other commands that start or stop processes.
+        """
+        socket_file = '/tmp/plugin_manager'
+
+        if os.path.exists(socket_file): #checking for the file
+            os.remove(socket_file)
+
+        try:
+            asyncio.run(self.serve_socket(socket_file))
+        except KeyboardInterrupt:
+            logger.info("Shutdown requested...exiting")
+            sys.exit(0)
+        finally:
+            self.lifecycle.shutdown(wait=False)
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--logging', dest='enable_logging', help='write to log files instead of stdout', action='store_true')
     parser.add_argument('--force', dest='force', help='kill other processes and start', action='store_true')
+    parser.add_argument('--config-dir', dest='config_dir', help='read node_controller_host and node_id from this directory instead of /etc/waggle, e.g. to use scripts/node_controller_standin.py')
     args = parser.parse_args()
 
+    if args.config_dir:
+        # the plugins are forked from this process and read the configuration through lib.config
+        lib.config.config_dir = args.config_dir
+        os.environ['WAGGLE_CONFIG_DIR'] = args.config_dir
+
 
     if args.enable_logging:
         # 5 times 10MB
@@ -0,0 +1 @@
+from .system_io import register
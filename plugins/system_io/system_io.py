@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import asyncio
+import signal
+import socket
+import sys
+import threading
+import time
+import logging
+import zmq
+from lib.plugin_mailbox import queue_reader
+from plugins.system_send.system_send import system_send
+from plugins.system_receive.system_receive import system_receive
+
+
+logger = logging.getLogger(__name__)
+
+
+class register(object):
+
+    def __init__(self, name, man, mailbox_outgoing, routes, send_stats=None, receive_stats=None, send_settings={}, receive_settings={},
+            priority_mailboxes=[]):
+        man[name] = 1
+
+        io = system_io(name, man, mailbox_outgoing, routes, send_stats, receive_stats, send_settings, receive_settings, priority_mailboxes)
+
+        try:
+            asyncio.run(io.run())
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+
+class system_io(object):
+    """
+    Does the work of system_send and system_receive in one process: the uplink socket, the
+    connection to the pull server and the system_send mailbox are served by one event loop,
+    with the same settings, counters and histograms as the two plugins. Runs instead of them.
+
+    The uplink still waits for acknowledgements when its window is full and nothing is spooled,
+    for at most the reply timeout; the downlink is held up for that time.
+    """
+
+    def __init__(self, name, man, mailbox_outgoing, routes, send_stats=None, receive_stats=None, send_settings={}, receive_settings={},
+            priority_mailboxes=[]):
+        self.name = name
+        self.man = man
+        self.mailbox_outgoing = mailbox_outgoing
+        self.priority_mailboxes = priority_mailboxes
+        self.send_stats = send_stats
+        self.send_settings = send_settings
+
+        self.receiver = system_receive(name, man, routes, receive_stats, receive_settings)
+        # created once the registration with the node controller went through
+        self.sender = None
+
+    def running(self):
+        return self.man[self.name]
+
+    async def readable(self, fds, timeout):
+        """
+        Waits until one of the file descriptors is readable, at most timeout seconds. Returns
+        False on timeout.
+        """
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def set_ready():
+            if not ready.done():
+                ready.set_result(True)
+
+        for fd in fds:
+            loop.add_reader(fd, set_ready)
+        try:
+            await asyncio.wait_for(ready, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            for fd in fds:
+                loop.remove_reader(fd)
+
+    def start_sender(self):
+        """
+        Creates the system_send instance in a thread, its registration with the node controller
+        blocks until that is reachable. Returns a future of the instance.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def create():
+            try:
+                sender = system_send(self.mailbox_outgoing, self.send_stats, self.send_settings, self.priority_mailboxes)
+            except Exception as e:
+                loop.call_soon_threadsafe(future.set_exception, e)
+                return
+            loop.call_soon_threadsafe(future.set_result, sender)
+
+        # a daemon thread, so that a stop during the registration does not wait for it
+        threading.Thread(target=create, name='system_io registration', daemon=True).start()
+        return future
+
+    async def send_loop(self):
+        loop = asyncio.get_running_loop()
+        self.sender = await self.start_sender()
+        sender = self.sender
+        loop.add_signal_handler(signal.SIGUSR1, sender.request_dump, signal.SIGUSR1, None)
+
+        mailbox_fds = [queue_reader(x).fileno() for x in [self.mailbox_outgoing] + self.priority_mailboxes]
+        try:
+            while self.running():
+                timeout = sender.next_timeout()
+                socket_ = sender.pipeline.socket
+                # the ZMQ descriptor only signals changes, replies that are already queued are
+                # seen through EVENTS
+                if timeout > 0 and not (socket_ and socket_.getsockopt(zmq.EVENTS) & zmq.POLLIN):
+                    fds = list(mailbox_fds)
+                    if socket_:
+                        fds.append(socket_.getsockopt(zmq.FD))
+                    start = time.monotonic()
+                    await self.readable(fds, timeout)
+                    sender.histograms['mailbox wait'].record(time.monotonic() - start)
+                sender.step()
+                # the downlink gets its turn between rounds
+                await asyncio.sleep(0)
+        finally:
+            sender.close()
+
+    async def pull(self):
+        """
+        Like system_receive.pull(), on the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        receiver = self.receiver
+        if not receiver.socket:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                await asyncio.wait_for(loop.sock_connect(sock, (receiver.NC_HOST, receiver.NC_PORT)), receiver.reply_timeout)
+            except BaseException:
+                sock.close()
+                raise
+            receiver.use_connection(sock)
+
+        await loop.sock_sendall(receiver.socket, receiver.make_request())
+        while not receiver.handle_frames():
+            if not await self.readable([receiver.socket.fileno()], receiver.reply_timeout):
+                raise socket.timeout('no reply within %s seconds' % (receiver.reply_timeout))
+            try:
+                if not receiver.decoder.recv_from(receiver.socket):
+                    raise ConnectionError('connection closed by node controller')
+            except BlockingIOError:
+                continue
+        return receiver.received
+
+    async def receive_loop(self):
+        receiver = self.receiver
+        try:
+            while self.running():
+                receiver.maintain()
+                reused = receiver.socket is not None and receiver.replies > 0
+                try:
+                    received = await self.pull()
+                except (Exception, asyncio.TimeoutError) as e:
+                    await asyncio.sleep(receiver.request_failed(e, reused))
+                    continue
+                receiver.attempt = 0
+
+                if not received:
+                    await asyncio.sleep(receiver.poll_interval)
+        finally:
+            receiver.disconnect()
+
+    async def run(self):
+        tasks = [asyncio.ensure_future(self.receive_loop()), asyncio.ensure_future(self.send_loop())]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        # an error of either side ends the process, the plugin manager shows it as stopped
+        for task in done:
+            task.result()
@@ -3,17 +3,21 @@ import time
 import socket
 import sys
 import logging
+import queue
 from waggle.protocol.PacketHandler import *
+from lib.config import read_config
+from lib.retry_scheduler import backoff
+from lib.frame_decoder import frame_decoder
 
 logger = logging.getLogger(__name__)
 
 class register(object):
 
-    def __init__(self, name, man, mailbox_incoming):
+    def __init__(self, name, man, routes, stats=None, settings={}):
 
         man[name] = 1
 
-        sr = system_receive(name, man, mailbox_incoming)
+        sr = system_receive(name, man, routes, stats, settings)
 
         try:
             sr.receive()
@@ -24,100 +28,252 @@ class register(object):
             sys.exit(1)
 
 
+def puid_key(puid):
+    """
+    Returns a puid as 8 lowercase hex digits, the form of the keys of the routes.
+    """
+    if isinstance(puid, int):
+        return '%08x' % (puid)
+    if isinstance(puid, (bytes, bytearray)):
+        if len(puid) == 4:
+            return puid.hex()
+        puid = puid.decode('iso-8859-1')
+    if isinstance(puid, str):
+        return puid.strip().lower()
+    return None
+
+
 class system_receive:
     """
     This class receives messages from the node controller for the plugin manager and/or plugins.
+
+    It keeps one connection to the pull server of the node controller open and asks for the
+    next message as soon as the last one has arrived, so that messages queued on the node
+    controller come in back-to-back. Only while the node controller has nothing for this node
+    ('False') it waits poll_interval seconds before asking again. A node controller that closes
+    the connection after every reply is reconnected to right away.
+
+    With batch_messages set, a request asks for up to batch_messages messages of at most
+    batch_bytes bytes in all: '<node id> <batch_messages> <batch_bytes>'. The node controller
+    answers with the packets back-to-back, followed by 'False'. The packets are unpacked and
+    passed on while the rest of the batch is still arriving.
+
+    Messages are routed by their r_puid through routes, puid -> {'plugin': name, 'queue': incoming
+    queue of the plugin}. A message for an unknown puid, or for a plugin whose queue is full, is
+    counted and dropped.
     """
-    def __init__(self, name, man, mailbox_incoming):
+
+    # reply of the pull server when no message is waiting for this node
+    NO_MESSAGE = b'False'
+
+    def __init__(self, name, man, routes, stats=None, settings={}):
 
         self.name = name
         self.man = man
-        self.incoming = mailbox_incoming
+        self.routes = routes
+
+        # counters shared with the plugin manager, updated every stats_interval
+        self.stats = stats
+        self.stats_interval = 1
+        self.last_stats = 0
+        self.messages = 0
+        self.unknown_puid = 0
+        # plugin -> [delivered, dropped]
+        self.plugin_counters = {}
+        for puid in self.routes:
+            self.plugin_counters[self.routes[puid]['plugin']] = [0, 0]
 
-        with open('/etc/waggle/node_controller_host','r') as file_:
-            self.NC_HOST = file_.read().strip()
+        self.NC_HOST = read_config('node_controller_host')
         logger.info("NC_HOST: %s" % (self.NC_HOST))
 
         self.NC_PORT = 9091 #port for pull_server
         logger.info("NC_PORT: %s" % (self.NC_PORT))
 
-        with open('/etc/waggle/node_id','r') as file_:
-            self.NODE_ID = file_.read().strip()
+        self.NODE_ID = read_config('node_id')
 
+        self.socket = None
+        # replies received on the current connection
+        self.replies = 0
+        # seconds between requests while no message is waiting
+        self.poll_interval = float(settings.get('poll_interval', 1))
+        self.reply_timeout = float(settings.get('reply_timeout', 10))
+        # most messages and bytes per request, one message per request while batch_messages is 0
+        self.batch_messages = int(settings.get('batch_messages', 0))
+        self.batch_bytes = int(settings.get('batch_bytes', 1 << 20))
+        if self.batch_messages:
+            logger.info("Pulling up to %d messages or %d bytes per request" % (self.batch_messages, self.batch_bytes))
+        # packets may arrive in pieces or several in one read, the decoder cuts them by the
+        # length in their header
+        # packets of the reply to the current request
+        self.received = 0
+        # requests that failed in a row
+        self.attempt = 0
+        self.decoder = frame_decoder(HEADER_LENGTH, FOOTER_LENGTH, lambda header: get_header(bytes(header))['len_body'], self.NO_MESSAGE)
+        self.unpack_errors = 0
 
+    def connect(self):
+        self.use_connection(socket.create_connection((self.NC_HOST, self.NC_PORT), timeout=self.reply_timeout))
 
-    def receive(self):
-        connection_error = False
-        while self.man[self.name]: #loop that keeps connecting to node controller
+    def use_connection(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket = sock
+        self.replies = 0
+        self.decoder.reset()
+        logger.debug("Connected to %s:%d" % (self.NC_HOST, self.NC_PORT))
 
-            if connection_error:
-                if s:
-                    s.close()
+    def disconnect(self):
+        if self.socket:
+            self.socket.close()
+        self.socket = None
 
-                time.sleep(3)
-                connection_error = False
+    def make_request(self):
+        """
+        Returns the request for the next message, or the next batch, of this node.
+        """
+        self.received = 0
+        request = self.NODE_ID
+        if self.batch_messages:
+            request = '%s %d %d' % (self.NODE_ID, self.batch_messages, self.batch_bytes)
+        return request.encode('iso-8859-1')
 
+    def handle_frames(self):
+        """
+        Passes on the packets that are complete in the receive buffer. Returns True once the
+        reply to the request is complete.
+        """
+        while True:
+            packet = self.decoder.next_frame()
+            if packet is None:
+                return False
+            # 'False' means no message, or the end of a batch
+            if packet is self.NO_MESSAGE:
+                break
+            self.received += 1
+            logger.debug("incoming message of %d bytes" % (len(packet)))
+            # the one copy of the packet, it is passed on to another process anyway. The view
+            # itself is only valid until the next read.
+            self.deliver(bytes(packet))
+            if not self.batch_messages:
+                break
+        self.replies += 1
+        return True
 
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.connect((self.NC_HOST,self.NC_PORT))
-            except Exception as e:
-                logger.error('Unable to connect to %s:%d : %s' % (self.NC_HOST, self.NC_PORT, str(e)))
-                connection_error = True
-                continue
+    def pull(self):
+        """
+        Asks the node controller for the messages of this node and passes every packet on as soon
+        as it is complete. Returns the number of packets, 0 if none was waiting.
+        """
+        if not self.socket:
+            self.connect()
 
+        self.socket.sendall(self.make_request())
+        while not self.handle_frames():
+            if not self.decoder.recv_from(self.socket):
+                raise ConnectionError('connection closed by node controller')
+        return self.received
 
-            # Contact node controller to
-            try:
-                s.send(self.NODE_ID.encode('iso-8859-1'))
-            except Exception as e:
-                 #waits for pull request to go through #TODO might be unneccessary
-                logger.error('Unable to send initial request: %s' % (str(e)))
-                connection_error = True
-                continue
-
-            time.sleep(1)
-            #
-            try:
-                msg = s.recv(4028) #arbitrary. Can put in a config file
-            except Exception as e:
-                logger.error('Error receiving message from node controller: %s' % (str(e)))
-                connection_error = True
-                continue
-
-            if not msg:
-                s.close()
-                time.sleep(1)
-
-            logger.debug("incoming message: %s" % (msg))
-            if msg == 'False'.encode('iso-8859-1'):
-                time.sleep(1)
-                continue
-
-            header = None
-            optional_header = None
-            data = None
-            try:
-                #unpacks the message
-                (header, optional_header, data) = unpack(msg)
-            except Exception as e:
-                logger.error('(System receive):Error unpacking the message %s with error %s' % (msg, str(e)))
-                raise
-            json_msg = {}
-            # Parse waggle message into JSON
-            json_msg.update(header)
-            if optional_header != None:
-                json_msg.update(optional_header)
-            json_msg['data'] = data
-
-            # TODO: some of the fields such as protocol version, flags may need to be removed in the JSON because these seem unneccesary.
+    def deliver(self, msg):
+        """
+        Unpacks a packet and passes it on. A packet that cannot be unpacked is dropped, the
+        frames after it are not affected.
+        """
+        header = None
+        optional_header = None
+        data = None
+        try:
+            #unpacks the message
+            (header, optional_header, data) = unpack(msg)
+        except Exception as e:
+            self.unpack_errors += 1
+            logger.error('(System receive):Error unpacking a message of %d bytes, %d so far: %s' % (len(msg), self.unpack_errors, str(e)))
+            return
+        json_msg = {}
+        # Parse waggle message into JSON
+        json_msg.update(header)
+        if optional_header != None:
+            json_msg.update(optional_header)
+        json_msg['data'] = data
+
+        # TODO: some of the fields such as protocol version, flags may need to be removed in the JSON because these seem unneccesary.
+
+        self.messages += 1
+        self.route(json_msg)
+
+    def route(self, msg):
+        """
+        Puts a message into the incoming queue of the plugin its r_puid belongs to.
+        """
+        route = self.routes.get(puid_key(msg.get('r_puid')))
+        if not route:
+            self.unknown_puid += 1
+            if self.unknown_puid == 1 or self.unknown_puid % 100 == 0:
+                logger.warning('(System receive) no plugin with puid %s, %d messages dropped so far' % (msg.get('r_puid'), self.unknown_puid))
+            return
+
+        counters = self.plugin_counters[route['plugin']]
+        try:
+            # a plugin that does not read its messages must not hold up the others
+            route['queue'].put_nowait(msg)
+            counters[0] += 1
+        except queue.Full:
+            counters[1] += 1
+        except Exception as e:
+            counters[1] += 1
+            logger.error('(System receive)) putting msg into the queue of %s failed: %s' % (route['plugin'], str(e)))
+
+    def maintain(self):
+        """
+        Publishes the counters, once every stats_interval.
+        """
+        now = time.time()
+        if self.stats is None or now < self.last_stats + self.stats_interval:
+            return
+        self.last_stats = now
 
+        plugins = {}
+        for puid in self.routes:
+            name = self.routes[puid]['plugin']
             try:
-                #sends incoming messages to msg_handler class
-                self.incoming.put(json_msg)
-                s.close() #closes each time a message is received.
-                #print 'Connection closed...'
-            except Exception as e:
-                logger.error('(System receive)) putting msg into the queue failed: %s' % (str(e)))
-            if s:
-                s.close()
+                depth = self.routes[puid]['queue'].qsize()
+            except NotImplementedError:
+                depth = -1
+            plugins[name] = {'depth': depth, 'delivered': self.plugin_counters[name][0], 'dropped': self.plugin_counters[name][1]}
+        try:
+            self.stats.update({'messages': self.messages, 'unknown puid': self.unknown_puid, 'unpack errors': self.unpack_errors,
+                'plugins': plugins})
+        except Exception as e:
+            logger.error("Could not publish stats (%s): %s" % (str(type(e)), str(e)))
+
+    def request_failed(self, error, reused):
+        """
+        Drops the connection after a failed request. Returns the seconds to wait before the next
+        request, 0 to reconnect right away.
+        """
+        self.disconnect()
+        if reused and isinstance(error, (ConnectionError, socket.timeout)) and self.attempt == 0:
+            # the node controller may close the connection after every reply
+            logger.debug('Connection closed by %s:%d, reconnecting' % (self.NC_HOST, self.NC_PORT))
+            self.attempt = 1
+            return 0
+        logger.error('Error receiving message from %s:%d : %s' % (self.NC_HOST, self.NC_PORT, str(error)))
+        delay = backoff(self.attempt, 1, 30)
+        self.attempt += 1
+        return delay
+
+    def receive(self):
+        try:
+            while self.man[self.name]: #loop that keeps asking the node controller
+
+                self.maintain()
+                reused = self.socket is not None and self.replies > 0
+                try:
+                    received = self.pull()
+                except Exception as e:
+                    time.sleep(self.request_failed(e, reused))
+                    continue
+                self.attempt = 0
+
+                if not received:
+                    time.sleep(self.poll_interval)
+        finally:
+            self.disconnect()
@@ -3,7 +3,10 @@ import time
 import sys
 import logging
 import os
-from multiprocessing import Queue
+import queue
+import multiprocessing.connection
+from lib import message_codec
+from lib.plugin_mailbox import queue_reader
 
 
 logger = logging.getLogger(__name__)
@@ -14,10 +17,10 @@ class register(object):
     #     man[name] = 1
 
     #     sr = system_router(name, man, mailbox_outgoing, mailbox_incoming, listeners)
-    def __init__(self, name, man, plugin_mailbox, listeners):
+    def __init__(self, name, man, lanes, listeners, listener_queues={}, control=None, stats=None, acks=None):
         man[name] = 1
 
-        sr = system_router(name, man, plugin_mailbox, listeners)
+        sr = system_router(name, man, lanes, listeners, listener_queues, control, stats, acks)
         try:
             sr.run()
         except KeyboardInterrupt:
@@ -25,17 +28,6 @@ class register(object):
 
 
 
-def check_pid(pid):
-    """ Check For the existence of a unix pid. """
-    try:
-        os.kill(pid, 0)
-    except OSError:
-        return False
-    else:
-        return True
-
-
-
 class system_router(object):
 
     # def __init__(self,name, man, mailbox_outgoing, mailbox_incoming, listeners):
@@ -73,66 +65,421 @@ class system_router(object):
     #     queue = plugin['incoming_queue']
     #     queue.put(msg)
     #     return msg
-    def __init__(self,name, man, plugin_mailbox, listeners):
+    def __init__(self,name, man, lanes, listeners, listener_queues={}, control=None, stats=None, acks=None):
         self.name = name
         self.man = man
-        self.plugin_mailbox = plugin_mailbox
-        self.listeners = listeners
-
-    def run(self):
-        check_interval = 10
+        # one lane per priority class, highest priority first. A lane is the mailbox and the
+        # ring buffers of the plugins in that class, see plugin_runner.
+        self.lanes = lanes
+        self.listener_queues = listener_queues
+        # listeners are added and removed through this queue while the router is running
+        self.control = control
+        # the uuid of every removed listener goes back through this queue, its queue can be used
+        # for another listener then
+        self.acks = acks
+
+        # traffic counters are kept locally and copied to the shared stats dict every stats_interval
+        self.stats = stats
+        self.stats_interval = 1
+        self.last_stats = 0
+        # source -> [messages, bytes, last seen]
+        self.source_stats = {}
+
+        # pidfd -> uuid of the listener whose process it refers to
+        self.pidfds = {}
+
+        # listeners that were registered before the router was started
+        self.listeners = {}
+        for listener_uuid in listeners:
+            self.add_listener(listener_uuid, listeners[listener_uuid])
+        self.batch_size = 64
+        self.blocking_timeout = 1
+        self.backlog = False
+
+        # share of a batch that every lane gets when all of them are busy
+        total_weight = sum([lane['weight'] for lane in self.lanes])
+        self.lane_quota = {}
+        for lane in self.lanes:
+            self.lane_quota[lane['name']] = max(1, self.batch_size * lane['weight'] // total_weight)
+        self.rings = []
+        for lane in self.lanes:
+            self.rings.extend(lane['rings'])
+
+        # the queue itself cannot be waited on together with the rings, its reading end can
+        self.wait_objects = []
+        for lane in self.lanes:
+            self.wait_objects.append(queue_reader(lane['mailbox']))
+            self.wait_objects.extend(lane['rings'])
+        if self.control:
+            self.wait_objects.append(queue_reader(self.control))
+
+        # (plugin, sensor) -> uuids of listeners subscribed to it, sensor None subscribes to the whole plugin
+        self.subscriptions = {}
+        # uuids of listeners without filters, they get everything
+        self.subscribed_to_all = set()
+        # (plugin, sensor) -> list of matching listener uuids, filled on first use
+        self.match_cache = {}
+        self.build_subscription_index()
+
+    def add_listener(self, listener_uuid, listener):
+        listener = dict(listener)
+        if not 'queue' in listener:
+            listener['queue'] = self.listener_queues[listener['queue_name']]
+        # priority class -> queue for the messages of that class, e.g. the control and health
+        # messages for system_send
+        if not 'lane_queues' in listener:
+            listener['lane_queues'] = {}
+            for lane_name in listener.get('lane_queue_names', {}):
+                listener['lane_queues'][lane_name] = self.listener_queues[listener['lane_queue_names'][lane_name]]
+        listener.setdefault('maxsize', 0)
+        listener.setdefault('policy', 'block')
+        listener.setdefault('sample_every', 10)
+        listener['dropped'] = 0
+        listener['sampled'] = 0
+        listener['delivered'] = 0
+        listener['high_water'] = 0
+
+        if listener_uuid in self.listeners:
+            self.remove_listener(listener_uuid)
+        self.listeners[listener_uuid] = listener
+        logger.info("listener: %s (maxsize %d, policy %s)" % (listener['name'], listener['maxsize'], listener['policy']))
+
+        if listener.get('pid'):
+            self.watch_listener(listener_uuid, listener['pid'])
+
+    def remove_listener(self, listener_uuid):
+        listener = self.listeners.pop(listener_uuid)
+        logger.info("removing listener: %s" % (listener['name']))
+
+        for pidfd in list(self.pidfds):
+            if self.pidfds[pidfd] == listener_uuid:
+                del self.pidfds[pidfd]
+                os.close(pidfd)
+
+    def watch_listener(self, listener_uuid, pid):
+        """
+        Waits on a pidfd of the listener process together with the mailbox, so that the listener is
+        removed as soon as its process exits. Without pidfd support (Linux < 5.3) the plugin manager
+        reports dead listeners through the control channel instead.
+        """
+        try:
+            pidfd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            logger.info("Listener process %s is not running anymore, pid: %d" % (self.listeners[listener_uuid]['name'], pid))
+            self.remove_listener(listener_uuid)
+            return
+        except (AttributeError, OSError) as e:
+            logger.debug("Cannot watch listener process %d: %s" % (pid, str(e)))
+            return
+
+        self.pidfds[pidfd] = listener_uuid
+
+    def reap_listeners(self, ready):
+        """
+        Removes the listeners whose pidfd became readable, i.e. whose process has exited.
+        """
+        changed = False
+        for pidfd in ready:
+            if not pidfd in self.pidfds:
+                continue
+            listener_uuid = self.pidfds[pidfd]
+            listener = self.listeners[listener_uuid]
+            logger.info("Listener process %s is not running anymore, pid: %d" % (listener['name'], listener['pid']))
+            self.remove_listener(listener_uuid)
+            changed = True
+
+        if changed:
+            self.build_subscription_index()
+
+    def count_drop(self, listener):
+        listener['dropped'] += 1
+        if listener['dropped'] == 1 or listener['dropped'] % 1000 == 0:
+            logger.warning("Queue %s is full, %d messages dropped so far" % (listener['name'], listener['dropped']))
+
+    def put_blocking(self, listener, encoded):
+        """
+        Puts a message into the bounded queue of the listener, waiting for room as long as it
+        takes. The stop flag is checked every blocking_timeout seconds, so that a stalled listener
+        cannot keep the router from stopping, the message is dropped then.
+        """
+        while True:
+            try:
+                listener['queue'].put(encoded, timeout=self.blocking_timeout)
+                return True
+            except queue.Full:
+                if not self.man[self.name]:
+                    self.count_drop(listener)
+                    return False
+
+    def deliver(self, listener, encoded, lane_name='bulk'):
+        """
+        Puts a message into the queue of a listener, or into its queue for the priority class of
+        the message if it has one. Once the queue holds maxsize messages the policy of the
+        listener decides:
+            block        wait until the listener has taken messages off the queue, the queue
+                         itself is bounded by maxsize
+            drop-oldest  remove the oldest message from the queue to make room
+            drop-newest  drop the new message
+            sample       only every sample_every-th new message replaces the oldest one
+        maxsize 0 means the queue is not bounded.
+        """
+        lane_queue = listener['lane_queues'].get(lane_name)
+        if lane_queue is not None:
+            # control and health traffic is small, its queue is not bounded
+            lane_queue.put(encoded)
+            listener['delivered'] += 1
+            return
+
+        listener_queue = listener['queue']
+        maxsize = listener['maxsize']
+        policy = listener['policy']
+
+        if maxsize:
+            depth = listener_queue.qsize()
+            if depth > listener['high_water']:
+                listener['high_water'] = depth
+
+        if policy == 'block':
+            if self.put_blocking(listener, encoded):
+                listener['delivered'] += 1
+            return
+
+        if maxsize and depth >= maxsize:
+            if policy == 'drop-newest':
+                self.count_drop(listener)
+                return
+
+            if policy == 'sample':
+                listener['sampled'] += 1
+                if listener['sampled'] % listener['sample_every']:
+                    self.count_drop(listener)
+                    return
+
+            # drop-oldest, or a sampled message
+            try:
+                listener_queue.get_nowait()
+            except queue.Empty:
+                # the queued messages are not readable yet, putting anyway would grow the
+                # queue past maxsize
+                self.count_drop(listener)
+                return
+            self.count_drop(listener)
 
+        try:
+            listener_queue.put_nowait(encoded)
+            listener['delivered'] += 1
+        except queue.Full:
+            self.count_drop(listener)
+        except Exception as e:
+            logger.error("Error trying to put message into queue %s (%s): %s" % (listener['name'], str(type(e)), str(e)))
+
+    def count_message(self, source, encoded, now):
+        source_stats = self.source_stats.get(source)
+        if source_stats is None:
+            source_stats = self.source_stats[source] = [0, 0, 0]
+        source_stats[0] += 1
+        source_stats[1] += len(encoded)
+        source_stats[2] = now
+
+    def publish_stats(self):
+        """
+        Copies the traffic counters into the stats dict shared with the plugin manager, in one
+        update so that the manager process is contacted once per stats_interval only.
+        """
+        sources = {}
+        for source in self.source_stats:
+            messages, size, last_seen = self.source_stats[source]
+            sources[source] = {'messages': messages, 'bytes': size, 'last_seen': last_seen}
+
+        listeners = {}
         for listener_uuid in self.listeners:
-            logger.info("listener: %s" % (self.listeners[listener_uuid]['name']))
-
-        last_check = time.time()
-        delete_listeners = []
-        while self.man[self.name]:
-
-            # TODO select.select statment to read from multiple plugin queues
-            msg = self.plugin_mailbox.get() # a blocking call.
-
-
-            check_listener = 0
-            current = time.time()
+            listener = self.listeners[listener_uuid]
+            try:
+                depth = listener['queue'].qsize()
+            except NotImplementedError:
+                depth = -1
+            if depth > listener['high_water']:
+                listener['high_water'] = depth
+            listeners[listener_uuid] = {'name': listener['name'], 'queue_name': listener.get('queue_name', ''), 'depth': depth,
+                'high_water': listener['high_water'], 'maxsize': listener['maxsize'], 'policy': listener['policy'],
+                'delivered': listener['delivered'], 'dropped': listener['dropped']}
 
-            if current > (last_check + check_interval):
-                check_listener = 1
-                last_check = current
-
-
-            for listener_uuid in self.listeners:
-
-                #logger.debug("listener: %s" % (listener_name))
-                listener = self.listeners[listener_uuid]
-                queue = listener['queue']
-
-                do_send = 1
-
-                if check_listener and ('pid' in listener):
-                    pid = listener['pid']
-
-                    if not check_pid(pid):
-                        logger.info("Listener process %s is not running anymore, pid: %d" % (listener['name'], pid))
-                        do_send = 0
-                        delete_listeners.append(listener_uuid)
+        try:
+            self.stats.update({'sources': sources, 'listeners': listeners, 'updated': time.time()})
+        except Exception as e:
+            logger.error("Could not publish router stats (%s): %s" % (str(type(e)), str(e)))
+
+    def read_control(self):
+        """
+        Applies the listener changes the plugin manager sent since the last round.
+        """
+        changed = False
+        while self.control:
+            try:
+                command = self.control.get_nowait()
+            except queue.Empty:
+                break
+
+            try:
+                if command[0] == 'add':
+                    self.add_listener(command[1], command[2])
+                elif command[0] == 'remove':
+                    if command[1] in self.listeners:
+                        self.remove_listener(command[1])
+                    # also for a listener reaped already, nothing is delivered to its queue anymore
+                    if self.acks:
+                        self.acks.put(command[1])
+                else:
+                    logger.error("unknown control command: %s" % (str(command[0])))
+                    continue
+            except Exception as e:
+                logger.error("Could not apply control command %s (%s): %s" % (str(command[0]), str(type(e)), str(e)))
+                continue
+            changed = True
+
+        if changed:
+            self.build_subscription_index()
+
+    def build_subscription_index(self):
+        self.subscriptions = {}
+        self.subscribed_to_all = set()
+        self.match_cache = {}
 
-                    else:
-                        logger.debug("Listener process %s is still running, pid: %d" % (listener['name'], pid))
+        for listener_uuid in self.listeners:
+            filters = self.listeners[listener_uuid].get('filters')
+            if not filters:
+                self.subscribed_to_all.add(listener_uuid)
+                continue
+            for message_filter in filters:
+                self.subscriptions.setdefault(message_filter, set()).add(listener_uuid)
+
+    def match(self, message_topic):
+        """
+        Returns the uuids of the listeners that want messages of the given (plugin, sensor) topic.
+        """
+        try:
+            return self.match_cache[message_topic]
+        except KeyError:
+            pass
+
+        source, sensor = message_topic
+        matches = set(self.subscribed_to_all)
+        matches.update(self.subscriptions.get((source, None), ()))
+        matches.update(self.subscriptions.get((source, sensor), ()))
+
+        self.match_cache[message_topic] = list(matches)
+        return self.match_cache[message_topic]
+
+    def wait(self):
+        """
+        Waits until a message arrives in one of the lanes, a control command arrives or a listener
+        process exits. Returns what became ready.
+        """
+        timeout = self.blocking_timeout
+
+        # the last round stopped at batch_size, there is more waiting already
+        if self.backlog:
+            timeout = 0
+        # a record that came in after the ring was read, without a wakeup
+        elif not all([ring.idle() for ring in self.rings]):
+            timeout = 0
+
+        return multiprocessing.connection.wait(self.wait_objects + list(self.pidfds), timeout)
+
+    def read_lane(self, lane, limit, encoded_batch):
+        """
+        Appends up to limit messages of one lane to encoded_batch. Returns True if the lane may
+        have more waiting.
+        """
+        count = 0
+        more = False
+
+        rings = lane['rings']
+        for ring in rings:
+            ring.clear_wakeup()
+            if count < limit:
+                records = ring.get_batch(limit - count)
+                encoded_batch.extend(records)
+                count += len(records)
+            if not ring.empty():
+                more = True
+        # the first ring of a lane must not always be served first
+        if len(rings) > 1:
+            rings.append(rings.pop(0))
+
+        while count < limit:
+            try:
+                encoded_batch.append(lane['mailbox'].get_nowait())
+            except queue.Empty:
+                break
+            count += 1
+        else:
+            more = True
+
+        return more
+
+    def read_batch(self):
+        """
+        Reads up to batch_size messages from the lanes, so that one wakeup dispatches many messages.
+        Returns (lane name, message) pairs.
+        Every lane first gets its weighted share of the batch, what is left goes to the lanes in
+        priority order. Control and health messages are never more than one batch behind the bulk
+        sensor data, however much of it is waiting. The plugins encode their messages, every
+        listener gets the same bytes.
+        """
+        lane_batches = {}
+        more = {}
+        count = 0
+        for lane in self.lanes:
+            lane_batches[lane['name']] = []
+            more[lane['name']] = self.read_lane(lane, self.lane_quota[lane['name']], lane_batches[lane['name']])
+            count += len(lane_batches[lane['name']])
+
+        for lane in self.lanes:
+            room = self.batch_size - count
+            if room <= 0:
+                break
+            before = len(lane_batches[lane['name']])
+            more[lane['name']] = self.read_lane(lane, room, lane_batches[lane['name']])
+            count += len(lane_batches[lane['name']]) - before
+
+        # a lane that stopped at its limit has more waiting already
+        self.backlog = any(more.values())
+
+        # higher lanes are dispatched first
+        encoded_batch = []
+        for lane in self.lanes:
+            encoded_batch.extend([(lane['name'], x) for x in lane_batches[lane['name']]])
+        return encoded_batch
 
-                if do_send:
-                    try:
-                        queue.put(msg)
-                    except Queue.Full:
-                        logger.warning("Queue %s is full, cannot push messages" % (listener_name))
-                    except Exception as e:
-                        logger.error("Error trying to put message into queue %s (%s): %s" % (listener['name'], str(type(e)), str(e)))
+    def run(self):
+        while self.man[self.name]:
 
-            # clean up
-            if delete_listeners:
-                for listener_uuid in delete_listeners:
-                    del self.listeners[listener_uuid]
-                delete_listeners = []
+            ready = self.wait()
+            # before read_control, which may close pidfds and reuse their numbers
+            if self.pidfds:
+                self.reap_listeners(ready)
+            self.read_control()
+
+            now = time.time()
+            if self.stats is not None and now > self.last_stats + self.stats_interval:
+                self.last_stats = now
+                self.publish_stats()
+
+            encoded_batch = self.read_batch()
+            if not encoded_batch:
+                continue
+
+            for lane_name, encoded in encoded_batch:
+                try:
+                    message_topic = message_codec.topic(encoded)
+                except Exception as e:
+                    logger.error("Could not read message header (%s): %s" % (str(type(e)), str(e)))
+                    continue
+                self.count_message(message_topic[0], encoded, now)
+
+                for listener_uuid in self.match(message_topic):
+                    self.deliver(self.listeners[listener_uuid], encoded, lane_name)
         # check_interval = 10
 
         # for listener_uuid in self.routingTable:
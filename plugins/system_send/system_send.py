@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
 import time
 import sys
+import signal
 import logging
+import queue
+import collections
 import zmq
 from waggle.protocol.utils import packetmaker
+from lib import message_codec
+from lib.config import read_config
+from lib.plugin_mailbox import queue_reader
+from lib.zmq_connection import zmq_pipeline
+from lib.spool import spool
+from lib.coalescer import coalescer
+from lib.compression import compressor, MINOR_TYPES
+from lib.retry_scheduler import retry_scheduler, circuit_breaker, backoff
+from lib.token_bucket import shaper
+from lib.histogram import histogram, summary, summary_header
 
 
 logging.basicConfig()
@@ -12,34 +25,90 @@ logger = logging.getLogger(__name__)
 
 class register(object):
 
-    def __init__(self, name, man, mailbox_outgoing):
+    def __init__(self, name, man, mailbox_outgoing, stats=None, settings={}, priority_mailboxes=[]):
         man[name] = 1
 
-        ss = system_send(mailbox_outgoing)
+        ss = system_send(mailbox_outgoing, stats, settings, priority_mailboxes)
+        signal.signal(signal.SIGUSR1, ss.request_dump)
 
         try:
             ss.read_mailbox(name, man)
         except KeyboardInterrupt:
             sys.exit(0)
+        finally:
+            ss.close()
 
 
 class system_send(object):
 
-    def __init__(self, mailbox_outgoing):
+    # Stages of the send path whose latency is recorded:
+    # mailbox wait: time spent waiting for messages or replies, i.e. idle
+    # compress, packet build: compressor.encode_data() and packetmaker.make_packet() of a batch
+    # connect: sending the first packet on a new socket, which waits for the connection
+    # send: handing a packet to the socket
+    # acknowledgement: from sending a packet until the node controller acknowledged it
+    # retry delay: from a failure of a packet until it is sent again
+    STAGES = ['mailbox wait', 'compress', 'packet build', 'connect', 'send', 'acknowledgement', 'retry delay']
+
+    def __init__(self, mailbox_outgoing, stats=None, settings={}, priority_mailboxes=[]):
         self.mailbox_outgoing = mailbox_outgoing
-        self.socket = None
-        self.HOST = open('/etc/waggle/node_controller_host').read().strip()
-        self.PORT = 9090
+        # control and health messages, highest priority first, see take_priority()
+        self.priority_mailboxes = list(priority_mailboxes)
+        self.priority_messages = 0
+        self.histograms = {}
+        for stage in self.STAGES:
+            self.histograms[stage] = histogram()
+        # set by SIGUSR1, the histograms are written to the log in the next loop round
+        self.dump_requested = False
+        # counters shared with the plugin manager, updated every stats_interval
+        self.stats = stats
+        self.stats_interval = 1
+        self.last_stats = 0
+        self.blocking_timeout = 1
+        # most messages taken off the mailbox in one round
+        self.intake_batch = 256
+        self.shaper = shaper(settings)
+        self.coalescer = coalescer(float(settings.get('linger', 0)), int(settings.get('batch_bytes', 8192)))
         try:
-            context = zmq.Context()
-            self.socket = context.socket(zmq.REQ)
-        except zmq.error.ZMQError as e:
-            logger.debug("zmq.error.ZMQError: (%s) %s" % (str(type(e)), str(e)))
-            msg = None
+            self.compressor = compressor(settings.get('compression', 'none'), int(settings.get('compress_min_bytes', 256)))
+        except ValueError as e:
+            logger.error("%s, sending uncompressed" % (str(e)))
+            self.compressor = compressor('none')
+
+        # A packet that is not acknowledged is tried again after a backoff, while later packets
+        # keep flowing. After several failures in a row the breaker opens: while it is open, or
+        # there is still a backlog, packets go to the spool on disk and the mailbox keeps being read.
+        self.retries = retry_scheduler(delays=self.histograms['retry delay'])
+        self.breaker = circuit_breaker()
+        # seconds of a loop round spent on sending the backlog, the rest is for reading the mailbox
+        self.replay_budget = 0.1
+        self.spool = None
+        spool_dir = settings.get('spool_dir', '/var/spool/waggle/system_send')
+        try:
+            self.spool = spool(spool_dir, segment_bytes=int(settings.get('spool_segment_bytes', 4 << 20)),
+                max_bytes=int(settings.get('spool_max_bytes', 256 << 20)))
+        except Exception as e:
+            logger.error("Could not open spool %s, packets wait in memory while the node controller is unreachable: %s" % (spool_dir, str(e)))
+
+        # positions of the spooled packets in flight, in the order they were sent, and those of
+        # them that are acknowledged. The spool is committed up to the first one not acknowledged.
+        self.replaying = collections.deque()
+        self.replay_acked = set()
+
+        self.acknowledged = 0
+        self.failed = 0
+
+        self.HOST = read_config('node_controller_host')
+        self.PORT = 9090
+        # one socket for all packets, kept open for the lifetime of the process, with up to
+        # window packets waiting for their acknowledgement
+        self.pipeline = zmq_pipeline(self.HOST, self.PORT, int(settings.get('window', 16)), float(settings.get('reply_timeout', 10)),
+            histograms=self.histograms)
         logger.debug("Using %s:%d" % (self.HOST , self.PORT))
 
         packet = packetmaker.make_GN_reg(1)
 
+        attempt = 0
         while 1:
             logger.info('Registration packet made. Sending to 1.')
             try:
@@ -47,20 +116,14 @@ class system_send(object):
                     self.send(pack)
             except Exception as e:
                 logger.error("Could not send guest node registration: %s" % (str(e)))
-                time.sleep(2)
+                time.sleep(backoff(attempt, 1, 60))
+                attempt += 1
                 continue
             break
 
     def send(self, msg):
-        if self.socket:
-            self.socket.close()
-
         try:
-            context = zmq.Context()
-            self.socket = context.socket(zmq.REQ)
-            self.socket.connect ("tcp://%s:%s" % (self.HOST, self.PORT))
-            self.socket.send(msg)
-            self.socket.close()
+            self.pipeline.request(msg)
         except Exception as e:
             logger.error("Could not send message to %s:%d: %s" % (self.HOST, self.PORT, str(e)))
             raise
@@ -84,37 +147,349 @@ class system_send(object):
         #     raise
 
 
-    def read_mailbox(self, name, man):
+    def maintain(self):
+        """
+        Once every stats_interval: makes the spool durable and publishes the counters.
+        """
+        now = time.time()
+        if now < self.last_stats + self.stats_interval:
+            return
+        self.last_stats = now
 
+        stats = {'coalesce': self.coalescer.get_stats()}
+        stats['compression'] = self.compressor.get_stats()
+        if self.shaper.buckets:
+            stats['shaping'] = self.shaper.get_stats()
+        stats['uplink'] = {'window': self.pipeline.window, 'in flight': len(self.pipeline.in_flight),
+            'acknowledged': self.acknowledged, 'failed': self.failed, 'waiting for retry': len(self.retries),
+            'retries dropped': self.retries.dropped, 'breaker': self.breaker.state, 'priority messages': self.priority_messages}
+        if self.spool:
+            try:
+                self.spool.sync()
+            except Exception as e:
+                logger.error("Could not sync spool (%s): %s" % (str(type(e)), str(e)))
+            stats['spool'] = self.spool.get_stats()
+        stats['latency'] = self.get_latency()
 
-        while man[name]:
+        if self.stats is None:
+            return
+        try:
+            self.stats.update(stats)
+        except Exception as e:
+            logger.error("Could not publish stats (%s): %s" % (str(type(e)), str(e)))
 
+    def get_latency(self):
+        latency = {}
+        for stage in self.STAGES:
+            latency[stage] = self.histograms[stage].snapshot()
+        return latency
 
-            data = self.mailbox_outgoing.get() # a blocking call.
+    def request_dump(self, signum, frame):
+        self.dump_requested = True
 
-            msg = {}
-            msg['data'] = data
-            msg['msg_mj_type'] = 's'
-            msg['msg_mi_type'] = 'd'
+    def dump_latency(self):
+        """
+        Writes a summary of every latency histogram to the log.
+        """
+        self.dump_requested = False
+        logger.warning("send path latency: %s" % (', '.join(summary_header)))
+        for stage in self.STAGES:
+            logger.warning("%s: %s" % (stage, ', '.join([str(x) for x in summary(self.histograms[stage].snapshot())])))
 
-            # Pass all the arguments collected from JSON type msg
-            packet = ""
-            try:
-                packet = packetmaker.make_packet(msg)
-            except Exception as e:
-                logger.error("could not make packet %s" % (str(e)))
-                continue
+    # A packet on its way is a token (kind, value, attempt): kind 'live' with the packet as value,
+    # or 'spool' with (position after the packet in the spool, packet).
 
-            for pack in packet:
-                while 1:
-                    try:
-                        self.send(pack)
-                    except KeyboardInterrupt as e:
-                        raise
-                    except Exception as e:
-                        logger.error("Could not send message to %s:%d : %s" % (self.HOST, self.PORT, str(e)))
-
-                        time.sleep(2)
-                        continue
+    def link_down(self, reason, failed):
+        """
+        Called when the breaker opened. The failed packets, those in flight and those waiting
+        for a retry go back to the spool, they are sent again once a probe gets through.
+        """
+        logger.error("Could not send messages to %s:%d, waiting %.1f seconds before trying again: %s" % (self.HOST, self.PORT, self.breaker.time_left(), str(reason)))
+        self.park(self.retries.drain() + failed + self.pipeline.reset())
+
+    def park(self, tokens):
+        """
+        Keeps packets until the breaker lets packets through again.
+        """
+        if not self.spool:
+            for token in tokens:
+                self.retries.schedule(token, delay=self.breaker.time_left())
+            return
+
+        # spooled packets are read again from the last committed one, fresh packets are appended
+        # behind everything that is already in the spool
+        if self.replaying:
+            self.spool.rewind()
+            self.replaying.clear()
+            self.replay_acked.clear()
+        for kind, value, attempt in tokens:
+            if kind == 'live':
+                self.spool.append(value)
+
+    def packet_failed(self, token, reason, link_works=False):
+        """
+        Schedules the packet for another attempt. If the link is known to work, because a packet
+        sent later was acknowledged, the failure does not count towards opening the breaker.
+        """
+        self.failed += 1
+        if not link_works and self.breaker.failure():
+            self.link_down(reason, [token])
+            return
+        if self.breaker.is_open():
+            self.park([token])
+            return
+
+        kind, value, attempt = token
+        self.retries.schedule((kind, value, attempt + 1), attempt)
+
+    def transmit(self, token):
+        kind, value, attempt = token
+        if kind == 'spool':
+            pack = value[1]
+        else:
+            pack = value
+
+        try:
+            self.pipeline.send(pack, token)
+        except KeyboardInterrupt as e:
+            raise
+        except Exception as e:
+            self.packet_failed(token, e)
+
+    def may_send(self):
+        """
+        True if the window has room and the breaker lets packets through. A half-open breaker
+        lets only one probe through.
+        """
+        if not self.pipeline.has_room() or not self.breaker.allow():
+            return False
+        return self.breaker.state == circuit_breaker.CLOSED or not self.pipeline.in_flight
+
+    def handle_replies(self):
+        """
+        Takes the acknowledged packets off the window, and those whose reply is overdue.
+        """
+        for kind, value, attempt in self.pipeline.receive():
+            self.acknowledged += 1
+            if self.breaker.success():
+                logger.info("%s:%d is reachable again" % (self.HOST, self.PORT))
+
+            if kind == 'spool':
+                self.replay_acked.add(value[0])
+                self.forget_dropped()
+                while self.replaying and self.replaying[0] in self.replay_acked:
+                    position = self.replaying.popleft()
+                    self.replay_acked.discard(position)
+                    self.spool.commit(position)
+                if self.spool.empty() and not self.replaying:
+                    logger.info("spooled packets are sent")
+
+        for token, link_works in self.pipeline.expire():
+            self.packet_failed(token, 'no reply within %s seconds' % (self.pipeline.reply_timeout), link_works)
+
+    def forget_dropped(self):
+        """
+        Stops waiting for the spooled packets in flight that the spool dropped when it was full,
+        their acknowledgements have nothing left to commit.
+        """
+        while self.replaying and self.replaying[0] <= self.spool.committed:
+            self.replay_acked.discard(self.replaying.popleft())
+
+    def retry_due(self):
+        while self.may_send():
+            token = self.retries.pop_due()
+            if not token:
+                return
+            self.transmit(token)
+
+    def wait(self, timeout):
+        """
+        Waits until a message arrives in the mailbox or a reply from the node controller.
+        """
+        poller = zmq.Poller()
+        poller.register(queue_reader(self.mailbox_outgoing), zmq.POLLIN)
+        for mailbox in self.priority_mailboxes:
+            poller.register(queue_reader(mailbox), zmq.POLLIN)
+        if self.pipeline.socket:
+            poller.register(self.pipeline.socket, zmq.POLLIN)
+        start = time.monotonic()
+        poller.poll(int(timeout * 1000))
+        self.histograms['mailbox wait'].record(time.monotonic() - start)
+
+    def send_packet(self, pack, priority=False):
+        """
+        Sends a fresh packet right away if nothing is waiting in the spool, otherwise, or while
+        the breaker is open, appends it to the spool. A priority packet passes the spool. With a
+        full window this waits for acknowledgements.
+        """
+        if self.spool and not self.spool.empty() and not priority:
+            self.spool.append(pack)
+            return
+
+        while self.pipeline.in_flight and not self.may_send() and not self.breaker.is_open():
+            self.pipeline.socket.poll(int(self.pipeline.time_left() * 1000))
+            self.handle_replies()
+
+        if not self.may_send():
+            if self.spool:
+                self.spool.append(pack)
+            else:
+                self.retries.schedule(('live', pack, 0), delay=self.breaker.time_left())
+            return
+
+        self.transmit(('live', pack, 0))
+
+    def replay(self):
+        """
+        Fills the window with packets from the spool, for at most replay_budget seconds.
+        """
+        end = time.monotonic() + self.replay_budget
+        while not self.spool.empty() and self.may_send() and time.monotonic() < end:
+            entry = self.spool.read()
+            if entry is None:
+                # the rest of the spool was corrupt
+                break
+            position, pack = entry
+            self.replaying.append(position)
+            self.transmit(('spool', (position, pack), 0))
+
+    def close(self):
+        self.pipeline.close()
+        if self.spool:
+            self.spool.close()
+
+    def send_batch(self, batch, size, priority=False):
+        """
+        Sends messages as one packet. A single message goes out as before, several as a list
+        with msg_mi_type 'b'. The raw payload of a single message is compressed if that pays off,
+        its msg_mi_type then names the encoding, see lib/compression.py.
+        """
+        start = time.monotonic()
+        msg = {}
+        if len(batch) == 1:
+            encoding, msg['data'] = self.compressor.encode_data(batch[0], size, message_codec.message_sensor(batch[0]))
+            msg['msg_mi_type'] = MINOR_TYPES[encoding]
+        else:
+            self.compressor.count('none', size, size)
+            msg['data'] = batch
+            msg['msg_mi_type'] = 'b'
+        msg['msg_mj_type'] = 's'
+        built = time.monotonic()
+        self.histograms['compress'].record(built - start)
+
+        # Pass all the arguments collected from JSON type msg
+        packet = ""
+        try:
+            # make_packet() is a generator, the packets are built here
+            packet = list(packetmaker.make_packet(msg))
+        except Exception as e:
+            logger.error("could not make packet %s" % (str(e)))
+            return
+        self.histograms['packet build'].record(time.monotonic() - built)
+
+        for pack in packet:
+            self.send_packet(pack, priority)
+        logger.debug("Did pass %d messages on to the nodecontroller." % (len(batch)))
+
+    def next_timeout(self):
+        """
+        Seconds until the next round has to run even if nothing arrives.
+        """
+        timeout = self.blocking_timeout
+        time_lefts = [self.coalescer.time_left(), self.pipeline.time_left(), self.shaper.time_left()]
+        if self.may_send():
+            time_lefts.append(self.retries.time_left())
+            if self.spool and not self.spool.empty():
+                time_lefts.append(0)
+        elif self.breaker.is_open():
+            time_lefts.append(self.breaker.time_left())
+        for time_left in time_lefts:
+            if time_left is not None:
+                timeout = min(timeout, time_left)
+        return timeout
+
+    def decode(self, encoded):
+        """
+        Returns the message the router passed on, None if it cannot be decoded.
+        """
+        try:
+            data = message_codec.decode(encoded)
+        except Exception as e:
+            logger.error("could not decode message (%s): %s" % (str(type(e)), str(e)))
+            return None
+
+        # raw payloads arrive as a slice of the received buffer, packetmaker wants bytes.
+        # This is the only copy of the payload in this process.
+        if isinstance(data, dict) and isinstance(data.get('data'), memoryview):
+            data['data'] = data['data'].tobytes()
+        return data
+
+    def take_priority(self):
+        """
+        Sends the control and health messages ahead of the bulk data. They are neither shaped
+        nor coalesced and pass the packets waiting in the spool.
+        """
+        for mailbox in self.priority_mailboxes:
+            for i in range(self.intake_batch):
+                try:
+                    encoded = mailbox.get_nowait()
+                except queue.Empty:
                     break
-            logger.debug("Did send message to nodecontroller.")
+                data = self.decode(encoded)
+                if data is None:
+                    continue
+                self.priority_messages += 1
+                self.send_batch([data], len(encoded), priority=True)
+
+    def step(self):
+        """
+        One round: takes the replies, sends what is due and everything waiting in the mailboxes.
+        """
+        self.handle_replies()
+        self.retry_due()
+        self.take_priority()
+
+        # everything that is waiting is taken, a backlog in the spool must not slow down the intake
+        encoded_batch = self.shaper.release()
+        try:
+            for i in range(self.intake_batch):
+                encoded = self.mailbox_outgoing.get_nowait()
+                if self.shaper.buckets:
+                    try:
+                        source = message_codec.topic(encoded)[0]
+                    except Exception:
+                        source = ''
+                    encoded_batch.extend(self.shaper.admit(source, encoded))
+                else:
+                    encoded_batch.append(encoded)
+        except queue.Empty:
+            pass
+
+        for encoded in encoded_batch:
+            data = self.decode(encoded)
+            if data is None:
+                continue
+
+            self.coalescer.add(data, len(encoded))
+
+            if self.coalescer.ready():
+                self.send_batch(*self.coalescer.take())
+                # sending may have waited for the window, control and health messages that came
+                # in meanwhile go next
+                self.take_priority()
+
+        if self.coalescer.ready():
+            self.send_batch(*self.coalescer.take())
+
+        if self.spool:
+            self.replay()
+
+        self.maintain()
+        if self.dump_requested:
+            self.dump_latency()
+
+    def read_mailbox(self, name, man):
+
+        while man[name]:
+            self.wait(self.next_timeout())
+            self.step()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+    Stand-in for the push and pull servers of the node controller, so that the uplink
+    (system_send) and the downlink (system_receive) can be load tested on any Linux box.
+
+    push server (--push-port, 9090): a ROUTER socket that answers REQ and DEALER peers alike.
+        Every packet is acknowledged --latency milliseconds after it went through a link of
+        --bandwidth bytes per second. --loss drops packets without a reply, --reply-loss
+        drops only the reply (the packet counts as received and is sent again by system_send),
+        --reply none never acknowledges anything, like a hung node controller.
+    pull server (--pull-port, 9091): serves a backlog of --backlog waggle packets of
+        --message-size bytes addressed to --puid, after --latency and at --bandwidth. It
+        answers '<node id>' with one packet or 'False', and '<node id> <messages> <bytes>'
+        with up to that many packets followed by 'False'. --close-after-reply closes the
+        connection after every reply, like the old pull server.
+
+    Prints the counters of both servers every second. The packets of the pull server are made
+    with waggle.protocol (pywaggle), the push server needs pyzmq only.
+
+    To run the plugin manager against it:
+        ./scripts/node_controller_standin.py --config-dir /tmp/waggle-standin --backlog 10000
+        ./plugin_manager.py --config-dir /tmp/waggle-standin
+
+    usage: ./scripts/node_controller_standin.py [--latency MS] [--loss P] [--reply-loss P]
+                                                [--bandwidth BYTES_PER_SEC] [--reply ok|none]
+                                                [--backlog N] [--message-size BYTES] [--puid HEX]
+                                                [--close-after-reply] [--config-dir DIR]
+                                                [--duration SEC]
+"""
+import argparse
+import collections
+import heapq
+import os
+import random
+import socketserver
+import threading
+import time
+
+import zmq
+
+
+class link(object):
+    """
+        A link of bandwidth bytes per second (0: unlimited) and latency seconds. Returns when
+        data sent over it arrives.
+    """
+
+    def __init__(self, bandwidth, latency):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.free = 0
+        self.lock = threading.Lock()
+
+    def arrival(self, size):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.free)
+            if self.bandwidth:
+                self.free = start + float(size) / self.bandwidth
+            else:
+                self.free = start
+            return self.free + self.latency
+
+
+class push_server(object):
+
+    def __init__(self, args, counters):
+        self.args = args
+        self.counters = counters
+        self.link = link(args.bandwidth, args.latency / 1000.0)
+
+    def run(self, stop):
+        context = zmq.Context()
+        server = context.socket(zmq.ROUTER)
+        server.bind('tcp://%s:%d' % (self.args.host, self.args.push_port))
+
+        # (due, sequence number, reply frames)
+        replies = []
+        sequence = 0
+        while not stop.is_set():
+            timeout = 100
+            if replies:
+                timeout = max(0, int((replies[0][0] - time.monotonic()) * 1000))
+            if server.poll(timeout):
+                frames = server.recv_multipart()
+                if random.random() < self.args.loss:
+                    self.counters['push lost'] += 1
+                    continue
+                self.counters['push packets'] += 1
+                self.counters['push bytes'] += len(frames[-1])
+                due = self.link.arrival(len(frames[-1]))
+                if self.args.reply == 'none' or random.random() < self.args.reply_loss:
+                    self.counters['push replies lost'] += 1
+                    continue
+                sequence += 1
+                heapq.heappush(replies, (due, sequence, frames[:-1] + [b'ok']))
+            while replies and replies[0][0] <= time.monotonic():
+                server.send_multipart(heapq.heappop(replies)[2])
+        server.close()
+        context.term()
+
+
+class pull_handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        standin = self.server
+        while not standin.stop.is_set():
+            try:
+                request = self.request.recv(256)
+            except OSError:
+                return
+            if not request:
+                return
+            fields = request.decode('iso-8859-1').split()
+            standin.counters['pull requests'] += 1
+
+            max_messages, max_bytes = 1, 0
+            batch = len(fields) == 3
+            if batch:
+                max_messages, max_bytes = int(fields[1]), int(fields[2])
+
+            packets = standin.take(max_messages, max_bytes)
+            reply = b''.join(packets)
+            if batch or not packets:
+                reply += b'False'
+
+            delay = standin.link.arrival(len(reply)) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.request.sendall(reply)
+            except OSError:
+                standin.give_back(packets)
+                return
+            standin.counters['pull messages'] += len(packets)
+            standin.counters['pull bytes'] += len(reply)
+            if standin.args.close_after_reply:
+                return
+
+
+class pull_server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, args, counters, stop):
+        self.args = args
+        self.counters = counters
+        self.stop = stop
+        self.link = link(args.bandwidth, args.latency / 1000.0)
+        self.lock = threading.Lock()
+        self.backlog = collections.deque(self.make_backlog(args.backlog, args.message_size, args.puid))
+        self.drained = None
+        socketserver.TCPServer.__init__(self, (args.host, args.pull_port), pull_handler)
+
+    def make_backlog(self, count, size, puid):
+        if not count:
+            return []
+        from waggle.protocol.PacketHandler import pack
+        header = {'msg_mj_type': ord('r'), 'msg_mi_type': ord('d'), 'r_puid': int(puid, 16)}
+        packets = []
+        for i in range(count):
+            data = ('%d ' % (i)).encode('iso-8859-1')
+            data += b'x' * max(0, size - len(data))
+            packets.extend(pack(header, data))
+        return packets
+
+    def take(self, max_messages, max_bytes):
+        """
+            Takes up to max_messages packets of at most max_bytes bytes in all off the backlog,
+            at least one if there is one.
+        """
+        packets = []
+        size = 0
+        with self.lock:
+            while self.backlog and len(packets) < max_messages:
+                if packets and max_bytes and size + len(self.backlog[0]) > max_bytes:
+                    break
+                packet = self.backlog.popleft()
+                packets.append(packet)
+                size += len(packet)
+            if not self.backlog and packets and self.drained is None:
+                self.drained = time.monotonic()
+        return packets
+
+    def give_back(self, packets):
+        with self.lock:
+            self.backlog.extendleft(reversed(packets))
+
+
+def write_config(directory, host, node_id):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, 'node_controller_host'), 'w') as f:
+        f.write('%s\n' % (host))
+    with open(os.path.join(directory, 'node_id'), 'w') as f:
+        f.write('%s\n' % (node_id))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--push-port', type=int, default=9090)
+    parser.add_argument('--pull-port', type=int, default=9091)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds until a reply')
+    parser.add_argument('--bandwidth', type=int, default=0, help='bytes per second of each direction, 0 is unlimited')
+    parser.add_argument('--loss', type=float, default=0, help='fraction of uplink packets that are lost')
+    parser.add_argument('--reply-loss', type=float, default=0, help='fraction of uplink acknowledgements that are lost')
+    parser.add_argument('--reply', default='ok', choices=['ok', 'none'], help='none: never acknowledge uplink packets')
+    parser.add_argument('--backlog', type=int, default=0, help='messages queued for the node')
+    parser.add_argument('--message-size', type=int, default=256, help='bytes of data of every queued message')
+    parser.add_argument('--puid', default='00000001', help='r_puid of the queued messages, see plugins/puidlist.txt')
+    parser.add_argument('--close-after-reply', action='store_true', help='close pull connections after every reply')
+    parser.add_argument('--config-dir', help='write node_controller_host and node_id for WAGGLE_CONFIG_DIR / --config-dir here')
+    parser.add_argument('--node-id', default='0000000000000001', help='node id written to the config dir')
+    parser.add_argument('--duration', type=float, default=0, help='seconds to run, 0 until interrupted')
+    args = parser.parse_args()
+
+    if args.config_dir:
+        write_config(args.config_dir, args.host, args.node_id)
+        print('config in %s, run ./plugin_manager.py --config-dir %s' % (args.config_dir, args.config_dir))
+
+    counters = collections.Counter()
+    stop = threading.Event()
+
+    push = push_server(args, counters)
+    push_thread = threading.Thread(target=push.run, args=(stop,))
+    push_thread.start()
+
+    pull = pull_server(args, counters, stop)
+    pull_thread = threading.Thread(target=pull.serve_forever, args=(0.1,))
+    pull_thread.start()
+
+    names = ['push packets', 'push bytes', 'push lost', 'push replies lost', 'pull requests', 'pull messages', 'pull bytes']
+    print('%8s %s %10s' % ('time', ' '.join(['%17s' % (x) for x in names]), 'backlog'))
+    start = time.monotonic()
+    try:
+        while not args.duration or time.monotonic() - start < args.duration:
+            time.sleep(1)
+            print('%8.0f %s %10d' % (time.monotonic() - start, ' '.join(['%17d' % (counters[x]) for x in names]), len(pull.backlog)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        pull.shutdown()
+        pull.server_close()
+        push_thread.join()
+
+    if pull.drained is not None:
+        print('backlog of %d messages sent after %.2f s' % (args.backlog, pull.drained - start))
+
+
+if __name__ == '__main__':
+    main()
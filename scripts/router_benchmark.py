@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+    End-to-end benchmark of the path mailbox_outgoing -> system_router -> listener queues.
+
+    Starts N synthetic producer plugins and system_router through plugin_runner, attaches
+    M listeners (the first one on the system_send queue) and reports per listener
+    throughput, p50/p99/p999 latency and the CPU time of every process.
+
+    It runs hermetically: the /etc/waggle files are stubbed in a temporary directory
+    (WAGGLE_CONFIG_DIR). With --with-send the real system_send process consumes the
+    system_send queue and talks to a local stand-in for the node controller push server,
+    this needs pyzmq and pywaggle.
+
+    usage: ./scripts/router_benchmark.py [--producers N] [--listeners M] [--size BYTES]
+                                         [--rate MSGS_PER_SEC] [--duration SEC] [--ring]
+"""
+import argparse
+import functools
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import types
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+config_dir = tempfile.mkdtemp(prefix='waggle-benchmark-')
+with open(os.path.join(config_dir, 'node_controller_host'), 'w') as f:
+    f.write('127.0.0.1\n')
+with open(os.path.join(config_dir, 'node_id'), 'w') as f:
+    f.write('0000000000000001\n')
+os.environ['WAGGLE_CONFIG_DIR'] = config_dir
+
+# plugins are looked up relative to the working directory
+os.chdir(repo_dir)
+sys.path.insert(0, repo_dir)
+
+import psutil
+import plugins
+import lib.run_plugins_multi
+import lib.ring_buffer
+from lib import message_codec
+
+
+def producer(name, man, mailbox, size, rate, duration):
+    """
+        A synthetic plugin, sends messages of the given size at the given rate (0: as fast as
+        possible) for the given time and then idles until it is stopped.
+    """
+    man[name] = 1
+    payload = bytes(size)
+    interval = 0
+    if rate:
+        interval = 1.0 / rate
+
+    start = time.monotonic()
+    next_send = start
+    while time.monotonic() < start + duration:
+        if interval:
+            next_send += interval
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        mailbox.put({'sensor': 'benchmark', 'data': payload, 'sent': time.monotonic()})
+
+    while man[name]:
+        time.sleep(0.1)
+
+
+def sink(listener_queue, results):
+    """
+        A listener, records the latency of every message until it gets an empty message.
+    """
+    latencies = []
+    first = last = None
+    while True:
+        data = listener_queue.get()
+        now = time.monotonic()
+        if not data:
+            break
+        msg = message_codec.decode(data)
+        latencies.append(now - msg['sent'])
+        if first is None:
+            first = now
+        last = now
+    results.put((os.getpid(), latencies, first, last))
+
+
+def node_controller_standin(port, stop):
+    """
+        Minimal push server, accepts and acknowledges packets.
+    """
+    import zmq
+    context = zmq.Context()
+    server = context.socket(zmq.REP)
+    server.bind('tcp://127.0.0.1:%d' % (port))
+    server.setsockopt(zmq.RCVTIMEO, 100)
+    while not stop.is_set():
+        try:
+            server.recv()
+        except zmq.error.Again:
+            continue
+        server.send(b'ok')
+    server.close()
+    context.term()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def cpu_seconds(pids):
+    times = {}
+    for name in pids:
+        try:
+            t = psutil.Process(pids[name]).cpu_times()
+            times[name] = t.user + t.system
+        except psutil.NoSuchProcess:
+            times[name] = 0
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--producers', type=int, default=4, help='number of synthetic plugins')
+    parser.add_argument('--listeners', type=int, default=2, help='number of listeners, the first is on the system_send queue')
+    parser.add_argument('--size', type=int, default=256, help='payload size in bytes')
+    parser.add_argument('--rate', type=int, default=0, help='messages per second per producer, 0 for as fast as possible')
+    parser.add_argument('--duration', type=float, default=10, help='seconds the producers send')
+    parser.add_argument('--maxsize', type=int, default=1000, help='bound of the listener queues')
+    parser.add_argument('--policy', default='block', help='overflow policy of the listener queues')
+    parser.add_argument('--ring', action='store_true', help='producers use the shared memory transport')
+    parser.add_argument('--with-send', action='store_true', help='run system_send against a local node controller stand-in')
+    args = parser.parse_args()
+
+    producer_names = ['benchmark_%d' % (i) for i in range(args.producers)]
+    for name in producer_names:
+        register = functools.partial(producer, size=args.size, rate=args.rate, duration=args.duration)
+        setattr(plugins, name, types.SimpleNamespace(register=register))
+        plugins.__all__.append(name)
+
+    ring_buffer_plugins = []
+    if args.ring:
+        if not lib.ring_buffer.supported():
+            parser.error('the ring buffer is not safe on %s' % (platform.machine()))
+        ring_buffer_plugins = producer_names
+    # the router blocks on the listener queues themselves
+    client_maxsize = 0
+    if args.policy == 'block':
+        client_maxsize = args.maxsize
+    plug = lib.run_plugins_multi.plugin_runner(ring_buffer_plugins=ring_buffer_plugins, max_log_listeners=args.listeners, system_send_maxsize=args.maxsize,
+        client_maxsize=client_maxsize)
+
+    stop_standin = threading.Event()
+    if args.with_send:
+        standin = threading.Thread(target=node_controller_standin, args=(9090, stop_standin))
+        standin.start()
+
+    results = multiprocessing.Queue()
+    pids = {}
+    sinks = []
+    for i in range(args.listeners):
+        if i == 0 and args.with_send:
+            status, message = plug.start_plugin('system_send')
+            pids['system_send'] = plug.plugin_pid('system_send')
+            continue
+        queue_name = 'system_send' if i == 0 else 'client-%d' % (i)
+        listener_queue = plug.listener_queues[queue_name]
+        p = multiprocessing.Process(name='listener_%d' % (i), target=sink, args=(listener_queue, results))
+        p.start()
+        status, message = plug.add_listener(queue_name, queue_name, p.pid, maxsize=args.maxsize, policy=args.policy)
+        if not status:
+            p.terminate()
+            parser.error(message)
+        pids[queue_name] = p.pid
+        sinks.append((queue_name, listener_queue, p))
+
+    plug.start_plugin('system_router')
+    pids['system_router'] = plug.plugin_pid('system_router')
+
+    for name in producer_names:
+        plug.start_plugin(name)
+        pids[name] = plug.plugin_pid(name)
+
+    cpu_start = cpu_seconds(pids)
+    start = time.monotonic()
+    time.sleep(args.duration)
+
+    # wait until the router has delivered everything
+    while not all(q.empty() for name, q, p in sinks) or not plug.mailbox_outgoing.empty() or not all(r.empty() for r in plug.ring_buffers.values()):
+        time.sleep(0.1)
+    time.sleep(0.5)
+    elapsed = time.monotonic() - start
+    cpu_end = cpu_seconds(pids)
+
+    for name, listener_queue, p in sinks:
+        listener_queue.put(b'')
+    collected = {}
+    for i in range(len(sinks)):
+        pid, latencies, first, last = results.get()
+        collected[pid] = (latencies, first, last)
+
+    print('%d producers x %s msgs/s, %d bytes, %s transport, %d listeners (maxsize %d, %s)' % (
+        args.producers, args.rate or 'max', args.size, 'ring' if args.ring else 'queue', args.listeners, args.maxsize, args.policy))
+    print()
+    print('%-14s %10s %10s %10s %10s %10s' % ('listener', 'messages', 'msgs/s', 'p50 ms', 'p99 ms', 'p999 ms'))
+    for name, listener_queue, p in sinks:
+        latencies, first, last = collected[p.pid]
+        latencies.sort()
+        rate = 0
+        if latencies and last > first:
+            rate = len(latencies) / (last - first)
+        print('%-14s %10d %10.0f %10.2f %10.2f %10.2f' % (name, len(latencies), rate,
+            percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3, percentile(latencies, 0.999) * 1e3))
+    print()
+    print('%-14s %10s %10s' % ('process', 'cpu s', 'cpu %'))
+    for name in sorted(pids):
+        used = cpu_end[name] - cpu_start[name]
+        print('%-14s %10.2f %10.1f' % (name, used, 100.0 * used / elapsed))
+
+    plug.stop_all()
+    for name, listener_queue, p in sinks:
+        p.join(1)
+    stop_standin.set()
+
+
+if __name__ == '__main__':
+    main()
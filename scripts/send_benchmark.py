@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+    Benchmark of the uplink socket of system_send against a local stand-in for the node
+    controller push server, in its own process. The stand-in acknowledges every packet
+    after --latency milliseconds, like a node controller at the other end of a slow link.
+
+    reconnect: what system_send did before, a new context and REQ socket per packet that
+               is closed right after sending, without waiting for the reply.
+    persistent: lib.zmq_connection, one socket for all packets, every packet is acknowledged
+               before the next is sent.
+    pipelined: lib.zmq_pipeline, up to --window packets wait for their acknowledgement.
+
+    Reports the packets per second that arrived at the stand-in. Needs pyzmq.
+
+    usage: ./scripts/send_benchmark.py [--mode reconnect|persistent|pipelined|all] [--size BYTES]
+                                       [--duration SEC] [--latency MS] [--window N]
+"""
+import argparse
+import heapq
+import multiprocessing
+import os
+import sys
+import time
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repo_dir)
+
+import zmq
+from lib.zmq_connection import zmq_connection, zmq_pipeline
+
+
+def node_controller_standin(port, latency, received, ready, stop):
+    """
+        Minimal push server, accepts and counts packets and acknowledges every packet latency
+        seconds after it arrived. A ROUTER socket answers REQ and DEALER peers alike.
+    """
+    context = zmq.Context()
+    server = context.socket(zmq.ROUTER)
+    server.bind('tcp://127.0.0.1:%d' % (port))
+    ready.set()
+
+    # (due, sequence number, reply frames)
+    replies = []
+    sequence = 0
+    while not stop.is_set():
+        timeout = 100
+        if replies:
+            timeout = max(0, int((replies[0][0] - time.monotonic()) * 1000))
+        if server.poll(timeout):
+            frames = server.recv_multipart()
+            with received.get_lock():
+                received.value += 1
+            sequence += 1
+            heapq.heappush(replies, (time.monotonic() + latency, sequence, frames[:-1] + [b'ok']))
+        while replies and replies[0][0] <= time.monotonic():
+            server.send_multipart(heapq.heappop(replies)[2])
+    server.close()
+    context.term()
+
+
+def send_reconnect(port, packet, duration):
+    end = time.monotonic() + duration
+    sent = 0
+    while time.monotonic() < end:
+        context = zmq.Context()
+        socket = context.socket(zmq.REQ)
+        socket.connect('tcp://127.0.0.1:%d' % (port))
+        socket.send(packet)
+        socket.close()
+        sent += 1
+    return sent
+
+
+def send_persistent(port, packet, duration):
+    connection = zmq_connection('127.0.0.1', port)
+    end = time.monotonic() + duration
+    sent = 0
+    while time.monotonic() < end:
+        connection.request(packet)
+        sent += 1
+    connection.close()
+    return sent
+
+
+def send_pipelined(port, packet, duration, window):
+    pipeline = zmq_pipeline('127.0.0.1', port, window)
+    end = time.monotonic() + duration
+    sent = 0
+    while time.monotonic() < end:
+        while not pipeline.has_room():
+            pipeline.socket.poll(1000)
+            pipeline.receive()
+        pipeline.send(packet)
+        sent += 1
+    pipeline.close()
+    return sent
+
+
+def run(mode, port, size, duration, latency, window):
+    received = multiprocessing.Value('L', 0)
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    server = multiprocessing.Process(target=node_controller_standin, args=(port, latency, received, ready, stop))
+    server.start()
+    ready.wait()
+
+    packet = bytes(size)
+    start = time.monotonic()
+    if mode == 'reconnect':
+        sent = send_reconnect(port, packet, duration)
+    elif mode == 'persistent':
+        sent = send_persistent(port, packet, duration)
+    else:
+        sent = send_pipelined(port, packet, duration, window)
+    elapsed = time.monotonic() - start
+
+    # packets still on their way
+    time.sleep(1)
+    stop.set()
+    server.join()
+
+    print('%-12s %10d %10d %10.0f' % (mode, sent, received.value, received.value / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', default='all', choices=['reconnect', 'persistent', 'pipelined', 'all'])
+    parser.add_argument('--size', type=int, default=512, help='packet size in bytes')
+    parser.add_argument('--duration', type=float, default=5, help='seconds to send')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds until the stand-in acknowledges a packet')
+    parser.add_argument('--window', type=int, default=16, help='packets in flight in pipelined mode')
+    parser.add_argument('--port', type=int, default=19090, help='port of the node controller stand-in')
+    args = parser.parse_args()
+
+    modes = [args.mode]
+    if args.mode == 'all':
+        modes = ['reconnect', 'persistent', 'pipelined']
+
+    print('%d byte packets, %.0f s, %.0f ms latency, window %d' % (args.size, args.duration, args.latency, args.window))
+    print()
+    print('%-12s %10s %10s %10s' % ('mode', 'sent', 'received', 'packets/s'))
+    for mode in modes:
+        run(mode, args.port, args.size, args.duration, args.latency / 1000.0, args.window)
+
+
+if __name__ == '__main__':
+    main()
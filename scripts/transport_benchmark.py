@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+    Compares the two ways a plugin can hand messages to the router: the common
+    multiprocessing.Queue (mailbox_outgoing) and the shared memory ring buffer.
+
+    One producer process sends messages, the consumer does what the router does
+    with them: it takes the encoded messages off the queue or out of the ring. Reports throughput for an unpaced run and latency percentiles for a
+    paced run.
+
+    usage: ./scripts/transport_benchmark.py [--count N] [--size BYTES] [--rate MSGS_PER_SEC]
+"""
+import argparse
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import message_codec
+from lib.ring_buffer import ring_buffer
+from lib.plugin_mailbox import plugin_mailbox
+
+
+def producer(transport, count, size, rate):
+    mailbox = plugin_mailbox('benchmark', transport)
+    payload = bytes(size)
+    interval = 0
+    if rate:
+        interval = 1.0 / rate
+    next_send = time.monotonic()
+    for i in range(count):
+        if interval:
+            next_send += interval
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        mailbox.put({'sent': time.monotonic(), 'data': payload})
+    mailbox.put(None)
+
+
+def consume_queue(mailbox):
+    received = []
+    while True:
+        data = mailbox.get()
+        now = time.monotonic()
+        msg = message_codec.decode(data)
+        if msg is None:
+            return received
+        received.append((msg['sent'], now))
+
+
+def consume_ring(ring):
+    received = []
+    while True:
+        if ring.empty():
+            multiprocessing.connection.wait([ring], 0.05)
+        ring.clear_wakeup()
+        for data in ring.get_batch(64):
+            now = time.monotonic()
+            msg = message_codec.decode(data)
+            if msg is None:
+                return received
+            received.append((msg['sent'], now))
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(transport, count, size, rate):
+    if transport == 'queue':
+        mailbox = multiprocessing.Queue()
+        consume = consume_queue
+    else:
+        mailbox = ring_buffer()
+        consume = consume_ring
+
+    p = multiprocessing.Process(target=producer, args=(mailbox, count, size, rate))
+    p.start()
+    received = consume(mailbox)
+    p.join()
+
+    elapsed = received[-1][1] - received[0][0]
+    latencies = sorted(now - sent for sent, now in received)
+    return {
+        'msgs/s': len(received) / elapsed,
+        'p50': percentile(latencies, 0.5) * 1e6,
+        'p99': percentile(latencies, 0.99) * 1e6,
+        'p999': percentile(latencies, 0.999) * 1e6,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100000, help='messages per run')
+    parser.add_argument('--size', type=int, default=64, help='payload size in bytes')
+    parser.add_argument('--rate', type=int, default=1000, help='messages per second for the latency run')
+    args = parser.parse_args()
+
+    print('%-6s %-10s %12s %10s %10s %10s' % ('', 'transport', 'msgs/s', 'p50 us', 'p99 us', 'p999 us'))
+    for mode, rate in (('burst', 0), ('paced', args.rate)):
+        count = args.count
+        if rate:
+            count = min(args.count, rate * 10)
+        for transport in ('queue', 'ring'):
+            r = run(transport, count, args.size, rate)
+            print('%-6s %-10s %12.0f %10.1f %10.1f %10.1f' % (mode, transport, r['msgs/s'], r['p50'], r['p99'], r['p999']))
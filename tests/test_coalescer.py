@@ -0,0 +1,78 @@
+import unittest
+from unittest import mock
+
+from lib.coalescer import coalescer
+
+
+class clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class test_coalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock()
+        patcher = mock.patch('lib.coalescer.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_size_threshold(self):
+        c = coalescer(10, 100)
+        c.add('a', 60)
+        self.assertFalse(c.ready())
+        c.add('b', 40)
+        self.assertTrue(c.ready())
+        self.assertEqual(c.take(), (['a', 'b'], 100))
+        self.assertFalse(c.ready())
+
+    def test_linger_expiry(self):
+        c = coalescer(0.5, 8192)
+        c.add('a', 10)
+        self.clock.now += 0.2
+        c.add('b', 10)
+        self.assertFalse(c.ready())
+        # the linger counts from the oldest message
+        self.clock.now += 0.3
+        self.assertTrue(c.ready())
+
+    def test_linger_zero_sends_every_message(self):
+        c = coalescer(0, 8192)
+        c.add('a', 10)
+        self.assertTrue(c.ready())
+        self.assertEqual(c.time_left(), 0)
+
+    def test_time_left(self):
+        c = coalescer(0.5, 8192)
+        self.assertIsNone(c.time_left())
+        c.add('a', 10)
+        self.clock.now += 0.2
+        self.assertAlmostEqual(c.time_left(), 0.3)
+        self.clock.now += 1
+        self.assertEqual(c.time_left(), 0)
+        c.take()
+        self.assertIsNone(c.time_left())
+
+    def test_batch_size_counters(self):
+        c = coalescer(0, 8192)
+        for count in [1, 1, 2, 3, 4, 5, 8]:
+            for i in range(count):
+                c.add(i, 10)
+            c.take()
+        stats = c.get_stats()
+        self.assertEqual(stats['batches'], 7)
+        self.assertEqual(stats['messages'], 24)
+        self.assertEqual(stats['bytes'], 240)
+        self.assertEqual(stats['messages per batch'], 3.4)
+        self.assertEqual(stats['batches of 1'], 2)
+        self.assertEqual(stats['batches of 2'], 1)
+        self.assertEqual(stats['batches of 3-4'], 2)
+        self.assertEqual(stats['batches of 5-8'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import unittest
+
+from lib.compression import compressor, decode_data, MINOR_TYPES
+
+
+TEXT = b'boot 2026-10-18 12:00:00 shutdown 2026-10-18 13:00:00\n' * 200
+
+
+class test_compression(unittest.TestCase):
+
+    def round_trip(self, c, data, key=''):
+        """
+            Encodes data like system_send and decodes it like the node controller, from the minor
+            type in the header.
+        """
+        encoding, encoded = c.encode_data(data, 0, key)
+        return encoding, decode_data(MINOR_TYPES[encoding], encoded)
+
+    def test_round_trip(self):
+        for mode in ['none', 'zlib', 'lzma']:
+            c = compressor(mode)
+            encoding, decoded = self.round_trip(c, {'sensor': 'history', 'data': TEXT})
+            self.assertEqual(encoding, mode)
+            self.assertEqual(decoded, {'sensor': 'history', 'data': TEXT})
+
+            encoding, decoded = self.round_trip(c, TEXT)
+            self.assertEqual(encoding, mode)
+            self.assertEqual(decoded, TEXT)
+
+    def test_minor_type_as_code(self):
+        c = compressor('zlib')
+        encoding, encoded = c.encode_data(TEXT, 0)
+        self.assertEqual(decode_data(ord('z'), encoded), TEXT)
+
+    def test_adaptive_picks_by_size(self):
+        c = compressor('adaptive', min_size=256, lzma_min_size=65536)
+        self.assertEqual(c.encode_data(b'x' * 100, 0)[0], 'none')
+        self.assertEqual(c.encode_data(b'x' * 1000, 0)[0], 'zlib')
+        self.assertEqual(c.encode_data(b'x' * 100000, 0)[0], 'lzma')
+
+    def test_only_raw_payloads_compressed(self):
+        c = compressor('zlib')
+        data = {'sensor': 'services', 'data': ['service'] * 1000}
+        self.assertEqual(c.encode_data(data, 8000), ('none', data))
+
+    def test_lookalike_data_left_alone(self):
+        # uncompressed data that looks like the old wrapper is not touched by the decoder
+        data = {'encoding': 'zlib', 'data': b'not compressed'}
+        self.assertEqual(decode_data('d', data), data)
+
+    def test_backs_off_and_probes(self):
+        c = compressor('adaptive', min_saving=0.1, probe_interval=5)
+        noise = os.urandom(4096)
+        # the first try shows that the key does not compress
+        self.assertEqual(c.encode_data(noise, 0, 'camera')[0], 'none')
+        self.assertEqual(c.counters['zlib'][0], 0)
+        for i in range(4):
+            c.encode_data(noise, 0, 'camera')
+        self.assertEqual(c.ratios['camera'][1], 4)
+        # the fifth skipped message is a probe, it resets the counter
+        c.encode_data(noise, 0, 'camera')
+        self.assertEqual(c.ratios['camera'][1], 0)
+
+        # other keys are not affected
+        self.assertEqual(c.encode_data(TEXT, 0, 'history')[0], 'zlib')
+
+    def test_bytes_saved(self):
+        c = compressor('zlib')
+        encoding, encoded = c.encode_data(TEXT, 0)
+        c.encode_data({'sensor': 'gps', 'data': 'not raw'}, 50)
+        stats = c.get_stats()
+        self.assertEqual(stats['bytes saved'], len(TEXT) - len(encoded))
+        self.assertEqual(stats['zlib messages'], 1)
+        self.assertEqual(stats['none messages'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
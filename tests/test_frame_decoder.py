@@ -0,0 +1,98 @@
+import struct
+import unittest
+
+from lib.frame_decoder import frame_decoder
+
+
+HEADER = struct.Struct('!I')
+SENTINEL = b'False'
+
+
+def make_frame(body):
+    return HEADER.pack(len(body)) + body + b'\xee\xee'
+
+
+class chunked_socket(object):
+    """
+        Hands out a byte stream in the given pieces, one per recv_into().
+    """
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        n = min(len(chunk), len(view))
+        view[:n] = chunk[:n]
+        if n < len(chunk):
+            self.chunks.insert(0, chunk[n:])
+        return n
+
+
+class test_frame_decoder(unittest.TestCase):
+
+    def make_decoder(self, **kwargs):
+        return frame_decoder(HEADER.size, 2, lambda header: HEADER.unpack(bytes(header))[0], SENTINEL, **kwargs)
+
+    def decode(self, decoder, sock):
+        """
+            Returns the frames and sentinels of the stream, frames copied to bytes.
+        """
+        results = []
+        while True:
+            item = decoder.next_frame()
+            if item is None:
+                if not decoder.recv_from(sock):
+                    return results
+                continue
+            results.append(item if item is SENTINEL else bytes(item))
+
+    def test_frame_split_over_reads(self):
+        frame = make_frame(b'payload' * 100)
+        sock = chunked_socket([frame[i:i + 3] for i in range(0, len(frame), 3)])
+        self.assertEqual(self.decode(self.make_decoder(), sock), [frame])
+
+    def test_frames_coalesced_in_one_read(self):
+        frames = [make_frame(b'%d' % (i) * i) for i in range(20)]
+        sock = chunked_socket([b''.join(frames) + SENTINEL])
+        self.assertEqual(self.decode(self.make_decoder(), sock), frames + [SENTINEL])
+
+    def test_sentinel_split_over_reads(self):
+        frame = make_frame(b'abc')
+        sock = chunked_socket([frame + b'Fa', b'l', b'se'])
+        decoder = self.make_decoder()
+        self.assertEqual(self.decode(decoder, sock), [frame, SENTINEL])
+        self.assertEqual(decoder.sentinels, 1)
+
+    def test_frame_larger_than_buffer(self):
+        frame = make_frame(b'x' * 100000)
+        sock = chunked_socket([frame[i:i + 4096] for i in range(0, len(frame), 4096)])
+        decoder = self.make_decoder(initial_size=1024)
+        self.assertEqual(self.decode(decoder, sock), [frame])
+        self.assertGreaterEqual(len(decoder.buffer), len(frame))
+
+    def test_oversized_frame_rejected(self):
+        sock = chunked_socket([make_frame(b'x' * 1000)])
+        decoder = self.make_decoder(max_frame=100)
+        with self.assertRaises(ValueError):
+            self.decode(decoder, sock)
+
+    def test_corrupt_sentinel_rejected(self):
+        sock = chunked_socket([b'Fals!'])
+        with self.assertRaises(ValueError):
+            self.decode(self.make_decoder(), sock)
+
+    def test_reset_drops_partial_frame(self):
+        frame = make_frame(b'abcdef')
+        decoder = self.make_decoder()
+        decoder.recv_from(chunked_socket([frame[:5]]))
+        self.assertIsNone(decoder.next_frame())
+        decoder.reset()
+        self.assertEqual(decoder.pending(), 0)
+        self.assertEqual(self.decode(decoder, chunked_socket([frame])), [frame])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+from lib.histogram import histogram, percentile, summary, BUCKETS
+
+
+def bucket_of(seconds):
+    h = histogram()
+    h.record(seconds)
+    return h.counts.index(1)
+
+
+class test_histogram(unittest.TestCase):
+
+    def test_bucket_boundaries(self):
+        # bucket i holds what is less than 2^i microseconds and not in bucket i - 1
+        self.assertEqual(bucket_of(0), 0)
+        self.assertEqual(bucket_of(0.0000009), 0)
+        self.assertEqual(bucket_of(0.000001), 1)
+        self.assertEqual(bucket_of(0.000002), 2)
+        self.assertEqual(bucket_of(0.000003), 2)
+        self.assertEqual(bucket_of(0.000004), 3)
+        self.assertEqual(bucket_of(0.001023), 10)
+        self.assertEqual(bucket_of(0.001024), 11)
+        self.assertEqual(bucket_of(1.0), 20)
+
+    def test_last_bucket(self):
+        self.assertEqual(bucket_of(2 ** 30 / 1000000.0), BUCKETS - 1)
+        self.assertEqual(bucket_of(86400 * 365), BUCKETS - 1)
+
+    def test_totals(self):
+        h = histogram()
+        for seconds in [0.001, 0.002, 0.003]:
+            h.record(seconds)
+        snapshot = h.snapshot()
+        self.assertEqual(snapshot['count'], 3)
+        self.assertAlmostEqual(snapshot['total'], 0.006)
+        self.assertEqual(snapshot['max'], 0.003)
+        self.assertEqual(sum(snapshot['counts']), 3)
+
+        # a snapshot is not changed by later records
+        h.record(1)
+        self.assertEqual(snapshot['count'], 3)
+
+    def test_percentiles(self):
+        h = histogram()
+        # 90 of 100 take about 100 us (bucket 7, up to 128 us), 9 about 1 ms (bucket 10, up to
+        # 1024 us), one 50 ms
+        for i in range(90):
+            h.record(0.0001)
+        for i in range(9):
+            h.record(0.001)
+        h.record(0.05)
+        snapshot = h.snapshot()
+
+        self.assertEqual(percentile(snapshot, 0.5), 0.000128)
+        self.assertEqual(percentile(snapshot, 0.9), 0.000128)
+        self.assertEqual(percentile(snapshot, 0.95), 0.001024)
+        self.assertEqual(percentile(snapshot, 0.99), 0.001024)
+        # the upper bound of the bucket is capped at the largest latency seen
+        self.assertEqual(percentile(snapshot, 1.0), 0.05)
+
+    def test_percentile_within_factor_two(self):
+        h = histogram()
+        for seconds in [0.0003, 0.0007, 0.005, 0.02, 0.3]:
+            for i in range(10):
+                h.record(seconds)
+            p = percentile(h.snapshot(), 1.0)
+            self.assertTrue(seconds <= p < 2 * seconds)
+
+    def test_empty(self):
+        snapshot = histogram().snapshot()
+        self.assertEqual(percentile(snapshot, 0.99), 0.0)
+        self.assertEqual(summary(snapshot), [0, 0.0, 0.0, 0.0, 0.0, 0.0])
+
+    def test_summary(self):
+        h = histogram()
+        for i in range(99):
+            h.record(0.0001)
+        h.record(0.01)
+        # count, mean, p50, p90, p99 and max in milliseconds
+        self.assertEqual(summary(h.snapshot()), [100, 0.199, 0.128, 0.128, 0.128, 10.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import queue
+import shutil
+import tempfile
+import unittest
+
+import lib.config
+
+try:
+    from plugins.system_receive.system_receive import system_receive, puid_key
+except ImportError:
+    # system_receive unpacks packets with waggle.protocol (pywaggle)
+    system_receive = None
+
+
+@unittest.skipIf(system_receive is None, 'waggle.protocol is not installed')
+class test_receive_routing(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, value in [('node_controller_host', '127.0.0.1'), ('node_id', '0000000000000001')]:
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write(value + '\n')
+        self.config_dir = lib.config.config_dir
+        lib.config.config_dir = self.directory
+
+        self.gps = queue.Queue()
+        self.camera = queue.Queue(maxsize=1)
+        routes = {'0000002a': {'plugin': 'gps', 'queue': self.gps}, '0000abcd': {'plugin': 'camera', 'queue': self.camera}}
+        self.stats = {}
+        self.receiver = system_receive('system_receive', {}, routes, self.stats)
+
+    def tearDown(self):
+        lib.config.config_dir = self.config_dir
+        shutil.rmtree(self.directory)
+
+    def test_puid_key(self):
+        self.assertEqual(puid_key(42), '0000002a')
+        self.assertEqual(puid_key(b'\x00\x00\x00\x2a'), '0000002a')
+        self.assertEqual(puid_key('0000ABCD '), '0000abcd')
+        self.assertEqual(puid_key(b'0000abcd'), '0000abcd')
+        self.assertIsNone(puid_key(None))
+
+    def test_routes_by_puid(self):
+        self.receiver.route({'r_puid': 42, 'data': b'fix'})
+        self.receiver.route({'r_puid': 0xabcd, 'data': b'frame'})
+        self.assertEqual(self.gps.get_nowait()['data'], b'fix')
+        self.assertEqual(self.camera.get_nowait()['data'], b'frame')
+
+    def test_unknown_puid_counted(self):
+        self.receiver.route({'r_puid': 7, 'data': b''})
+        self.receiver.route({'data': b''})
+        self.assertEqual(self.receiver.unknown_puid, 2)
+        self.assertTrue(self.gps.empty())
+
+    def test_full_queue_drops_without_blocking_others(self):
+        for i in range(3):
+            self.receiver.route({'r_puid': 0xabcd, 'data': b'%d' % (i)})
+        self.receiver.route({'r_puid': 42, 'data': b'fix'})
+        self.assertEqual(self.receiver.plugin_counters['camera'], [1, 2])
+        self.assertEqual(self.receiver.plugin_counters['gps'], [1, 0])
+
+        self.receiver.maintain()
+        self.assertEqual(self.stats['plugins']['camera'], {'depth': 1, 'delivered': 1, 'dropped': 2})
+        self.assertEqual(self.stats['unknown puid'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest
+from unittest import mock
+
+from lib.histogram import histogram
+from lib.retry_scheduler import retry_scheduler, circuit_breaker, backoff
+
+
+class clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class test_backoff(unittest.TestCase):
+
+    def test_jitter_within_bounds(self):
+        for attempt in range(10):
+            delay = backoff(attempt, 0.5, 60)
+            full = min(60, 0.5 * 2 ** attempt)
+            self.assertGreaterEqual(delay, full / 2)
+            self.assertLessEqual(delay, full)
+
+
+class test_retry_scheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock()
+        patcher = mock.patch('lib.retry_scheduler.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_items_due_in_order(self):
+        delays = histogram()
+        retries = retry_scheduler(delays=delays)
+        retries.schedule('late', delay=2)
+        retries.schedule('early', delay=1)
+        retries.schedule('also early', delay=1)
+
+        self.assertIsNone(retries.pop_due())
+        self.assertEqual(retries.time_left(), 1)
+        self.clock.now += 1
+        self.assertEqual(retries.pop_due(), 'early')
+        self.assertEqual(retries.pop_due(), 'also early')
+        self.assertIsNone(retries.pop_due())
+        self.clock.now += 1
+        self.assertEqual(retries.pop_due(), 'late')
+        self.assertIsNone(retries.time_left())
+        self.assertEqual(delays.count, 3)
+
+    def test_backoff_grows_with_attempt(self):
+        retries = retry_scheduler(base=1, maximum=60)
+        retries.schedule('second try', attempt=0)
+        retries.schedule('fifth try', attempt=4)
+        self.clock.now += 1
+        self.assertEqual(retries.pop_due(), 'second try')
+        self.assertIsNone(retries.pop_due())
+        self.clock.now += 15
+        self.assertEqual(retries.pop_due(), 'fifth try')
+
+    def test_bounded(self):
+        retries = retry_scheduler(max_pending=2)
+        self.assertTrue(retries.schedule('a', delay=0))
+        self.assertTrue(retries.schedule('b', delay=0))
+        self.assertFalse(retries.schedule('c', delay=0))
+        self.assertEqual(retries.dropped, 1)
+        self.assertEqual(retries.drain(), ['a', 'b'])
+        self.assertEqual(len(retries), 0)
+
+
+class test_circuit_breaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock()
+        patcher = mock.patch('lib.retry_scheduler.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = circuit_breaker(failure_threshold=3, base_interval=1, max_interval=60)
+
+    def test_opens_after_threshold(self):
+        self.assertFalse(self.breaker.failure())
+        self.assertFalse(self.breaker.failure())
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.failure())
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+        # failures while open do not extend the interval
+        self.assertFalse(self.breaker.failure())
+
+    def test_success_resets_failures(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.assertFalse(self.breaker.success())
+        self.assertFalse(self.breaker.failure())
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+
+    def test_half_open_probe(self):
+        for i in range(3):
+            self.breaker.failure()
+        self.clock.now += self.breaker.time_left()
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, circuit_breaker.HALF_OPEN)
+        self.assertTrue(self.breaker.success())
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+        self.assertEqual(self.breaker.time_left(), 0)
+
+    def test_failed_probe_reopens_for_longer(self):
+        for i in range(3):
+            self.breaker.failure()
+        intervals = []
+        for i in range(6):
+            intervals.append(self.breaker.time_left())
+            self.clock.now += self.breaker.time_left()
+            self.assertTrue(self.breaker.allow())
+            self.assertTrue(self.breaker.failure())
+            self.assertTrue(self.breaker.is_open())
+        # the n-th opening lasts between half and all of 2 * base * 2^n, up to max_interval
+        for n, interval in enumerate(intervals):
+            full = min(60, 2 ** (n + 1))
+            self.assertGreaterEqual(interval, full / 2.0)
+            self.assertLessEqual(interval, full)
+
+
+if __name__ == '__main__':
+    unittest.main()
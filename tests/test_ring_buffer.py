@@ -0,0 +1,114 @@
+import multiprocessing.connection
+import queue
+import unittest
+
+from lib.ring_buffer import ring_buffer, DATA_OFFSET, LENGTH, PADDING
+
+
+class test_ring_buffer(unittest.TestCase):
+
+    def test_empty(self):
+        ring = ring_buffer(256)
+        self.assertTrue(ring.empty())
+        self.assertIsNone(ring.get_bytes())
+        self.assertEqual(ring.get_batch(10), [])
+
+    def test_order(self):
+        ring = ring_buffer(256)
+        for i in range(5):
+            ring.put(b'message %d' % (i))
+        self.assertFalse(ring.empty())
+
+        self.assertEqual(ring.get_batch(3), [b'message 0', b'message 1', b'message 2'])
+        self.assertEqual(ring.get_batch(10), [b'message 3', b'message 4'])
+        self.assertTrue(ring.empty())
+
+    def test_parts(self):
+        ring = ring_buffer(256)
+        ring.put([b'head ', bytearray(b'body '), memoryview(b'tail')])
+        self.assertEqual(ring.get_bytes(), b'head body tail')
+
+    def test_full(self):
+        # records of 4 + 20 bytes take 24 bytes, 5 of them fill 128 bytes but for 8
+        ring = ring_buffer(128)
+        for i in range(5):
+            ring.put_nowait(b'%020d' % (i))
+        self.assertRaises(queue.Full, ring.put_nowait, b'x' * 20)
+        self.assertRaises(queue.Full, ring.put, b'x' * 20, True, 0.01)
+
+        # a smaller record still fits
+        ring.put_nowait(b'')
+
+        self.assertEqual(ring.get_bytes(), b'%020d' % (0))
+        ring.put_nowait(b'%020d' % (5))
+        self.assertEqual(ring.get_batch(10), [b'%020d' % (i) for i in range(1, 5)] + [b'', b'%020d' % (5)])
+
+    def test_too_large(self):
+        ring = ring_buffer(128)
+        self.assertRaises(ValueError, ring.put, b'x' * 125)
+        ring.put(b'x' * 124)
+        self.assertEqual(ring.get_bytes(), b'x' * 124)
+
+    def test_wraparound(self):
+        ring = ring_buffer(128)
+        received = []
+        # 40 byte records do not divide 128, every few of them wrap around with padding
+        for i in range(100):
+            ring.put_nowait(b'%036d' % (i))
+            ring.put_nowait(b'%036d' % (i + 1000))
+            received.extend(ring.get_batch(2))
+        self.assertEqual(received, [b'%036d' % (j) for i in range(100) for j in (i, i + 1000)])
+        self.assertTrue(ring.empty())
+
+    def test_padding(self):
+        ring = ring_buffer(128)
+        ring.put(b'x' * 92)
+        self.assertEqual(ring.get_bytes(), b'x' * 92)
+
+        # 32 bytes are left before the end, a 40 byte record goes to the start
+        ring.put(b'y' * 36)
+        self.assertEqual(LENGTH.unpack_from(ring.mem, DATA_OFFSET + 96)[0], PADDING)
+        self.assertEqual(LENGTH.unpack_from(ring.mem, DATA_OFFSET)[0], 36)
+        self.assertEqual(ring.get_bytes(), b'y' * 36)
+
+    def test_padding_needs_room(self):
+        ring = ring_buffer(128)
+        ring.put(b'x' * 60)
+        ring.put(b'x' * 28)
+        ring.get_bytes()
+
+        # 96 bytes are free, 32 at the end and 64 at the start. A 72 byte record fits into
+        # neither, the 32 bytes before the end become padding.
+        self.assertRaises(queue.Full, ring.put_nowait, b'y' * 68)
+        ring.get_bytes()
+        ring.put_nowait(b'y' * 68)
+        self.assertEqual(ring.get_bytes(), b'y' * 68)
+
+    def test_idle(self):
+        ring = ring_buffer(256)
+        self.assertTrue(ring.idle())
+        ring.put(b'message')
+        self.assertFalse(ring.idle())
+        ring.get_bytes()
+        self.assertTrue(ring.idle())
+
+    def test_wakeup(self):
+        ring = ring_buffer(256)
+        self.assertEqual(multiprocessing.connection.wait([ring], 0), [])
+
+        ring.put(b'first')
+        self.assertEqual(multiprocessing.connection.wait([ring], 0), [ring])
+
+        ring.clear_wakeup()
+        self.assertEqual(multiprocessing.connection.wait([ring], 0), [])
+
+        # the consumer has not caught up, it does not need another wakeup
+        ring.put(b'second')
+        self.assertEqual(multiprocessing.connection.wait([ring], 0), [])
+        ring.get_batch(10)
+        ring.put(b'third')
+        self.assertEqual(multiprocessing.connection.wait([ring], 0), [ring])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import queue
+import unittest
+
+from plugins.system_router.system_router import system_router
+
+try:
+    from lib.run_plugins_multi import plugin_runner
+except ImportError:
+    # run_plugins_multi needs psutil
+    plugin_runner = None
+
+
+class control_queue(queue.Queue):
+    """
+        The control channel. The tests do not wait on it, so it needs no reading end.
+    """
+    _reader = None
+
+
+def make_router():
+    listener_queues = {'client-0': queue.Queue(), 'client-1': queue.Queue()}
+    router = system_router('system_router', {'system_router': 1}, [], {}, listener_queues, control_queue(), acks=queue.Queue())
+    return router
+
+
+def client(filters=[]):
+    return {'name': 'client', 'queue_name': 'client-0', 'pid': 0, 'filters': filters, 'maxsize': 10, 'policy': 'drop-oldest'}
+
+
+def drain(control_queue):
+    items = []
+    while True:
+        try:
+            items.append(control_queue.get_nowait())
+        except queue.Empty:
+            return items
+
+
+class test_router_control(unittest.TestCase):
+
+    def test_add(self):
+        router = make_router()
+        router.control.put(('add', 'a', client([('gps', None)])))
+        router.read_control()
+
+        self.assertEqual(list(router.listeners), ['a'])
+        self.assertIs(router.listeners['a']['queue'], router.listener_queues['client-0'])
+        self.assertEqual(router.listeners['a']['maxsize'], 10)
+        self.assertEqual(router.match(('gps', 'position')), ['a'])
+        self.assertEqual(router.match(('coresense_3', 'frame')), [])
+
+    def test_remove(self):
+        router = make_router()
+        router.control.put(('add', 'a', client()))
+        router.control.put(('add', 'b', client()))
+        router.read_control()
+        self.assertEqual(sorted(router.match(('gps', None))), ['a', 'b'])
+
+        router.control.put(('remove', 'a'))
+        router.read_control()
+        self.assertEqual(list(router.listeners), ['b'])
+        self.assertEqual(router.match(('gps', None)), ['b'])
+        self.assertEqual(drain(router.acks), ['a'])
+
+    def test_remove_unknown(self):
+        # a listener the router reaped already is confirmed as well
+        router = make_router()
+        router.control.put(('remove', 'a'))
+        router.read_control()
+        self.assertEqual(router.listeners, {})
+        self.assertEqual(drain(router.acks), ['a'])
+
+    def test_bad_commands(self):
+        router = make_router()
+        router.control.put(('rename', 'a'))
+        router.control.put(('add', 'a', dict(client(), queue_name='client-9')))
+        router.control.put(('add', 'b', client()))
+        router.read_control()
+        self.assertEqual(list(router.listeners), ['b'])
+
+
+class running_router(object):
+    name = 'system_router'
+
+    def is_alive(self):
+        return True
+
+
+@unittest.skipIf(plugin_runner is None, 'psutil is not installed')
+class test_listener_queue_reuse(unittest.TestCase):
+
+    def make_runner(self):
+        runner = plugin_runner.__new__(plugin_runner)
+        runner.jobs = []
+        runner.listeners = {}
+        runner.removing_listeners = {}
+        runner.router_control = queue.Queue()
+        runner.router_acks = queue.Queue()
+        runner.system_send_lanes = {}
+        runner.listener_queue_bounds = {}
+        runner.listener_queues = {'system_send': queue.Queue(), 'client-0': queue.Queue()}
+        runner.jobs.append(running_router())
+        return runner
+
+    def test_reuse_after_ack(self):
+        runner = self.make_runner()
+        status, listener_uuid = runner.add_listener('client', 'client-0', os.getpid())
+        self.assertEqual(status, 1)
+        self.assertEqual(runner.free_listener_queue(), None)
+
+        runner.remove_listener(listener_uuid)
+        self.assertEqual(drain(runner.router_control)[-1], ('remove', listener_uuid))
+        # the router may still deliver to the queue
+        runner.listener_queues['client-0'].put(b'old')
+        self.assertEqual(runner.free_listener_queue(), None)
+
+        runner.router_acks.put(listener_uuid)
+        self.assertEqual(runner.free_listener_queue(), 'client-0')
+        self.assertTrue(runner.listener_queues['client-0'].empty())
+
+    def test_reuse_without_router(self):
+        runner = self.make_runner()
+        status, listener_uuid = runner.add_listener('client', 'client-0', os.getpid())
+        runner.remove_listener(listener_uuid)
+
+        runner.jobs = []
+        self.assertEqual(runner.free_listener_queue(), 'client-0')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import multiprocessing
+import queue
+import threading
+import time
+import unittest
+
+from lib.ring_buffer import ring_buffer
+from plugins.system_router.system_router import system_router
+
+try:
+    from lib.run_plugins_multi import priority_classes
+except ImportError:
+    # run_plugins_multi needs psutil
+    priority_classes = None
+
+
+class lane_queue(queue.Queue):
+    """
+        A mailbox of a lane. The tests do not wait on it, so it needs no reading end.
+    """
+    _reader = None
+
+
+def make_router(batch_size=64):
+    lanes = []
+    for name, weight in [('control', 16), ('health', 4), ('bulk', 1)]:
+        lanes.append({'name': name, 'weight': weight, 'mailbox': lane_queue(), 'rings': []})
+    router = system_router('system_router', {'system_router': 1}, lanes, {})
+    router.batch_size = batch_size
+    return router
+
+
+def fill(router, lane_name, count):
+    for lane in router.lanes:
+        if lane['name'] == lane_name:
+            for i in range(count):
+                lane['mailbox'].put(('%s %d' % (lane_name, i)).encode())
+
+
+def lane_counts(batch):
+    counts = {'control': 0, 'health': 0, 'bulk': 0}
+    for lane_name, encoded in batch:
+        counts[lane_name] += 1
+    return counts
+
+
+class test_router_lanes(unittest.TestCase):
+
+    def test_weighted_shares(self):
+        router = make_router()
+        for lane_name in ['control', 'health', 'bulk']:
+            fill(router, lane_name, 1000)
+
+        batch = router.read_batch()
+        self.assertEqual(len(batch), 64)
+        counts = lane_counts(batch)
+        # 16:4:1 of 64, the rest of the batch goes to the highest lane
+        self.assertEqual(counts, {'control': 49, 'health': 12, 'bulk': 3})
+        self.assertTrue(router.backlog)
+
+        # higher lanes are dispatched first
+        self.assertEqual([x[0] for x in batch], ['control'] * 49 + ['health'] * 12 + ['bulk'] * 3)
+
+    def test_bulk_not_starved(self):
+        router = make_router()
+        fill(router, 'control', 10000)
+        fill(router, 'bulk', 10)
+        bulk = 0
+        for i in range(4):
+            bulk += lane_counts(router.read_batch())['bulk']
+        self.assertEqual(bulk, 10)
+
+    def test_idle_lanes_leave_room(self):
+        router = make_router()
+        fill(router, 'bulk', 100)
+        fill(router, 'health', 1)
+        batch = router.read_batch()
+        self.assertEqual(lane_counts(batch), {'control': 0, 'health': 1, 'bulk': 63})
+        self.assertEqual(batch[0], ('health', b'health 0'))
+
+    def test_priority_lanes_delivered_to_own_queue(self):
+        router = make_router()
+        send_queue = queue.Queue()
+        control_queue = queue.Queue()
+        router.add_listener('send', {'name': 'system_send', 'queue': send_queue, 'lane_queues': {'control': control_queue}})
+
+        listener = router.listeners['send']
+        router.deliver(listener, b'reboot', 'control')
+        router.deliver(listener, b'frame', 'bulk')
+        # a class without a queue of its own goes with the bulk data
+        router.deliver(listener, b'health report', 'health')
+        self.assertEqual(control_queue.get_nowait(), b'reboot')
+        self.assertEqual([send_queue.get_nowait(), send_queue.get_nowait()], [b'frame', b'health report'])
+        self.assertEqual(listener['delivered'], 3)
+
+    def test_ring_wakeup(self):
+        ring = ring_buffer(4096)
+        mailbox = multiprocessing.Queue()
+        self.addCleanup(mailbox.close)
+        router = system_router('system_router', {'system_router': 1}, [{'name': 'bulk', 'weight': 1, 'mailbox': mailbox, 'rings': [ring]}], {})
+
+        # an idle router sleeps for the whole timeout, it does not poll the ring
+        router.blocking_timeout = 0.2
+        start = time.monotonic()
+        self.assertEqual(router.wait(), [])
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+        # a record that is there although its wakeup was taken does not wait for the timeout
+        router.blocking_timeout = 5
+        ring.put(b'early')
+        ring.clear_wakeup()
+        start = time.monotonic()
+        router.wait()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(router.read_batch(), [('bulk', b'early')])
+
+        # a record put into the empty ring wakes the router up
+        producer = threading.Timer(0.05, ring.put, [b'late'])
+        producer.start()
+        start = time.monotonic()
+        self.assertEqual(router.wait(), [ring])
+        self.assertLess(time.monotonic() - start, 1)
+        producer.join()
+        self.assertEqual(router.read_batch(), [('bulk', b'late')])
+
+    @unittest.skipIf(priority_classes is None, 'psutil is not installed')
+    def test_unknown_class_is_bulk(self):
+        classes = priority_classes({'system_base': 'health', 'wagman': 'control', 'gps': 'urgent'})
+        self.assertEqual(classes, {'system_base': 'health', 'wagman': 'control'})
+
+
+if __name__ == '__main__':
+    unittest.main()
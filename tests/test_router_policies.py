@@ -0,0 +1,120 @@
+import queue
+import threading
+import time
+import unittest
+
+from plugins.system_router.system_router import system_router
+
+
+class lagging_queue(queue.Queue):
+    """
+        A queue whose messages are counted but not readable yet, like those of a
+        multiprocessing queue that are still in its feeder thread.
+    """
+    def get_nowait(self):
+        raise queue.Empty
+
+
+def make_router(listener_queue, maxsize, policy, sample_every=10):
+    router = system_router('system_router', {'system_router': 1}, [], {})
+    router.blocking_timeout = 0.01
+    router.add_listener('uuid', {'name': 'test', 'queue': listener_queue, 'maxsize': maxsize, 'policy': policy,
+        'sample_every': sample_every})
+    return router, router.listeners['uuid']
+
+
+def drain(listener_queue):
+    messages = []
+    while not listener_queue.empty():
+        messages.append(listener_queue.get_nowait())
+    return messages
+
+
+class test_router_policies(unittest.TestCase):
+
+    def test_unbounded(self):
+        listener_queue = queue.Queue()
+        router, listener = make_router(listener_queue, 0, 'drop-newest')
+        for i in range(100):
+            router.deliver(listener, i)
+
+        self.assertEqual(listener_queue.qsize(), 100)
+        self.assertEqual(listener['delivered'], 100)
+        self.assertEqual(listener['dropped'], 0)
+
+    def test_drop_newest(self):
+        listener_queue = queue.Queue()
+        router, listener = make_router(listener_queue, 3, 'drop-newest')
+        for i in range(5):
+            router.deliver(listener, i)
+
+        self.assertEqual(drain(listener_queue), [0, 1, 2])
+        self.assertEqual(listener['delivered'], 3)
+        self.assertEqual(listener['dropped'], 2)
+        self.assertEqual(listener['high_water'], 3)
+
+    def test_drop_oldest(self):
+        listener_queue = queue.Queue()
+        router, listener = make_router(listener_queue, 3, 'drop-oldest')
+        for i in range(5):
+            router.deliver(listener, i)
+
+        self.assertEqual(drain(listener_queue), [2, 3, 4])
+        self.assertEqual(listener['delivered'], 5)
+        self.assertEqual(listener['dropped'], 2)
+
+    def test_drop_oldest_not_readable(self):
+        # the new message is dropped instead, the queue does not grow past maxsize
+        listener_queue = lagging_queue()
+        router, listener = make_router(listener_queue, 3, 'drop-oldest')
+        for i in range(5):
+            router.deliver(listener, i)
+
+        self.assertEqual(listener_queue.qsize(), 3)
+        self.assertEqual(listener['delivered'], 3)
+        self.assertEqual(listener['dropped'], 2)
+
+    def test_sample(self):
+        listener_queue = queue.Queue()
+        router, listener = make_router(listener_queue, 2, 'sample', sample_every=3)
+        for i in range(8):
+            router.deliver(listener, i)
+
+        # of the 6 messages that found the queue full, every third replaced the oldest one
+        self.assertEqual(drain(listener_queue), [4, 7])
+        self.assertEqual(listener['delivered'], 4)
+        self.assertEqual(listener['dropped'], 6)
+
+    def test_block_waits_for_room(self):
+        listener_queue = queue.Queue(2)
+        router, listener = make_router(listener_queue, 2, 'block')
+        router.deliver(listener, 0)
+        router.deliver(listener, 1)
+
+        def read():
+            time.sleep(0.05)
+            listener_queue.get()
+        reader = threading.Thread(target=read)
+        reader.start()
+        router.deliver(listener, 2)
+        reader.join()
+
+        self.assertEqual(drain(listener_queue), [1, 2])
+        self.assertEqual(listener['delivered'], 3)
+        self.assertEqual(listener['dropped'], 0)
+
+    def test_block_stops(self):
+        listener_queue = queue.Queue(1)
+        router, listener = make_router(listener_queue, 1, 'block')
+        router.deliver(listener, 0)
+
+        router.man['system_router'] = 0
+        router.deliver(listener, 1)
+
+        self.assertEqual(drain(listener_queue), [0])
+        self.assertEqual(listener['delivered'], 1)
+        self.assertEqual(listener['dropped'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
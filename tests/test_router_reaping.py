@@ -0,0 +1,80 @@
+import multiprocessing.connection
+import os
+import queue
+import subprocess
+import sys
+import unittest
+
+from plugins.system_router.system_router import system_router
+
+
+def start_listener_process():
+    return subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+
+
+def make_router(pid):
+    router = system_router('system_router', {'system_router': 1}, [], {})
+    router.add_listener('a', {'name': 'client', 'queue': queue.Queue(), 'pid': pid})
+    router.add_listener('b', {'name': 'client', 'queue': queue.Queue()})
+    router.build_subscription_index()
+    return router
+
+
+@unittest.skipIf(not hasattr(os, 'pidfd_open'), 'no pidfd support')
+class test_router_reaping(unittest.TestCase):
+
+    def test_reap(self):
+        process = start_listener_process()
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        router = make_router(process.pid)
+        self.assertEqual(list(router.pidfds.values()), ['a'])
+
+        # nothing to reap while the process runs
+        self.assertEqual(multiprocessing.connection.wait(list(router.pidfds), 0), [])
+
+        process.kill()
+        ready = multiprocessing.connection.wait(list(router.pidfds), 5)
+        self.assertEqual(len(ready), 1)
+        pidfd = ready[0]
+
+        router.reap_listeners(ready)
+        self.assertEqual(list(router.listeners), ['b'])
+        self.assertEqual(router.pidfds, {})
+        self.assertEqual(router.match(('gps', None)), ['b'])
+        # the pidfd is closed
+        self.assertRaises(OSError, os.fstat, pidfd)
+
+    def test_reap_ignores_other_objects(self):
+        process = start_listener_process()
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        router = make_router(process.pid)
+
+        router.reap_listeners([])
+        router.reap_listeners([queue.Queue()])
+        self.assertEqual(sorted(router.listeners), ['a', 'b'])
+
+    def test_remove_closes_pidfd(self):
+        process = start_listener_process()
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        router = make_router(process.pid)
+        pidfd = list(router.pidfds)[0]
+
+        router.remove_listener('a')
+        self.assertEqual(router.pidfds, {})
+        self.assertRaises(OSError, os.fstat, pidfd)
+
+    def test_process_gone(self):
+        process = start_listener_process()
+        process.kill()
+        process.wait()
+
+        router = make_router(process.pid)
+        self.assertEqual(list(router.listeners), ['b'])
+        self.assertEqual(router.pidfds, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import queue
+import unittest
+
+from lib import message_codec
+from plugins.system_router.system_router import system_router
+
+
+def make_router(filters):
+    """
+        filters: listener name -> filters of the listener, [] subscribes to everything
+    """
+    listeners = {}
+    for name in filters:
+        listeners[name] = {'name': name, 'queue': queue.Queue(), 'filters': filters[name]}
+    return system_router('system_router', {'system_router': 1}, [], listeners)
+
+
+def match(router, msg, source):
+    return sorted(router.match(message_codec.topic(message_codec.encode(msg, source))))
+
+
+class test_router_subscriptions(unittest.TestCase):
+
+    def test_plugin(self):
+        router = make_router({'coresense': [('coresense_3', None)]})
+        self.assertEqual(match(router, {'sensor': 'frame', 'data': b'\x00'}, 'coresense_3'), ['coresense'])
+        self.assertEqual(match(router, {'data': 1}, 'coresense_3'), ['coresense'])
+        self.assertEqual(match(router, {'sensor': 'frame', 'data': b'\x00'}, 'gps'), [])
+
+    def test_plugin_sensor(self):
+        router = make_router({'frames': [('coresense_3', 'frame')]})
+        self.assertEqual(match(router, {'sensor': 'frame', 'data': b'\x00'}, 'coresense_3'), ['frames'])
+        self.assertEqual(match(router, {'sensor': 'status', 'data': 1}, 'coresense_3'), [])
+        self.assertEqual(match(router, 'no sensor', 'coresense_3'), [])
+        self.assertEqual(match(router, {'sensor': 'frame', 'data': 1}, 'gps'), [])
+
+    def test_wildcard(self):
+        router = make_router({'all': [], 'gps': [('gps', None)]})
+        self.assertEqual(match(router, {'sensor': 'frame', 'data': b'\x00'}, 'coresense_3'), ['all'])
+        self.assertEqual(match(router, {'sensor': 'position', 'data': 1}, 'gps'), ['all', 'gps'])
+
+    def test_several_filters(self):
+        router = make_router({
+            'mixed': [('gps', None), ('coresense_3', 'frame')],
+            'frames': [('coresense_3', 'frame')],
+            'coresense': [('coresense_3', None)],
+        })
+        self.assertEqual(match(router, {'sensor': 'frame', 'data': b'\x00'}, 'coresense_3'), ['coresense', 'frames', 'mixed'])
+        self.assertEqual(match(router, {'sensor': 'status', 'data': 1}, 'coresense_3'), ['coresense'])
+        self.assertEqual(match(router, {'sensor': 'position', 'data': 1}, 'gps'), ['mixed'])
+
+    def test_index_rebuilt(self):
+        router = make_router({'frames': [('coresense_3', 'frame')]})
+        self.assertEqual(match(router, {'sensor': 'frame', 'data': 1}, 'coresense_3'), ['frames'])
+
+        # the cached match is dropped with the index
+        router.add_listener('all', {'name': 'all', 'queue': queue.Queue()})
+        router.build_subscription_index()
+        self.assertEqual(match(router, {'sensor': 'frame', 'data': 1}, 'coresense_3'), ['all', 'frames'])
+
+        router.remove_listener('frames')
+        router.build_subscription_index()
+        self.assertEqual(match(router, {'sensor': 'frame', 'data': 1}, 'coresense_3'), ['all'])
+
+
+if __name__ == '__main__':
+    unittest.main()
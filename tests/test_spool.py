@@ -0,0 +1,182 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from lib.spool import spool, RECORD
+
+
+class test_spool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_all(self, s):
+        packets = []
+        while True:
+            record = s.read()
+            if record is None:
+                return packets
+            packets.append(record)
+
+    def test_append_read_commit(self):
+        s = spool(self.directory)
+        self.assertTrue(s.empty())
+        s.append(b'a')
+        s.append(b'bb')
+        records = self.read_all(s)
+        self.assertEqual([data for position, data in records], [b'a', b'bb'])
+        self.assertTrue(s.empty())
+
+        # packets that were read but not committed are read again
+        s.commit(records[0][0])
+        s.rewind()
+        self.assertEqual([data for position, data in self.read_all(s)], [b'bb'])
+        s.close()
+
+    def test_segments_rotate_and_are_removed_once_delivered(self):
+        s = spool(self.directory, segment_bytes=100)
+        for i in range(10):
+            s.append(b'x' * 40)
+        self.assertEqual(len(s.segments), 4)
+
+        for position, data in self.read_all(s):
+            s.commit(position)
+        self.assertEqual(len(s.segments), 1)
+        self.assertEqual(s.pending_bytes(), 0)
+        self.assertEqual(len([x for x in os.listdir(self.directory) if x.endswith('.seg')]), 1)
+        s.close()
+
+    def test_oldest_segments_dropped_when_full(self):
+        s = spool(self.directory, segment_bytes=100, max_bytes=300)
+        for i in range(20):
+            s.append(b'%02d' % (i) * 20)
+        self.assertLessEqual(s.write_position - s.segments[0], 300)
+        self.assertGreater(s.dropped_bytes, 0)
+
+        packets = [data for position, data in self.read_all(s)]
+        # the newest packets survive, in order
+        self.assertEqual(packets[-1], b'19' * 20)
+        self.assertEqual(packets, sorted(packets))
+        s.close()
+
+    def test_reopen_resumes_at_synced_position(self):
+        s = spool(self.directory, segment_bytes=100)
+        for i in range(5):
+            s.append(b'%d' % (i) * 30)
+        records = self.read_all(s)
+        s.commit(records[1][0])
+        s.close()
+
+        s = spool(self.directory, segment_bytes=100)
+        self.assertEqual([data for position, data in self.read_all(s)], [b'%d' % (i) * 30 for i in range(2, 5)])
+        s.close()
+
+    def test_incomplete_record_cut_off(self):
+        s = spool(self.directory)
+        s.append(b'complete')
+        s.append(b'torn')
+        s.close()
+
+        path = s.segment_path(s.segments[-1])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 2)
+
+        s = spool(self.directory)
+        self.assertEqual([data for position, data in self.read_all(s)], [b'complete'])
+        # appending goes on behind the last complete record
+        s.append(b'next')
+        self.assertEqual(s.read()[1], b'next')
+        s.close()
+
+    def test_stale_commit_after_drop(self):
+        s = spool(self.directory, segment_bytes=500, max_bytes=1500)
+        for i in range(10):
+            s.append(b'%d' % (i) * 20)
+        stale_position, data = s.read()
+
+        # overflows the spool, the segment of the packet read above is dropped
+        for i in range(30):
+            s.append(b'%d' % (i) * 20)
+        self.assertGreater(s.committed, stale_position)
+
+        s.commit(stale_position)
+        self.assertGreaterEqual(s.committed, s.segments[0])
+
+        s.rewind()
+        self.assertIsNotNone(s.read())
+        s.close()
+
+    def test_corrupt_record_skips_rest_of_segment(self):
+        s = spool(self.directory, segment_bytes=100)
+        for i in range(9):
+            s.append(b'%d' % (i) * 30)
+        s.close()
+        self.assertEqual(len(s.segments), 3)
+
+        # a bit flips in the second packet of the first segment, which recover() does not check
+        path = s.segment_path(s.segments[0])
+        with open(path, 'r+b') as f:
+            f.seek(RECORD.size + 30 + RECORD.size + 5)
+            f.write(b'x')
+
+        s = spool(self.directory, segment_bytes=100)
+        packets = [data for position, data in self.read_all(s)]
+        # three packets to a segment, the third one is skipped as well
+        self.assertEqual(packets, [b'0' * 30] + [b'%d' % (i) * 30 for i in range(3, 9)])
+        self.assertEqual(s.get_stats()['corrupt bytes'], 2 * (RECORD.size + 30))
+        s.close()
+
+    def test_corrupt_last_record(self):
+        s = spool(self.directory)
+        s.append(b'first')
+        s.append(b'second')
+
+        # garbage length in the second record
+        with open(s.segment_path(s.segments[0]), 'r+b') as f:
+            f.seek(RECORD.size + 5)
+            f.write(RECORD.pack(1 << 30, 0))
+
+        self.assertEqual(s.read()[1], b'first')
+        self.assertIsNone(s.read())
+        self.assertTrue(s.empty())
+        s.append(b'third')
+        self.assertEqual(s.read()[1], b'third')
+        s.close()
+
+    def test_directory_synced(self):
+        s = spool(self.directory, segment_bytes=100, max_bytes=300)
+        with mock.patch.object(s, 'sync_directory', wraps=s.sync_directory) as sync_directory:
+            s.append(b'a' * 100)
+            self.assertEqual(sync_directory.call_count, 0)
+
+            # a new segment
+            s.append(b'b' * 100)
+            self.assertEqual(sync_directory.call_count, 1)
+
+            # the offset file is replaced
+            s.sync()
+            self.assertEqual(sync_directory.call_count, 2)
+
+            # a delivered segment is removed
+            position, data = s.read()
+            s.commit(position)
+            self.assertEqual(sync_directory.call_count, 3)
+
+            # a new segment
+            s.append(b'c' * 100)
+            self.assertEqual(sync_directory.call_count, 4)
+
+            # a new segment, and the oldest one is dropped since the spool is full
+            s.append(b'd' * 100)
+            self.assertEqual(s.dropped_segments, 1)
+            self.assertEqual(sync_directory.call_count, 6)
+        s.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
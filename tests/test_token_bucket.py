@@ -0,0 +1,133 @@
+import unittest
+from unittest import mock
+
+from lib.token_bucket import token_bucket, shaper
+
+
+class fake_clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class test_token_bucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock()
+        patcher = mock.patch('lib.token_bucket.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst(self):
+        bucket = token_bucket(100, 500)
+        self.assertEqual(bucket.level(), 500)
+        self.assertTrue(bucket.consume(300))
+        self.assertTrue(bucket.consume(200))
+        self.assertFalse(bucket.consume(1))
+        self.assertEqual(bucket.level(), 0)
+
+    def test_refill(self):
+        bucket = token_bucket(100, 500)
+        bucket.consume(500)
+
+        self.clock.now += 1.5
+        self.assertEqual(bucket.level(), 150)
+        self.assertFalse(bucket.consume(200))
+        self.assertEqual(bucket.time_until(200), 0.5)
+
+        self.clock.now += 0.5
+        self.assertEqual(bucket.time_until(200), 0)
+        self.assertTrue(bucket.consume(200))
+
+        # never more than burst
+        self.clock.now += 60
+        self.assertEqual(bucket.level(), 500)
+
+    def test_larger_than_burst(self):
+        bucket = token_bucket(100, 500)
+        bucket.consume(100)
+        self.assertFalse(bucket.consume(800))
+        self.assertEqual(bucket.time_until(800), 1)
+
+        # passes with a full bucket and leaves it in debt
+        self.clock.now += 1
+        self.assertTrue(bucket.consume(800))
+        self.assertEqual(bucket.level(), -300)
+        self.assertEqual(bucket.time_until(100), 4)
+
+
+class test_shaper(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock()
+        patcher = mock.patch('lib.token_bucket.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_not_limited(self):
+        limits = shaper({'limit.gps': '100:200'})
+        for i in range(10):
+            self.assertEqual(limits.admit('coresense_3', b'x' * 1000), [b'x' * 1000])
+        self.assertIsNone(limits.time_left())
+
+    def test_defer(self):
+        limits = shaper({'limit.gps': '100:200'})
+        self.assertEqual(limits.admit('gps', b'1' * 100), [b'1' * 100])
+        self.assertEqual(limits.admit('gps', b'2' * 100), [b'2' * 100])
+        self.assertEqual(limits.admit('gps', b'3' * 100), [])
+        self.assertEqual(limits.admit('gps', b'4' * 50), [])
+        self.assertEqual(limits.time_left(), 1)
+        self.assertEqual(limits.release(), [])
+
+        # the deferred messages go out in order, a new one does not overtake them
+        self.clock.now += 1
+        self.assertEqual(limits.admit('gps', b'5' * 10), [])
+        self.assertEqual(limits.release(), [b'3' * 100])
+        self.clock.now += 0.6
+        self.assertEqual(limits.release(), [b'4' * 50, b'5' * 10])
+        self.assertIsNone(limits.time_left())
+
+        stats = limits.get_stats()
+        self.assertEqual(stats['gps bytes passed'], 360)
+        self.assertEqual(stats['gps deferred'], 3)
+        self.assertEqual(stats['gps waiting'], 0)
+        self.assertEqual(stats['gps dropped'], 0)
+
+    def test_defer_bounded(self):
+        limits = shaper({'limit.gps': '100:100'}, max_deferred=2)
+        limits.admit('gps', b'0' * 100)
+        for i in range(1, 5):
+            limits.admit('gps', b'%d' % (i) * 100)
+
+        # the oldest deferred messages are dropped
+        self.clock.now += 1
+        self.assertEqual(limits.release(), [b'3' * 100])
+        self.clock.now += 1
+        self.assertEqual(limits.release(), [b'4' * 100])
+        self.assertEqual(limits.get_stats()['gps dropped'], 2)
+
+    def test_drop(self):
+        limits = shaper({'limit.gps': '100:200:drop'})
+        self.assertEqual(limits.admit('gps', b'1' * 150), [b'1' * 150])
+        self.assertEqual(limits.admit('gps', b'2' * 100), [])
+        self.assertIsNone(limits.time_left())
+
+        self.clock.now += 0.5
+        self.assertEqual(limits.admit('gps', b'3' * 100), [b'3' * 100])
+        self.assertEqual(limits.release(), [])
+
+        stats = limits.get_stats()
+        self.assertEqual(stats['gps bytes passed'], 250)
+        self.assertEqual(stats['gps deferred'], 0)
+        self.assertEqual(stats['gps dropped'], 1)
+
+    def test_invalid_limits(self):
+        limits = shaper({'limit.a': '100', 'limit.b': 'x:100', 'limit.c': '100:100:later', 'limit.d': '0:100',
+            'limit.e': '100:100', 'linger': '0'})
+        self.assertEqual(list(limits.buckets), ['e'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+from unittest import mock
+
+try:
+    import zmq
+    from lib.zmq_connection import zmq_pipeline
+except ImportError:
+    zmq = None
+
+
+class fake_clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@unittest.skipIf(zmq is None, 'zmq is not installed')
+class test_zmq_pipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.addCleanup(self.context.term)
+        # stands in for the REP socket of the node controller
+        self.server = self.context.socket(zmq.ROUTER)
+        self.server.setsockopt(zmq.LINGER, 0)
+        self.server.setsockopt(zmq.RCVTIMEO, 5000)
+        self.addCleanup(self.server.close)
+        port = self.server.bind_to_random_port('tcp://127.0.0.1')
+
+        self.clock = fake_clock()
+        patcher = mock.patch('lib.zmq_connection.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.pipeline = zmq_pipeline('127.0.0.1', port, window=3, reply_timeout=10, context=self.context)
+        self.addCleanup(self.pipeline.close)
+
+    def serve(self):
+        """
+            Receives one packet, returns the frames to reply with and the packet.
+        """
+        frames = self.server.recv_multipart()
+        delimiter = frames.index(b'')
+        return frames[:delimiter + 1], frames[delimiter + 1]
+
+    def reply(self, envelope):
+        self.server.send_multipart(envelope + [b'ok'])
+
+    def receive(self, count):
+        """
+            Reads replies until count packets are acknowledged.
+        """
+        acknowledged = []
+        while len(acknowledged) < count:
+            self.assertTrue(self.pipeline.socket.poll(5000))
+            acknowledged.extend(self.pipeline.receive())
+        return acknowledged
+
+    def test_retire_on_reply(self):
+        for i in range(3):
+            self.pipeline.send(b'packet %d' % (i), i)
+        self.assertFalse(self.pipeline.has_room())
+
+        envelopes = []
+        for i in range(3):
+            envelope, packet = self.serve()
+            self.assertEqual(packet, b'packet %d' % (i))
+            envelopes.append(envelope)
+
+        # replies can come in any order
+        self.reply(envelopes[1])
+        self.assertEqual(self.receive(1), [1])
+        self.assertTrue(self.pipeline.has_room())
+        self.assertEqual(list(self.pipeline.in_flight.values()), [(1010.0, 0), (1010.0, 2)])
+
+        self.reply(envelopes[2])
+        self.reply(envelopes[0])
+        self.assertEqual(sorted(self.receive(2)), [0, 2])
+        self.assertEqual(len(self.pipeline.in_flight), 0)
+        self.assertIsNone(self.pipeline.time_left())
+
+    def test_timeout(self):
+        self.pipeline.send(b'first', 'first')
+        self.clock.now += 4
+        self.pipeline.send(b'second', 'second')
+        self.assertEqual(self.pipeline.time_left(), 6)
+
+        self.clock.now += 5
+        self.assertEqual(self.pipeline.expire(), [])
+
+        # only the first is overdue, nothing arrived after it
+        self.clock.now += 2
+        self.assertEqual(self.pipeline.expire(), [('first', False)])
+        self.assertEqual(list(self.pipeline.in_flight.values()), [(1014.0, 'second')])
+
+    def test_expired_while_link_works(self):
+        self.pipeline.send(b'lost', 'lost')
+        self.clock.now += 1
+        self.pipeline.send(b'second', 'second')
+        self.serve()
+        envelope, packet = self.serve()
+        self.reply(envelope)
+        self.assertEqual(self.receive(1), ['second'])
+
+        # a packet sent after the lost one was acknowledged, the link works
+        self.clock.now += 10
+        self.assertEqual(self.pipeline.expire(), [('lost', True)])
+
+    def test_resend_ignores_late_reply(self):
+        self.pipeline.send(b'packet', 'first try')
+        old_envelope, packet = self.serve()
+
+        self.clock.now += 11
+        self.assertEqual(self.pipeline.expire(), [('first try', False)])
+
+        # sent again under a new request id
+        self.pipeline.send(packet, 'second try')
+        new_envelope, packet = self.serve()
+        self.assertEqual(packet, b'packet')
+        self.assertNotEqual(old_envelope, new_envelope)
+
+        # the reply to the expired packet is ignored
+        self.reply(old_envelope)
+        self.reply(new_envelope)
+        self.assertEqual(self.receive(1), ['second try'])
+        self.assertEqual(len(self.pipeline.in_flight), 0)
+
+    def test_reset(self):
+        self.pipeline.send(b'a', 'a')
+        self.pipeline.send(b'b', 'b')
+        self.assertEqual(self.pipeline.reset(), ['a', 'b'])
+        self.assertIsNone(self.pipeline.socket)
+        self.assertTrue(self.pipeline.has_room())
+
+
+if __name__ == '__main__':
+    unittest.main()
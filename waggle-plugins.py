@@ -21,7 +21,7 @@ def command_dummy(results):
     print((json.dumps(results, sort_keys=True, indent=4, separators=(',', ': '))))
     
 
-def read_streaming_api():
+def read_streaming_api(command_line):
     client_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     
     try:
@@ -32,7 +32,8 @@ def read_streaming_api():
         return None
     
     try:
-        client_sock.sendall('log'.encode('iso-8859-15'))
+        # e.g. "log gps coresense_3:frame maxsize=100 policy=sample"
+        client_sock.sendall(" ".join(command_line).encode('iso-8859-15'))
     except Exception as e:
          print(("Error talking to socket: %s" % (str(e))))
          client_sock.close()
@@ -76,14 +77,22 @@ def read_api(command, timeout=3):
          client_sock.close()
          return None   
 
-    #ready = select.select([mysocket], [], [], timeout_in_seconds)
+    # the reply is one line of JSON, read until its newline or until the plugin manager closes the connection
+    chunks = []
     try:
-        data = client_sock.recv(2048).decode('iso-8859-15') #TODO need better solution
+        while True:
+            chunk = client_sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if chunk.endswith(b'\n'):
+                break
     except Exception as e:
         print(("Error reading socket: %s" % (str(e))))
         client_sock.close()
         return None
-        
+    data = b''.join(chunks).decode('iso-8859-15')
+
 
     client_sock.close()
 
@@ -125,7 +134,7 @@ def execute_command(command_line):
     try:
         command_function(results)
     except Exception as e:
-        print(('DATA: "%s"' % (str(data))))
+        print(('DATA: "%s"' % (str(results))))
         print(("error: "+str(e)))
     
 
@@ -139,7 +148,9 @@ if __name__ == '__main__':
         'list':  { 'function' : print_tables},
         'start': { 'function' : command_dummy},
         'stop':  { 'function' : command_dummy},
-        'kill':  { 'function' : command_dummy}
+        'kill':  { 'function' : command_dummy},
+        'stats': { 'function' : print_tables},
+        'latency': { 'function' : print_tables}
     }
     
     
@@ -163,7 +174,7 @@ if __name__ == '__main__':
         
             
         if len(command_array) > 0 and command_array[0] == 'log':
-            read_streaming_api()
+            read_streaming_api(command_array)
             continue
         
         execute_command(command_array)